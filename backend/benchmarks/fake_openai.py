@@ -0,0 +1,188 @@
+"""
+本機的 OpenAI API 替身 (只實作伺服器用到的 /v1/embeddings 與 /v1/chat/completions)
+
+- Embedding 依輸入內容的雜湊產生固定的單位向量 (同樣的文字每次都得到同樣的向量)
+- Chat 依 Prompt 內容回傳固定格式的結果：出題 JSON、評分 JSON 或一般文字回答 (支援串流)
+- 各種延遲可由參數調整，用來模擬真實 API 的回應時間
+
+用法 (於 backend 目錄)：
+    python benchmarks/fake_openai.py --port 8900 --chat-latency-ms 300 --token-latency-ms 5
+    OPENAI_BASE_URL=http://127.0.0.1:8900/v1 OPENAI_API_KEY=sk-fake uvicorn main:app
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import re
+import time
+import uuid
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+DEFAULT_DIM = 3072  # text-embedding-3-large 的完整維度
+
+# 延遲設定 (毫秒)，由命令列參數覆寫
+LATENCY = {
+    "embedding": 50,        # 每次 Embedding 請求的固定延遲
+    "embedding_item": 0.5,  # 每個輸入文字額外的延遲
+    "chat": 300,            # Chat 第一個 token 前的延遲
+    "token": 5,             # 每個輸出 token 的延遲
+}
+ANSWER_TOKENS = 120  # 文字回答的 token 數
+
+app = FastAPI()
+
+
+def seed_of(value) -> int:
+    return int.from_bytes(hashlib.sha256(json.dumps(value, ensure_ascii=False).encode("utf-8")).digest()[:8], "little")
+
+
+def fake_vector(value, dim: int) -> np.ndarray:
+    """
+    依輸入內容產生固定的單位向量 (輸入可以是文字或 token id 列表)
+    """
+    vec = np.random.default_rng(seed_of(value)).standard_normal(dim).astype(np.float32)
+    return vec / np.linalg.norm(vec)
+
+
+def count_input_tokens(value) -> int:
+    # LangChain 預設先以 tiktoken 切好 token 再送出；純文字時粗估
+    if isinstance(value, list):
+        return len(value)
+    return max(1, len(value.encode("utf-8")) // 3)
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body["input"]
+    if isinstance(inputs, str) or (isinstance(inputs, list) and inputs and isinstance(inputs[0], int)):
+        inputs = [inputs]
+    dim = body.get("dimensions") or DEFAULT_DIM
+    await asyncio.sleep((LATENCY["embedding"] + LATENCY["embedding_item"] * len(inputs)) / 1000)
+
+    data = []
+    for i, value in enumerate(inputs):
+        vec = fake_vector(value, dim)
+        # OpenAI SDK 預設要求 base64 (float32 little-endian)
+        embedding = base64.b64encode(vec.tobytes()).decode("ascii") if body.get("encoding_format") == "base64" else vec.tolist()
+        data.append({"object": "embedding", "index": i, "embedding": embedding})
+    tokens = sum(count_input_tokens(v) for v in inputs)
+    return {
+        "object": "list",
+        "data": data,
+        "model": body.get("model", "text-embedding-3-large"),
+        "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+    }
+
+
+def canned_reply(messages: list) -> str:
+    """
+    依 Prompt 內容決定回覆：出題 Prompt 回傳題目 JSON，評分 Prompt 回傳評分 JSON，其餘為文字回答
+    """
+    prompt = "\n".join(str(m.get("content", "")) for m in messages)
+    seed = seed_of(prompt)
+    if "question_content" in prompt:
+        files = re.findall(r"[\w./-]+\.(?:csv|geojson|shp|tif|tiff|kml|json)", prompt)
+        return json.dumps({
+            "question_content": f"### 練習題 {seed % 1000}\n請讀取資料並完成空間分析。",
+            "hint": "使用 sf::st_read() 讀取資料，再以 sf::st_buffer() 建立環域。",
+            "target_filename": files[0] if files else "None",
+        }, ensure_ascii=False)
+    if '"score"' in prompt:
+        score = 60 + seed % 41
+        return json.dumps({
+            "score": score,
+            "level": "良好" if score >= 80 else "待加強",
+            "rubric": ["觀念正確性", "操作步驟完整性"],
+            "strengths": ["說明清楚"],
+            "weaknesses": ["缺少座標系統的檢查"],
+            "missing_items": ["st_transform()"],
+            "action_items": ["複習投影轉換"],
+        }, ensure_ascii=False)
+    words = ["根據", "講義", "內容", "，", "空間", "分析", "需要", "先", "確認", "座標", "系統", "。"]
+    return "".join(words[(seed + i) % len(words)] for i in range(ANSWER_TOKENS))
+
+
+def split_tokens(text: str) -> list:
+    # 以固定長度切成「token」，讓串流的片段數與延遲可預期
+    return [text[i:i + 4] for i in range(0, len(text), 4)] or [""]
+
+
+def usage_of(messages: list, pieces: list) -> dict:
+    prompt_tokens = sum(count_input_tokens(str(m.get("content", ""))) for m in messages)
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": len(pieces), "total_tokens": prompt_tokens + len(pieces)}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages = body.get("messages", [])
+    model = body.get("model", "gpt-4o")
+    pieces = split_tokens(canned_reply(messages))
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+    created = int(time.time())
+
+    if not body.get("stream"):
+        await asyncio.sleep((LATENCY["chat"] + LATENCY["token"] * len(pieces)) / 1000)
+        return JSONResponse({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(pieces)},
+                "finish_reason": "stop",
+                "logprobs": None,
+            }],
+            "usage": usage_of(messages, pieces),
+        })
+
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+    def chunk(choices: list, usage=None) -> str:
+        payload = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                   "choices": choices}
+        if usage is not None:
+            payload["usage"] = usage
+        return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+    async def events():
+        await asyncio.sleep(LATENCY["chat"] / 1000)
+        yield chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+        for piece in pieces:
+            await asyncio.sleep(LATENCY["token"] / 1000)
+            yield chunk([{"index": 0, "delta": {"content": piece}, "finish_reason": None}])
+        yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if include_usage:
+            yield chunk([], usage_of(messages, pieces))
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機的 OpenAI API 替身")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--embedding-latency-ms", type=float, default=LATENCY["embedding"])
+    parser.add_argument("--embedding-item-latency-ms", type=float, default=LATENCY["embedding_item"])
+    parser.add_argument("--chat-latency-ms", type=float, default=LATENCY["chat"])
+    parser.add_argument("--token-latency-ms", type=float, default=LATENCY["token"])
+    args = parser.parse_args()
+    LATENCY.update({
+        "embedding": args.embedding_latency_ms,
+        "embedding_item": args.embedding_item_latency_ms,
+        "chat": args.chat_latency_ms,
+        "token": args.token_latency_ms,
+    })
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
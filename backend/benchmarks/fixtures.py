@@ -0,0 +1,159 @@
+"""
+產生負載測試用的講義包 ZIP (PDF / DOCX / Markdown 與幾個 GIS 資料檔)
+
+內容由固定亂數種子產生，同樣的參數每次得到位元組完全相同的 ZIP；
+PDF 與 DOCX 以最小結構手寫，不需額外安裝 reportlab 或 python-docx。
+
+用法 (於 backend 目錄)：
+    python benchmarks/fixtures.py --size medium --output /tmp/medium.zip
+"""
+import argparse
+import io
+import random
+import zipfile
+
+# 各語料庫大小：(文件數, 每份文件的段落數)
+CORPUS_SIZES = {
+    "small": (6, 8),
+    "medium": (30, 20),
+    "large": (120, 40),
+}
+
+# 固定的時間戳記，讓 ZIP 內容每次都相同
+FIXED_DATE = (2024, 1, 1, 0, 0, 0)
+
+EN_WORDS = (
+    "spatial analysis buffer overlay projection coordinate raster vector kriging interpolation "
+    "autocorrelation moran density kernel polygon point line network shortest path zonal statistics "
+    "clip dissolve intersect union join attribute geometry crs transform resample elevation slope "
+    "aspect hotspot cluster regression weight neighbourhood distance centroid"
+).split()
+ZH_WORDS = (
+    "空間 分析 環域 疊圖 投影 座標 網格 向量 克利金 內插 自相關 密度 核心 多邊形 點 線 路網 "
+    "最短路徑 分區統計 裁切 融合 交集 聯集 屬性 幾何 轉換 重新取樣 高程 坡度 坡向 熱點 群聚 迴歸 權重 鄰近 距離"
+).split()
+R_FUNCS = ("st_read", "st_buffer", "st_transform", "st_intersection", "st_join", "st_centroid", "terra::rast")
+
+
+def paragraph(rng: random.Random, words: tuple, n_words: int, sep: str = " ") -> str:
+    sentence = sep.join(rng.choice(words) for _ in range(n_words))
+    return f"{sentence}. Use {rng.choice(R_FUNCS)}() for this step."
+
+
+def make_pdf(pages: list) -> bytes:
+    """
+    產生只含文字的最小 PDF (每頁一段 ASCII 文字，Helvetica 字型)
+    """
+    def escape(text: str) -> str:
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines = [text[i:i + 90] for i in range(0, len(text), 90)]
+        content = "BT /F1 10 Tf 14 TL 50 760 Td " + " ".join(f"({escape(line)}) '" for line in lines) + " ET"
+        stream = content.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        kids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % k for k in kids), len(kids))
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % i + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+def make_docx(paragraphs: list) -> bytes:
+    """
+    產生最小的 DOCX (只有 document.xml，docx2txt 即可讀取)
+    """
+    def escape(text: str) -> str:
+        return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+
+    body = "".join(f"<w:p><w:r><w:t>{escape(p)}</w:t></w:r></w:p>" for p in paragraphs)
+    members = {
+        "[Content_Types].xml": (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>'
+        ),
+        "_rels/.rels": (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="word/document.xml"/></Relationships>'
+        ),
+        "word/document.xml": (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f'<w:body>{body}</w:body></w:document>'
+        ),
+    }
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, text in members.items():
+            zf.writestr(zipfile.ZipInfo(name, FIXED_DATE), text)
+    return out.getvalue()
+
+
+def make_corpus_zip(size: str = "small", seed: int = 0) -> bytes:
+    """
+    產生講義包 ZIP：文件依序輪流為 PDF (英文)、DOCX 與 Markdown (中英混合)，另附 GIS 資料檔
+    """
+    n_docs, n_paragraphs = CORPUS_SIZES[size]
+    rng = random.Random(f"{size}:{seed}")
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        def add(name: str, data):
+            zf.writestr(zipfile.ZipInfo(name, FIXED_DATE), data, compress_type=zipfile.ZIP_DEFLATED)
+
+        for i in range(n_docs):
+            kind = ("pdf", "docx", "md")[i % 3]
+            if kind == "pdf":
+                pages = [paragraph(rng, EN_WORDS, rng.randint(60, 120)) for _ in range(n_paragraphs)]
+                add(f"lectures/week{i:03d}.pdf", make_pdf(pages))
+            elif kind == "docx":
+                paras = [paragraph(rng, ZH_WORDS + EN_WORDS, rng.randint(60, 120)) for _ in range(n_paragraphs)]
+                add(f"handouts/unit{i:03d}.docx", make_docx(paras))
+            else:
+                sections = [f"## 第 {j + 1} 節\n\n{paragraph(rng, ZH_WORDS, rng.randint(60, 120), sep='')}"
+                            for j in range(n_paragraphs)]
+                add(f"notes/topic{i:03d}.md", f"# 主題 {i}\n\n" + "\n\n".join(sections))
+
+        # GIS 資料檔 (出題時列給模型選擇)
+        rows = "\n".join(f"S{j:03d},{121 + rng.random():.5f},{25 + rng.random():.5f}" for j in range(50))
+        add("data/stations.csv", "id,lon,lat\n" + rows)
+        add("data/districts.geojson", '{"type": "FeatureCollection", "features": []}')
+    return out.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="產生負載測試用的講義包 ZIP")
+    parser.add_argument("--size", choices=sorted(CORPUS_SIZES), default="small")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+    data = make_corpus_zip(args.size, args.seed)
+    with open(args.output, "wb") as f:
+        f.write(data)
+    print(f"已產生 {args.output} ({len(data) / 1024:.0f} KB)")
+
+
+if __name__ == "__main__":
+    main()
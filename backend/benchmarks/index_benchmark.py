@@ -0,0 +1,107 @@
+"""
+向量索引類型的召回率 / 延遲比較 (以 flat 完整維度的結果為標準答案)
+
+使用固定亂數種子產生的合成語料庫，不需呼叫 OpenAI API：
+- 向量以群集方式產生 (模擬同一份講義中主題相近的 Chunk)
+- 各維度的變異數遞減，模擬 text-embedding-3 前面維度資訊較多、可直接截斷縮減維度的特性
+
+用法 (於 backend 目錄)：
+    python benchmarks/index_benchmark.py --chunks 5000 --queries 200 --k 5
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import faiss
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from main import EMBEDDING_DIM, INDEX_TYPES, MmapFlatIndex, build_faiss_index  # noqa: E402
+
+
+def make_fixture(n_chunks: int, n_queries: int, dim: int, seed: int = 42):
+    """
+    產生固定的合成語料庫與查詢 (同樣的參數每次結果都相同)
+    """
+    rng = np.random.default_rng(seed)
+    n_topics = max(8, n_chunks // 50)
+    scale = (1.0 / np.sqrt(1.0 + np.arange(dim) / 64.0)).astype(np.float32)
+    centers = rng.standard_normal((n_topics, dim)).astype(np.float32) * scale
+    topics = rng.integers(0, n_topics, n_chunks)
+    corpus = centers[topics] + 0.6 * rng.standard_normal((n_chunks, dim)).astype(np.float32) * scale
+    query_topics = rng.integers(0, n_topics, n_queries)
+    queries = centers[query_topics] + 0.8 * rng.standard_normal((n_queries, dim)).astype(np.float32) * scale
+    return normalize(corpus), normalize(queries)
+
+
+def normalize(x: np.ndarray) -> np.ndarray:
+    return (x / np.linalg.norm(x, axis=1, keepdims=True)).astype(np.float32)
+
+
+def truncate(x: np.ndarray, dims: int) -> np.ndarray:
+    # 與 OpenAI 的 dimensions 參數相同：取前 dims 維再重新正規化
+    return normalize(x[:, :dims])
+
+
+def build(index_type: str, corpus: np.ndarray):
+    """
+    建立與伺服器相同的索引，回傳 (可搜尋的索引, 每個向量佔用的 bytes)
+    flat / flat_f16 使用 mmap 格式的 NumPy 搜尋，其餘使用 FAISS 索引
+    """
+    if index_type == "flat":
+        return MmapFlatIndex(corpus), corpus.shape[1] * 4
+    if index_type == "flat_f16":
+        return MmapFlatIndex(corpus.astype(np.float16)), corpus.shape[1] * 2
+    index, _ = build_faiss_index(corpus, index_type)
+    return index, len(faiss.serialize_index(index)) / len(corpus)
+
+
+def run(index, queries: np.ndarray, k: int):
+    """
+    逐一查詢 (與線上請求相同，一次一個問題)，回傳 (結果 id, 每次查詢的毫秒數)
+    """
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    latencies = []
+    for i, q in enumerate(queries):
+        start = time.perf_counter()
+        _, labels = index.search(q[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        ids[i] = labels[0]
+    return ids, np.array(latencies)
+
+
+def recall(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=5000, help="語料庫的 Chunk 數")
+    parser.add_argument("--queries", type=int, default=200, help="查詢數")
+    parser.add_argument("--k", type=int, default=5, help="每次檢索的段落數 (與 API 相同預設 5)")
+    parser.add_argument("--dims", default=f"{EMBEDDING_DIM},1024,256", help="要比較的維度 (逗號分隔)")
+    parser.add_argument("--types", default=",".join(INDEX_TYPES), help="要比較的索引類型 (逗號分隔)")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    corpus, queries = make_fixture(args.chunks, args.queries, EMBEDDING_DIM, args.seed)
+    truth, _ = run(MmapFlatIndex(corpus), queries, args.k)  # 標準答案：完整維度的精確搜尋
+
+    print(f"chunks={args.chunks} queries={args.queries} k={args.k} seed={args.seed}")
+    print(f"{'type':<10}{'dims':>6}{'recall@k':>10}{'p50 ms':>9}{'p95 ms':>9}{'bytes/vec':>11}{'build s':>9}")
+    for dims in [int(d) for d in args.dims.split(",")]:
+        c, q = (corpus, queries) if dims == EMBEDDING_DIM else (truncate(corpus, dims), truncate(queries, dims))
+        for index_type in args.types.split(","):
+            start = time.perf_counter()
+            index, bytes_per_vector = build(index_type, c)
+            build_seconds = time.perf_counter() - start
+            found, latencies = run(index, q, args.k)
+            print(f"{index_type:<10}{dims:>6}{recall(found, truth):>10.3f}"
+                  f"{np.percentile(latencies, 50):>9.2f}{np.percentile(latencies, 95):>9.2f}"
+                  f"{bytes_per_vector:>11.0f}{build_seconds:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
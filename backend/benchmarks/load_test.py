@@ -0,0 +1,301 @@
+"""
+端對端負載測試：以本機的 OpenAI 替身 (fake_openai.py) 取代真正的 API，不花費 API 費用也不受網路影響
+
+流程：
+1. 在暫存目錄啟動 fake_openai.py 與伺服器 (uvicorn main:app，使用全新的快取目錄)
+2. 以 fixtures.py 產生各種大小的講義包 ZIP
+3. 依 (端點, 語料庫大小, 並行數) 逐一送出請求，記錄吞吐量、p50/p95/p99 延遲與伺服器的最高 RSS
+4. 可將結果存成 JSON，下一版再以 --baseline 比較，退步超過門檻時回傳非 0 (方便放進 CI)
+
+問答/評分的輸入預設每個請求都不同 (避開檢索與評分快取)；加上 --repeat-inputs 可測量快取命中的路徑。
+每個情境開始前先送 --warmup 個請求 (例如讓上傳的語料庫進入索引快取)，不計入結果。
+
+用法 (於 backend 目錄)：
+    python benchmarks/load_test.py --sizes small,medium --concurrency 1,4,16 --requests 32 --output before.json
+    python benchmarks/load_test.py --sizes small,medium --concurrency 1,4,16 --requests 32 --baseline before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from fixtures import CORPUS_SIZES, make_corpus_zip  # noqa: E402
+
+ENDPOINTS = ("process_zip", "ask_with_zip", "generate_question", "grade_submission")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_ready(url: str, proc: subprocess.Popen, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"{url} 的行程啟動失敗 (exit code {proc.returncode})")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"等待 {url} 啟動逾時")
+
+
+def process_rss(pid: int) -> int:
+    """
+    回傳行程 (含子行程，例如讀檔用的行程池) 目前的 RSS bytes；非 Linux 時回傳 0
+    """
+    total = 0
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1]) * 1024
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            for child in f.read().split():
+                total += process_rss(int(child))
+    except (OSError, ValueError):
+        pass
+    return total
+
+
+class RssSampler:
+    """
+    在背景定期取樣伺服器的 RSS，記錄情境期間的最高值
+    """
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, process_rss(self.pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_rss(self.pid))
+
+
+def build_request(endpoint: str, corpus: bytes, i: int, repeat: bool):
+    """
+    回傳 (路徑, 表單欄位, 檔案欄位)；repeat=False 時每個請求的問題/答案都不同
+    """
+    suffix = "" if repeat else f" (#{i})"
+    files = {"file": ("corpus.zip", corpus, "application/zip")}
+    if endpoint == "process_zip":
+        return "/process_zip", {}, files
+    if endpoint == "ask_with_zip":
+        return "/ask_with_zip", {"question": f"如何建立環域並計算重疊面積？{suffix}"}, files
+    if endpoint == "generate_question":
+        # 出題的檢索查詢只由題型與難度決定，以難度欄位區分不同請求
+        return "/api/generate_question", {"qtype": "R 語言實作題", "level": f"中級{suffix}"}, files
+    return "/api/grade_submission", {
+        "qtype": "觀念簡答題",
+        "question_text": "請說明環域分析的用途。",
+        "student_answer": f"環域分析可找出距離某地物一定範圍內的區域。{suffix}",
+    }, files
+
+
+async def run_scenario(base_url: str, endpoint: str, corpus: bytes, concurrency: int, total: int,
+                       warmup: int, repeat: bool) -> dict:
+    latencies, errors = [], 0
+    counter = iter(range(total))
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=httpx.Timeout(600)) as client:
+        async def send(i: int) -> float:
+            path, data, files = build_request(endpoint, corpus, i, repeat)
+            start = time.perf_counter()
+            response = await client.post(path, data=data, files=files)
+            await response.aread()  # 串流回傳的 ZIP 也要讀完才算完成
+            response.raise_for_status()
+            return time.perf_counter() - start
+
+        for i in range(warmup):
+            await send(-1 - i)
+
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                try:
+                    latencies.append(await send(i))
+                except httpx.HTTPError:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+
+    def pct(p: float):
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 1)
+
+    return {
+        "requests": total,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 3) if elapsed else 0.0,
+        "p50_ms": pct(50),
+        "p95_ms": pct(95),
+        "p99_ms": pct(99),
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: list, baseline: list, threshold: float) -> list:
+    """
+    與前一版的結果比較，回傳退步的項目說明 (p95 延遲、吞吐量或最高 RSS 變差超過門檻)
+    """
+    previous = {(r["endpoint"], r["size"], r["concurrency"]): r for r in baseline}
+    regressions = []
+    for r in results:
+        old = previous.get((r["endpoint"], r["size"], r["concurrency"]))
+        if old is None:
+            continue
+        name = f'{r["endpoint"]}/{r["size"]}/c{r["concurrency"]}'
+        if old.get("p95_ms") and r.get("p95_ms") and r["p95_ms"] > old["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {old['p95_ms']} -> {r['p95_ms']} ms")
+        if old.get("throughput_rps") and r["throughput_rps"] < old["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{name}: throughput {old['throughput_rps']} -> {r['throughput_rps']} req/s")
+        if old.get("peak_rss_mb") and r["peak_rss_mb"] > old["peak_rss_mb"] * (1 + threshold):
+            regressions.append(f"{name}: peak RSS {old['peak_rss_mb']} -> {r['peak_rss_mb']} MB")
+    return regressions
+
+
+def print_table(results: list):
+    header = f'{"endpoint":<18}{"size":<8}{"conc":>5}{"ok":>6}{"err":>5}{"req/s":>9}{"p50":>9}{"p95":>9}{"p99":>9}{"RSS MB":>9}'
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f'{r["endpoint"]:<18}{r["size"]:<8}{r["concurrency"]:>5}{r["requests"] - r["errors"]:>6}{r["errors"]:>5}'
+              f'{r["throughput_rps"]:>9}{str(r["p50_ms"]):>9}{str(r["p95_ms"]):>9}{str(r["p99_ms"]):>9}'
+              f'{r["peak_rss_mb"]:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以本機 OpenAI 替身進行端對端負載測試")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="要測試的端點，以逗號分隔")
+    parser.add_argument("--sizes", default="small", help=f"語料庫大小 ({', '.join(CORPUS_SIZES)})，以逗號分隔")
+    parser.add_argument("--concurrency", default="1,4,16", help="並行數，以逗號分隔")
+    parser.add_argument("--requests", type=int, default=32, help="每個情境的請求數")
+    parser.add_argument("--warmup", type=int, default=1, help="每個情境開始前不計入結果的請求數")
+    parser.add_argument("--repeat-inputs", action="store_true", help="每個請求使用相同的問題/答案 (測量快取命中)")
+    parser.add_argument("--chat-latency-ms", type=float, default=300)
+    parser.add_argument("--token-latency-ms", type=float, default=5)
+    parser.add_argument("--embedding-latency-ms", type=float, default=50)
+    parser.add_argument("--server-env", action="append", default=[], help="額外傳給伺服器的環境變數 KEY=VALUE")
+    parser.add_argument("--output", help="將結果存成 JSON")
+    parser.add_argument("--baseline", help="與前一版的結果 JSON 比較")
+    parser.add_argument("--threshold", type=float, default=0.10, help="視為退步的變化比例 (預設 10%%)")
+    args = parser.parse_args()
+
+    endpoints = [e for e in args.endpoints.split(",") if e]
+    sizes = [s for s in args.sizes.split(",") if s]
+    levels = [int(c) for c in args.concurrency.split(",") if c]
+    unknown = [e for e in endpoints if e not in ENDPOINTS] + [s for s in sizes if s not in CORPUS_SIZES]
+    if unknown:
+        parser.error(f"未知的端點或語料庫大小: {', '.join(unknown)}")
+
+    workdir = tempfile.mkdtemp(prefix="rag-load-")
+    fake_port, server_port = free_port(), free_port()
+    fake_cmd = [sys.executable, os.path.join(BENCH_DIR, "fake_openai.py"), "--port", str(fake_port),
+                "--chat-latency-ms", str(args.chat_latency_ms), "--token-latency-ms", str(args.token_latency_ms),
+                "--embedding-latency-ms", str(args.embedding_latency_ms)]
+    server_env = dict(os.environ)
+    server_env.update({
+        "OPENAI_API_KEY": "sk-fake",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{fake_port}/v1",
+        "RAG_CACHE_DIR": os.path.join(workdir, "cache"),  # 全新的快取，避免受之前的執行影響
+        "QUESTION_POOL_SIZE": "0",                         # 背景補題會與測試請求搶 llm 名額
+    })
+    for item in args.server_env:
+        key, _, value = item.partition("=")
+        server_env[key] = value
+    server_cmd = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+                  "--port", str(server_port), "--log-level", "warning"]
+
+    print(f"工作目錄: {workdir} (伺服器日誌: server.log)")
+    with open(os.path.join(workdir, "fake_openai.log"), "w") as fake_log, \
+            open(os.path.join(workdir, "server.log"), "w") as server_log:
+        fake = subprocess.Popen(fake_cmd, stdout=fake_log, stderr=subprocess.STDOUT)
+        server = subprocess.Popen(server_cmd, cwd=workdir, env=server_env, stdout=server_log, stderr=subprocess.STDOUT)
+        try:
+            wait_ready(f"http://127.0.0.1:{fake_port}/docs", fake)
+            wait_ready(f"http://127.0.0.1:{server_port}/", server)
+            results = []
+            for size in sizes:
+                corpus = make_corpus_zip(size)
+                for endpoint in endpoints:
+                    for concurrency in levels:
+                        with RssSampler(server.pid) as rss:
+                            stats = asyncio.run(run_scenario(
+                                f"http://127.0.0.1:{server_port}", endpoint, corpus, concurrency,
+                                args.requests, args.warmup, args.repeat_inputs,
+                            ))
+                        stats.update({"endpoint": endpoint, "size": size, "concurrency": concurrency,
+                                      "peak_rss_mb": round(rss.peak / (1024 * 1024), 1)})
+                        results.append(stats)
+                        print(f"完成 {endpoint} / {size} / 並行 {concurrency}: "
+                              f"{stats['throughput_rps']} req/s, p95 {stats['p95_ms']} ms")
+        finally:
+            for proc in (server, fake):
+                proc.terminate()
+                try:
+                    proc.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+    print()
+    print_table(results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"revision": git_revision(), "created_at": time.time(), "args": vars(args), "results": results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\n結果已存到 {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.threshold)
+        print(f"\n與 {args.baseline} (revision {baseline.get('revision', '?')}) 比較：")
+        for line in regressions:
+            print(f"  ⚠️ {line}")
+        if regressions:
+            sys.exit(1)
+        print("  沒有超過門檻的退步")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+冷啟動檢查：匯入 main 的時間、匯入時是否誤載入重量級套件，以及 uvicorn 啟動到 /healthz 可回應的時間
+
+任一項超過預算時回傳非 0 (方便放進 CI，避免有人又在模組層級匯入 LangChain 等套件)：
+- python -X importtime 量測 `import main` 的累計時間 (取多次中位數)
+- 匯入後 sys.modules 中不應出現延遲載入的套件 (見 main.HEAVY_IMPORTS)
+- 啟動 uvicorn main:app，量測到 /healthz 回傳 200 的時間；/readyz 的暖機時間只列出，不計入預算
+
+用法 (於 backend 目錄)：
+    python benchmarks/startup_check.py --import-budget-ms 1500 --serve-budget-ms 3000
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from load_test import free_port  # noqa: E402
+
+# 冷啟動時不應被匯入的套件 (與 main.HEAVY_IMPORTS 對應；在子行程中檢查，本行程不匯入 main)
+LAZY_MODULES = ("numpy", "faiss", "openai", "tiktoken", "pypdf", "docx2txt", "bs4",
+                "langchain_core", "langchain_openai", "langchain_community", "langchain_text_splitters")
+
+PROBE = """
+import json, sys
+import main
+print(json.dumps(sorted(m for m in {modules!r} if m in sys.modules)))
+"""
+
+
+def clean_env(workdir: str) -> dict:
+    env = dict(os.environ)
+    env.pop("OPENAI_API_KEY", None)  # 不建立 OpenAI 客戶端，只量測匯入本身
+    env.update({
+        "PYTHONPATH": BACKEND_DIR,
+        "RAG_CACHE_DIR": os.path.join(workdir, "cache"),
+        "QUESTION_POOL_SIZE": "0",
+        "DEFAULT_RAG_ZIP": os.path.join(workdir, "missing.zip"),
+    })
+    return env
+
+
+def import_time_ms(workdir: str) -> float:
+    """
+    以 -X importtime 量測 `import main` 的累計時間 (毫秒)
+    """
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=workdir,
+                          env=clean_env(workdir), capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import main 失敗:\n{proc.stderr[-2000:]}")
+    for line in proc.stderr.splitlines():
+        # 格式：import time: self [us] | cumulative | imported package
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == "main":
+            return int(parts[1]) / 1000
+    raise RuntimeError("importtime 輸出中找不到 main")
+
+
+def eager_modules(workdir: str) -> list:
+    """
+    回傳匯入 main 後已經出現在 sys.modules 的延遲載入套件
+    """
+    proc = subprocess.run([sys.executable, "-c", PROBE.format(modules=LAZY_MODULES)], cwd=workdir,
+                          env=clean_env(workdir), capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def serve_times(workdir: str, timeout: float = 120) -> tuple:
+    """
+    啟動 uvicorn，回傳 (到 /healthz 回應 200 的秒數, 到 /readyz 回應 200 的秒數或 None)
+    """
+    port = free_port()
+    cmd = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+           "--port", str(port), "--log-level", "warning"]
+    base = f"http://127.0.0.1:{port}"
+    with open(os.path.join(workdir, "server.log"), "w") as log:
+        start = time.perf_counter()
+        server = subprocess.Popen(cmd, cwd=workdir, env=clean_env(workdir), stdout=log, stderr=subprocess.STDOUT)
+        try:
+            live = ready = None
+            while time.perf_counter() - start < timeout and ready is None:
+                if server.poll() is not None:
+                    raise RuntimeError(f"伺服器啟動失敗 (exit code {server.returncode})，見 {workdir}/server.log")
+                try:
+                    if live is None and httpx.get(f"{base}/healthz", timeout=1).status_code == 200:
+                        live = time.perf_counter() - start
+                    if live is not None and httpx.get(f"{base}/readyz", timeout=1).status_code == 200:
+                        ready = time.perf_counter() - start
+                except httpx.HTTPError:
+                    pass
+                time.sleep(0.02)
+            if live is None:
+                raise RuntimeError("等待 /healthz 逾時")
+            return live, ready
+        finally:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="檢查冷啟動時間是否超過預算")
+    parser.add_argument("--runs", type=int, default=3, help="量測次數 (取中位數)")
+    parser.add_argument("--import-budget-ms", type=float, default=1500, help="import main 的時間預算")
+    parser.add_argument("--serve-budget-ms", type=float, default=3000, help="啟動到 /healthz 可回應的時間預算")
+    parser.add_argument("--skip-serve", action="store_true", help="只檢查匯入，不啟動 uvicorn")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="rag-startup-")
+    failures = []
+
+    eager = eager_modules(workdir)
+    print(f"匯入時載入的重量級套件: {', '.join(eager) if eager else '(無)'}")
+    if eager:
+        failures.append(f"import main 不應匯入: {', '.join(eager)}")
+
+    imports = [import_time_ms(workdir) for _ in range(args.runs)]
+    import_ms = statistics.median(imports)
+    print(f"import main: {import_ms:.0f} ms (中位數，{args.runs} 次: {', '.join(f'{t:.0f}' for t in imports)})")
+    if import_ms > args.import_budget_ms:
+        failures.append(f"import main {import_ms:.0f} ms > 預算 {args.import_budget_ms:.0f} ms")
+
+    if not args.skip_serve:
+        runs = [serve_times(workdir) for _ in range(args.runs)]
+        live_ms = statistics.median(live for live, _ in runs) * 1000
+        ready = [r for _, r in runs if r is not None]
+        print(f"/healthz 可回應: {live_ms:.0f} ms (中位數)")
+        print(f"/readyz 就緒: {statistics.median(ready) * 1000:.0f} ms (中位數，僅供參考)" if ready
+              else "/readyz 在逾時前未就緒 (僅供參考)")
+        if live_ms > args.serve_budget_ms:
+            failures.append(f"/healthz {live_ms:.0f} ms > 預算 {args.serve_budget_ms:.0f} ms")
+
+    for line in failures:
+        print(f"  ⚠️ {line}")
+    if failures:
+        sys.exit(1)
+    print("  冷啟動在預算內")
+
+
+if __name__ == "__main__":
+    main()
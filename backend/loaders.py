@@ -0,0 +1,85 @@
+"""
+文件解析 (PDF / Word / 純文字 / HTML) 與讀檔行程的進入點
+
+main.py 的 LoaderPool 以 forkserver/spawn 建立讀檔行程，子行程只會匯入這個模組，
+不會重新匯入 main (不會開啟 SQLite 快取、建立資料夾或 FastAPI 應用程式)
+解析套件在第一次讀檔時才匯入，main 匯入本模組不會拖慢冷啟動
+"""
+import io
+import os
+from typing import List
+
+
+# --- [修改] 輔助函數：解碼純文字檔 ---
+def read_text(data: bytes, encoding: str) -> str:
+    """
+    以文字模式讀取 (與 open() 相同：嚴格解碼並轉換換行字元)，無法以此編碼解碼時拋出 UnicodeDecodeError
+    """
+    return io.TextIOWrapper(io.BytesIO(data), encoding=encoding).read()
+
+
+def decode_text(data: bytes) -> str:
+    """
+    與 TextLoader(encoding="utf-8", autodetect_encoding=True) 相同：先以 UTF-8 解碼，
+    失敗時依偵測到的候選編碼 (charset_normalizer，依信心排序) 逐一嘗試
+    全部失敗時拋出 ValueError，不會默默以 latin-1 解出亂碼
+    """
+    try:
+        return read_text(data, "utf-8")
+    except UnicodeDecodeError:
+        pass
+    from charset_normalizer import from_bytes
+    for match in from_bytes(data):
+        try:
+            return read_text(data, match.encoding)
+        except (UnicodeDecodeError, LookupError):
+            continue
+    raise ValueError("無法偵測文字編碼")
+
+
+# --- [修改] 讀取單一檔案 (直接處理記憶體中的內容) ---
+def parse_file(filename: str, data: bytes) -> List:
+    """
+    根據檔案的副檔名，選擇對應的解析方式讀取記憶體中的檔案內容
+    回傳一個 Document 物件列表 (格式與原本的 LangChain Loader 相同)；檔案損毀時拋出例外
+    """
+    from langchain_core.documents import Document
+
+    # 取得檔案副檔名並轉為小寫，方便判斷
+    ext = os.path.splitext(filename)[1].lower()
+    # 判斷是否為 PDF：直接使用 PyPDFLoader 內部的解析器，每一頁一個 Document 並記錄頁碼
+    if ext == ".pdf":
+        from langchain_community.document_loaders.blob_loaders import Blob
+        from langchain_community.document_loaders.parsers.pdf import PyPDFParser
+        return list(PyPDFParser().lazy_parse(Blob.from_data(data, path=filename)))
+    # 判斷是否為 Word 檔 (.docx)
+    elif ext == ".docx":
+        import docx2txt
+        return [Document(page_content=docx2txt.process(io.BytesIO(data)), metadata={"source": filename})]
+    # 判斷是否為程式碼或純文字檔 (增加支援 R, Rmd, Py, Md, Txt)
+    elif ext in [".txt", ".md", ".r", ".rmd", ".py"]:
+        return [Document(page_content=decode_text(data), metadata={"source": filename})]
+    # 判斷是否為網頁檔
+    elif ext in [".html", ".htm"]:
+        # 使用 BeautifulSoup 解析 HTML 結構，只保留文字與標題 (與 BSHTMLLoader 相同)
+        from bs4 import BeautifulSoup
+        soup = BeautifulSoup(decode_text(data), "html.parser")
+        title = str(soup.title.string) if soup.title else ""
+        return [Document(page_content=soup.get_text(""), metadata={"source": filename, "title": title})]
+    # 如果是不支援的格式 (如 jpg, xlsx)，回傳空列表，程式會自動略過
+    return []
+
+
+def loader_worker_main(conn):
+    """
+    讀檔行程的主迴圈：逐一接收 (檔名, 內容)，回傳 ("ok", Document 列表) 或 ("error", 錯誤訊息)
+    """
+    while True:
+        try:
+            name, data = conn.recv()
+        except (EOFError, OSError):
+            return  # 主行程關閉連線，結束
+        try:
+            conn.send(("ok", parse_file(name, data)))
+        except Exception as e:
+            conn.send(("error", str(e)))
@@ -1,39 +1,129 @@
+from __future__ import annotations  # [新增] 型別註記不在匯入時求值，延遲載入的套件只在實際使用時才匯入
 import os  # 匯入作業系統模組，用於處理檔案路徑、讀取環境變數等
 import shutil  # 匯入高階檔案操作模組，用於複製、移動或刪除檔案與目錄
 import zipfile  # 匯入 ZIP 壓縮檔處理模組，用於解壓縮與壓縮檔案
 import uuid  # 匯入 UUID 模組，用於產生唯一識別碼 (Task ID)，避免多人使用時檔名衝突
 import json  # [新增] 匯入 JSON 模組，用於解析 OpenAI 回傳的 JSON 字串
-from typing import List, Optional  # [修改] 匯入 Optional 用於標記可選參數
+import hashlib  # [新增] 匯入雜湊模組，用於計算上傳 ZIP 的 SHA-256 內容指紋
+import threading  # [新增] 匯入執行緒模組，用於保護快取的共用狀態
+import time  # [新增] 匯入時間模組，用於定期檢查預設語料庫是否變更
+import sqlite3  # [新增] 匯入 SQLite，用於在硬碟上持久保存 Chunk 的 Embedding 向量
+import multiprocessing  # [新增] 匯入多行程模組，用於平行讀取 PDF/Word 等 CPU 密集的文件
+from multiprocessing import connection as mp_connection  # [新增] 同時等待多個讀檔行程的結果
+import queue  # [新增] 閒置讀檔行程的佇列
+from loaders import decode_text, parse_file, loader_worker_main  # [新增] 文件解析與讀檔行程的進入點 (子行程不需匯入 main)
+import io  # [新增] 匯入 io 模組，用 BytesIO 讓讀取器直接處理記憶體中的 ZIP 成員
+import pickle  # [新增] 用於直接從 ZIP 成員還原 FAISS 的 docstore (index.pkl)
+import struct  # [新增] 用於解析 ZIP 成員的 local header，計算資料在檔案中的位移 (memory-map 用)
+import asyncio  # [新增] 匯入 asyncio，讓阻塞的工作在執行緒池中執行，不卡住事件迴圈
+import contextvars  # [新增] 讓執行緒池中的工作沿用請求的 context
+import functools  # [新增] 用於包裝要丟到執行緒池的函數與參數
+import contextlib  # [新增] 用於撰寫取得/釋放執行名額的 context manager
+import csv  # [新增] 用於解析批次評分上傳的 CSV 學生答案
+import random  # [新增] Embedding 批次重試時的退避抖動
+import zlib  # [新增] 以 CRC32 快速雜湊字元 n-gram (MinHash 近似重複偵測)
+from concurrent.futures import ThreadPoolExecutor, as_completed  # [新增] 有上限的執行緒池；依完成順序取得批次結果
+from collections import OrderedDict, deque  # [新增] 有序字典用於實作 LRU 淘汰；deque 用於題庫佇列
+from collections.abc import Mapping  # [新增] 用於實作唯讀的 index -> docstore id 對照表
+from typing import Callable, Dict, List, Optional  # [修改] 匯入 Optional 用於標記可選參數
+import importlib  # [新增] 用於延遲載入重量級套件
 
 # 匯入 FastAPI 相關元件
 from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, HTTPException  # [新增] HTTPException 用於錯誤處理
-from fastapi.responses import FileResponse, JSONResponse  # 匯入回應類別，分別用於回傳檔案與 JSON 資料
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse  # 匯入回應類別，分別用於回傳 JSON 資料、純文字 (/metrics) 與串流 (SSE、索引 Zip)
 from fastapi.middleware.cors import CORSMiddleware  # 匯入 CORS (跨來源資源共享) 中介軟體，解決跨網域請求問題
+from starlette.routing import Match  # [新增] 用於找出請求對應的路由樣板 (指標的 endpoint 標籤)
 from pydantic import BaseModel # [新增] 用於定義資料模型
 
+# --- [新增] 延遲載入的重量級套件 ---
+# LangChain、FAISS、OpenAI SDK 等套件匯入需要數秒，冷啟動時不匯入：
+# 第一次使用時才載入，伺服器啟動後也會由背景暖機執行緒 (WarmUp) 預先載入
+class LazyImport:
+    """
+    代理尚未匯入的模組 (或模組中的屬性)，第一次取用屬性、呼叫或 isinstance 檢查時才真正匯入
+    """
+    def __init__(self, module: str, attr: Optional[str] = None):
+        self._module = module
+        self._attr = attr
+        self._target = None
+        self._lock = threading.Lock()
+        self._hooks: List[Callable] = []  # 匯入完成後要執行的函數 (例如註冊虛擬子類別)
+
+    @property
+    def name(self) -> str:
+        return f"{self._module}.{self._attr}" if self._attr else self._module
+
+    def load(self):
+        if self._target is None:
+            with self._lock:
+                if self._target is None:
+                    target = importlib.import_module(self._module)
+                    target = getattr(target, self._attr) if self._attr else target
+                    for hook in self._hooks:
+                        hook(target)
+                    self._target = target
+        return self._target
+
+    def on_load(self, hook: Callable):
+        """
+        登記匯入完成後要執行的函數 (以匯入的物件呼叫)；已匯入時立即執行
+        """
+        with self._lock:
+            if self._target is None:
+                self._hooks.append(hook)
+                return
+        hook(self._target)
+
+    @property
+    def loaded(self) -> bool:
+        return self._target is not None
+
+    def __getattr__(self, item):
+        if item in ("_module", "_attr", "_target", "_lock", "_hooks"):
+            raise AttributeError(item)  # 尚未初始化 (例如 copy 建立的新物件)，避免無限遞迴
+        return getattr(self.load(), item)
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __instancecheck__(self, obj) -> bool:
+        return isinstance(obj, self.load())
+
+    def __repr__(self) -> str:
+        return f"<LazyImport {self.name} ({'loaded' if self.loaded else 'not loaded'})>"
+
 # --- [新增] OpenAI 原生客戶端 ---
-from openai import OpenAI  # 用於直接呼叫 GPT-4o 模型 API
+openai = LazyImport("openai")  # 可重試的 API 錯誤類別 (RateLimitError 等)
+OpenAI = LazyImport("openai", "OpenAI")  # 用於直接呼叫 GPT-4o 模型 API
+import httpx  # [新增] OpenAI SDK 底層的 HTTP 客戶端，用於設定共用的 keep-alive 連線池 (連線池類別需要繼承，直接匯入)
+tiktoken = LazyImport("tiktoken")  # [新增] 計算送去 Embedding API 的 token 數 (用量指標)
+
+# --- [修改] 文件解析套件 (直接解析記憶體中的檔案內容，不需先解壓縮到硬碟) ---
+PdfReader = LazyImport("pypdf", "PdfReader")  # 用於讀取 PDF 檔案
+docx2txt = LazyImport("docx2txt")  # 用於讀取 Word (.docx) 檔案
+BeautifulSoup = LazyImport("bs4", "BeautifulSoup")  # 用於讀取 HTML 網頁檔案
+# 匯入 FAISS 原生套件，用於從位元組直接還原 index.faiss
+faiss = LazyImport("faiss")
 
 # --- LangChain & OpenAI 相關套件 ---
-# 從 LangChain 社群套件匯入各種文件讀取器
-from langchain_community.document_loaders import (
-    PyPDFLoader,    # 用於讀取 PDF 檔案
-    Docx2txtLoader, # 用於讀取 Word (.docx) 檔案
-    TextLoader,     # 用於讀取純文字檔案 (.txt, .md, .py 等)
-    BSHTMLLoader    # 用於讀取 HTML 網頁檔案
-)
 # 匯入文字切分器，用於將長文件切成小塊，這是 RAG 的關鍵步驟
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-# 匯入 OpenAI 的 Embeddings (向量化工具) 與 ChatOpenAI (聊天模型)
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+RecursiveCharacterTextSplitter = LazyImport("langchain_text_splitters", "RecursiveCharacterTextSplitter")
+# 匯入 OpenAI 的 Embeddings (向量化工具)
+OpenAIEmbeddings = LazyImport("langchain_openai", "OpenAIEmbeddings")
 # 匯入 FAISS 向量資料庫，用於儲存與搜尋向量 (這是我們 RAG Zip 的核心格式)
-from langchain_community.vectorstores import FAISS
+FAISS = LazyImport("langchain_community.vectorstores", "FAISS")
 # 匯入 LangChain 的基礎文件物件結構
-from langchain_core.documents import Document
-# 匯入檢索問答鏈 (RetrievalQA)，這是串接檢索與生成的標準流程
-from langchain.chains import RetrievalQA
-# 匯入提示模板 (PromptTemplate)，用於自訂 AI 的角色與指令
-from langchain.prompts import PromptTemplate
+Document = LazyImport("langchain_core.documents", "Document")
+# [新增] 匯入 Embeddings 介面，用於包裝帶有持久快取的 Embedding 模型
+Embeddings = LazyImport("langchain_core.embeddings", "Embeddings")
+# [新增] 匯入 NumPy，用於將向量轉為 float32 二進位存入快取 (faiss-cpu 已依賴此套件)
+np = LazyImport("numpy")
+# [新增] 解析尚未完整的 JSON 字串，用於串流出題時回傳部分結果
+parse_partial_json = LazyImport("langchain_core.utils.json", "parse_partial_json")
+
+# 背景暖機時依序預先載入 (最常用、最慢的放前面)
+HEAVY_IMPORTS = (np, faiss, Document, Embeddings, RecursiveCharacterTextSplitter, OpenAI, openai, tiktoken,
+                 OpenAIEmbeddings, FAISS, parse_partial_json, PdfReader, docx2txt, BeautifulSoup)
 
 # 初始化 FastAPI 應用程式實例
 app = FastAPI()
@@ -45,20 +135,19 @@ app.add_middleware(
     allow_origins=["*"],  # 允許所有來源的網域存取 (生產環境建議設定特定網域以策安全)
     allow_methods=["*"],  # 允許所有 HTTP 方法 (如 GET, POST 等)
     allow_headers=["*"],  # 允許所有 HTTP 標頭
+    expose_headers=["*"],  # [新增] 讓前端可以讀取自訂的統計 Header (例如 X-Embedding-Reused)
 )
 
 # --- 設定暫存目錄結構 ---
 # 定義基礎暫存目錄名稱，所有操作都會在這個資料夾內進行
-BASE_TEMP_DIR = "temp_rag_processing"
-# 定義上傳檔案的存放目錄
-UPLOAD_DIR = os.path.join(BASE_TEMP_DIR, "uploads")
-# 定義解壓縮後的檔案存放目錄
-EXTRACT_DIR = os.path.join(BASE_TEMP_DIR, "extracted")
-# 定義處理完成的輸出檔案 (如向量庫 Zip) 存放目錄
-OUTPUT_DIR = os.path.join(BASE_TEMP_DIR, "outputs")
+# [修改] 每個請求/工作在其中各自取得一個暫存資料夾 (由 WorkspaceManager 管理，不再共用 uploads/outputs)
+BASE_TEMP_DIR = os.getenv("RAG_TEMP_DIR", "temp_rag_processing")
+
+# [新增] 定義長期保存的快取目錄 (不放在暫存目錄內，重啟後仍可沿用)
+CACHE_DIR = os.getenv("RAG_CACHE_DIR", "rag_cache")
 
 # 檢查上述目錄是否存在，若不存在則自動建立
-for d in [UPLOAD_DIR, EXTRACT_DIR, OUTPUT_DIR]:
+for d in [BASE_TEMP_DIR, CACHE_DIR]:
     os.makedirs(d, exist_ok=True)  # exist_ok=True 表示若目錄已存在則不報錯，避免程式中斷
 
 # --- 輔助函數：清理檔案 ---
@@ -73,7 +162,7 @@ def cleanup_files(paths_to_remove: List[str], dirs_to_remove: List[str]):
             try:
                 os.remove(path)  # 嘗試刪除檔案
             except Exception as e:  # 如果刪除失敗 (例如檔案被佔用)
-                print(f"Error removing file {path}: {e}")  # 印出錯誤訊息但不中斷程式
+                log_event("cleanup_failed", path=path, error=str(e))  # 記錄錯誤但不中斷程式
 
     # 遍歷需要刪除的資料夾路徑列表
     for dir_path in dirs_to_remove:
@@ -81,579 +170,4619 @@ def cleanup_files(paths_to_remove: List[str], dirs_to_remove: List[str]):
             try:
                 shutil.rmtree(dir_path, ignore_errors=True)  # 遞迴刪除資料夾及其內容 (rm -rf 的效果)
             except Exception as e:  # 如果刪除失敗
-                print(f"Error removing dir {dir_path}: {e}")  # 印出錯誤訊息
+                log_event("cleanup_failed", path=dir_path, error=str(e))  # 記錄錯誤
 
-# --- 輔助函數：讀取單一檔案 ---
-def load_single_file(file_path: str) -> List[Document]:
+# --- [新增] 輔助函數：讀取整數型環境變數 ---
+def env_int(name: str, default: int) -> int:
     """
-    根據檔案的副檔名，選擇對應的 LangChain Loader 來讀取內容
-    回傳一個 Document 物件列表
+    從環境變數讀取整數設定，若未設定或格式錯誤則使用預設值
     """
-    # 取得檔案副檔名並轉為小寫，方便判斷
-    ext = os.path.splitext(file_path)[1].lower()
+    value = os.getenv(name)
+    if not value:
+        return default
     try:
-        # 判斷是否為 PDF
-        if ext == ".pdf":
-            loader = PyPDFLoader(file_path)
-        # 判斷是否為 Word 檔 (.docx)
-        elif ext == ".docx":
-            loader = Docx2txtLoader(file_path)
-        # 判斷是否為程式碼或純文字檔 (增加支援 R, Rmd, Py, Md, Txt)
-        elif ext in [".txt", ".md", ".r", ".rmd", ".py"]:
-            # 使用 TextLoader，並開啟自動編碼偵測 (autodetect_encoding) 以避免中文亂碼
-            loader = TextLoader(file_path, encoding="utf-8", autodetect_encoding=True)
-        # 判斷是否為網頁檔
-        elif ext in [".html", ".htm"]:
-            # 使用 BSHTMLLoader (BeautifulSoup) 解析 HTML 結構
-            loader = BSHTMLLoader(file_path, open_encoding="utf-8")
-        else:
-            # 如果是不支援的格式 (如 jpg, xlsx)，回傳空列表，程式會自動略過
-            return []
-        # 執行讀取並回傳文件內容
-        return loader.load()
-    except Exception as e:
-        # 如果讀取過程發生錯誤 (如檔案損毀)，印出錯誤並回傳空列表，確保主程式不崩潰
-        print(f"⚠️ 無法讀取檔案 {file_path}: {e}")
-        return []
+        return int(value)
+    except ValueError:
+        log_event("invalid_env_int", name=name, value=value, default=default)
+        return default
 
-# --- 共通函數：處理 ZIP 並回傳 Documents (用於處理原始文件 Zip) ---
-def process_zip_to_docs(zip_path, extract_path):
+# =========================================================
+# [新增] 可觀測性：Prometheus 格式的指標 (/metrics) 與帶有 request id 的結構化日誌
+# =========================================================
+# 目前請求的 ID 與端點 (由 RequestContextMiddleware 設定；STAGES.run 會把 context 帶進執行緒池)
+REQUEST_ID: contextvars.ContextVar[str] = contextvars.ContextVar("request_id", default="-")
+REQUEST_ENDPOINT: contextvars.ContextVar[str] = contextvars.ContextVar("request_endpoint", default="background")
+
+def log_event(event: str, **fields):
     """
-    解壓縮 ZIP 檔，並遞迴掃描目錄，讀取所有支援的原始文件
-    回傳所有讀取到的 Document 物件列表
+    輸出一行 JSON 格式的日誌，自動帶上 request_id 與端點，方便把同一個請求的各行日誌串起來
     """
-    # 檢查該路徑是否為有效的 ZIP 檔
-    if not zipfile.is_zipfile(zip_path):
-        raise ValueError("無效的 ZIP 檔")
+    record = {"ts": round(time.time(), 3), "event": event, "request_id": REQUEST_ID.get(), "endpoint": REQUEST_ENDPOINT.get()}
+    record.update(fields)
+    print(json.dumps(record, ensure_ascii=False, default=str), flush=True)
 
-    # 開啟 ZIP 檔並解壓縮到指定目錄 (extract_path)
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_path)
+# 延遲直方圖的預設分界 (秒)：涵蓋快取命中的毫秒級到大型講義包建庫的數分鐘
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
 
-    all_documents = []  # 用於存放所有讀取到的文件
-    # 定義支援的副檔名列表
-    supported_exts = ('.pdf', '.docx', '.txt', '.md', '.py', '.html', '.r', '.rmd')
-
-    # 使用 os.walk 遞迴遍歷解壓縮後的目錄 (包含子資料夾)
-    for root, _, files in os.walk(extract_path):
-        for filename in files:
-            # 檢查檔案是否為支援的格式
-            if filename.lower().endswith(supported_exts):
-                # 組合完整的檔案路徑
-                file_path = os.path.join(root, filename)
-                # 呼叫 load_single_file 讀取該檔案
-                docs = load_single_file(file_path)
-
-                # 為讀取到的文件加入 Metadata (元數據)，這對 RAG 溯源很重要
-                # 計算相對路徑 (例如: "subfolder/doc.pdf")
-                rel_path = os.path.relpath(file_path, extract_path)
-                for d in docs:
-                    d.metadata["filename"] = filename  # 紀錄檔名
-                    d.metadata["source"] = rel_path    # 紀錄相對路徑來源
-                # 將處理好的文件加入總列表
-                all_documents.extend(docs)
+class Metric:
+    """
+    單一指標 (counter / gauge / histogram)，依標籤值分別累計，可跨執行緒使用
+    histogram 每組標籤保存 [各分界的次數..., 總和, 次數]
+    """
+    def __init__(self, name: str, help_text: str, kind: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.kind = kind
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values: Dict[tuple, object] = {}
 
-    return all_documents
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
 
-# --- [新增] 輔助函數：取得 OpenAI Client ---
-def get_openai_client():
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        # 也用於把各快取自行累計的次數在抓取時同步成 counter
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    @staticmethod
+    def _labels(names: tuple, values: tuple) -> str:
+        if not names:
+            return ""
+        escaped = (v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+        return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted((k, list(v) if isinstance(v, list) else v) for k, v in self._values.items())
+        for key, value in items:
+            if self.kind != "histogram":
+                lines.append(f"{self.name}{self._labels(self.labelnames, key)} {value}")
+                continue
+            names = self.labelnames + ("le",)
+            for bound, count in zip(self.buckets, value):
+                lines.append(f"{self.name}_bucket{self._labels(names, key + (repr(float(bound)),))} {count}")
+            lines.append(f"{self.name}_bucket{self._labels(names, key + ('+Inf',))} {value[-1]}")
+            lines.append(f"{self.name}_sum{self._labels(self.labelnames, key)} {value[-2]}")
+            lines.append(f"{self.name}_count{self._labels(self.labelnames, key)} {value[-1]}")
+        return lines
+
+class MetricsRegistry:
     """
-    初始化並回傳 OpenAI 原生客戶端，用於新 API 直接呼叫模型
+    所有指標的集合，render() 輸出 Prometheus text exposition format (0.0.4)
     """
-    api_key = os.getenv("OPENAI_API_KEY")  # 從環境變數讀取 Key
-    if not api_key:
-        raise ValueError("未設定 OPENAI_API_KEY")  # 若無 Key 則報錯
-    return OpenAI(api_key=api_key)  # 回傳 Client 物件
+    def __init__(self):
+        self._metrics: List[Metric] = []
 
-# --- [新增] 輔助函數：從解壓縮目錄取得 GIS 檔案名稱 ---
-def get_gis_filenames(extract_path) -> List[str]:
+    def add(self, name: str, help_text: str, kind: str, labelnames: tuple = (), **kwargs) -> Metric:
+        metric = Metric(name, help_text, kind, labelnames, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for m in self._metrics for line in m.render()) + "\n"
+
+METRICS = MetricsRegistry()
+HTTP_REQUESTS = METRICS.add("rag_http_requests_total", "HTTP requests by endpoint, method and status", "counter",
+                            ("endpoint", "method", "status"))
+HTTP_LATENCY = METRICS.add("rag_http_request_duration_seconds", "HTTP request latency until the last response byte",
+                           "histogram", ("endpoint", "method"))
+HTTP_IN_FLIGHT = METRICS.add("rag_http_requests_in_flight", "HTTP requests currently being served", "gauge", ("endpoint",))
+STAGE_LATENCY = METRICS.add("rag_stage_duration_seconds", "Time spent in each processing stage of a request",
+                            "histogram", ("endpoint", "stage"))
+LIMITER_WAIT = METRICS.add("rag_limiter_wait_seconds", "Time spent waiting for a concurrency slot", "histogram", ("limiter",))
+LIMITER_ACTIVE = METRICS.add("rag_limiter_active", "Work items currently running in each limiter", "gauge", ("limiter",))
+LIMITER_WAITING = METRICS.add("rag_limiter_waiting", "Work items currently queued in each limiter", "gauge", ("limiter",))
+LIMITER_REJECTED = METRICS.add("rag_limiter_rejected_total", "Work items rejected by each limiter (full queue or wait timeout)",
+                               "counter", ("limiter", "reason"))
+LLM_TOKENS = METRICS.add("rag_llm_tokens_total", "Chat completion tokens by endpoint, model and kind (prompt/completion)",
+                         "counter", ("endpoint", "model", "kind"))
+EMBEDDING_TOKENS = METRICS.add("rag_embedding_tokens_total", "Tokens sent to the embedding API", "counter", ("endpoint", "model"))
+CACHE_HITS = METRICS.add("rag_cache_hits_total", "Cache hits by cache", "counter", ("cache",))
+CACHE_MISSES = METRICS.add("rag_cache_misses_total", "Cache misses by cache", "counter", ("cache",))
+CACHE_HIT_RATIO = METRICS.add("rag_cache_hit_ratio", "Cache hit ratio by cache", "gauge", ("cache",))
+OPENAI_IN_FLIGHT = METRICS.add("rag_openai_requests_in_flight", "OpenAI HTTP requests currently in flight", "gauge")
+OPENAI_CONNECTIONS = METRICS.add("rag_openai_connections", "Open connections in the shared OpenAI pool", "gauge")
+
+@contextlib.contextmanager
+def timed_stage(stage: str):
     """
-    掃描目錄，找出 .shp, .csv 等可用於 GIS 實作的檔案名稱
-    這將用於提供給 AI，讓它知道有哪些素材可以出題
+    記錄一個處理階段的耗時 (依目前請求的端點分開統計)，並輸出一行日誌
     """
-    gis_exts = ('.shp', '.csv', '.tif', '.tiff', '.geojson', '.txt', '.json', '.kml')  # 定義感興趣的副檔名
-    found_files = []  # 初始化結果列表
-    for root, _, files in os.walk(extract_path):  # 遍歷目錄
-        for filename in files:
-            if filename.lower().endswith(gis_exts):  # 如果符合 GIS 格式
-                found_files.append(filename)  # 加入列表
-    return found_files  # 回傳檔名列表
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_LATENCY.observe(elapsed, endpoint=REQUEST_ENDPOINT.get(), stage=stage)
+        log_event("stage", stage=stage, seconds=round(elapsed, 4))
 
-# 定義根路徑 (Root Endpoint)
-@app.get("/")
-def home():
-    # 回傳簡單的 JSON 訊息，確認伺服器正在運作，並告知可用的 API 路徑
-    return {"message": "RAG Server Ready. Endpoints: /process_zip, /ask_with_zip, /api/generate_question, /api/grade_submission"}
+def route_template(scope) -> str:
+    """
+    取得請求對應的路由樣板 (例如 /api/jobs/{job_id})，避免把 job_id 等參數當成指標標籤
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return getattr(route, "path", "unmatched")
+    return "unmatched"
 
-# =========================================================
-# 功能 1: 製作並下載 Vector DB (原始文件 -> RAG Zip)
-# =========================================================
-@app.post("/process_zip")
-async def process_zip_file(background_tasks: BackgroundTasks, file: UploadFile = File(...)):
+def valid_request_id(value: str) -> bool:
+    return 0 < len(value) <= 64 and all(c.isalnum() or c in "-_." for c in value)
+
+class RequestContextMiddleware:
     """
-    接收原始文件 Zip，製作成 FAISS 向量資料庫，並回傳 Zip 供使用者下載。
+    ASGI 中介軟體：為每個請求指定 request id (沿用用戶端送來的 X-Request-ID，並回傳於回應 Header)
+    記錄上傳耗時 (讀完請求內容)、總耗時 (串流回應算到最後一個 byte 送出) 與進行中的請求數
     """
-    # 從環境變數取得 OpenAI API Key，這是呼叫 Embedding 模型必需的
-    api_key = os.getenv("OPENAI_API_KEY")
-    # 如果沒有設定 API Key，回傳 500 錯誤
-    if not api_key:
-        return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+    def __init__(self, app):
+        self.app = app
 
-    # 產生一個唯一的 Task ID，用於隔離不同使用者的請求
-    task_id = str(uuid.uuid4())
-    # 定義檔案路徑
-    zip_save_path = os.path.join(UPLOAD_DIR, f"{task_id}_{file.filename}")
-    extract_folder = os.path.join(EXTRACT_DIR, task_id)
-    vector_db_folder = os.path.join(OUTPUT_DIR, task_id)
-    output_zip_path = os.path.join(OUTPUT_DIR, f"{task_id}_faiss.zip")
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope.get("headers") or [])
+        request_id = headers.get(b"x-request-id", b"").decode("latin-1")
+        if not valid_request_id(request_id):
+            request_id = uuid.uuid4().hex
+        endpoint = route_template(scope)
+        method = scope.get("method", "")
+        id_token = REQUEST_ID.set(request_id)
+        endpoint_token = REQUEST_ENDPOINT.set(endpoint)
+        start = time.perf_counter()
+        state = {"status": 500, "uploaded": False, "finished": False}
+        HTTP_IN_FLIGHT.inc(endpoint=endpoint)
 
-    # 將使用者上傳的 Zip 寫入硬碟
-    with open(zip_save_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+        def finish():
+            if state["finished"]:
+                return
+            state["finished"] = True
+            elapsed = time.perf_counter() - start
+            HTTP_IN_FLIGHT.dec(endpoint=endpoint)
+            HTTP_REQUESTS.inc(endpoint=endpoint, method=method, status=str(state["status"]))
+            HTTP_LATENCY.observe(elapsed, endpoint=endpoint, method=method)
+            log_event("request", method=method, path=scope.get("path", ""), status=state["status"], seconds=round(elapsed, 4))
 
-    try:
-        # 1. 呼叫共通函數：解壓縮並讀取所有文件
-        all_documents = process_zip_to_docs(zip_save_path, extract_folder)
-        # 如果沒有讀取到任何支援的文件，回傳 400 錯誤
-        if not all_documents:
-            return JSONResponse(status_code=400, content={"error": "Zip 內無支援的文件"})
-
-        # 2. 文字切分 (Chunking)
-        # 設定切分器：每塊 1000 字元，重疊 200 字元
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        split_docs = text_splitter.split_documents(all_documents)
-
-        # 3. 向量化 (Embedding)
-        # 初始化 OpenAI Embeddings 模型 (使用 text-embedding-3-large)
-        embeddings = OpenAIEmbeddings(model="text-embedding-3-large", api_key=api_key)
-        # 使用 FAISS 將切分後的文件轉換為向量並建立索引
-        vectorstore = FAISS.from_documents(split_docs, embeddings)
-
-        # 4. 將向量資料庫存檔
-        # 將 FAISS 索引儲存到本地資料夾 (包含 index.faiss 和 index.pkl)
-        vectorstore.save_local(vector_db_folder)
+        async def receive_wrapper():
+            message = await receive()
+            if not state["uploaded"] and message["type"] == "http.request" and not message.get("more_body", False):
+                # 整個請求內容 (上傳的 ZIP) 已收完
+                state["uploaded"] = True
+                STAGE_LATENCY.observe(time.perf_counter() - start, endpoint=endpoint, stage="upload")
+            return message
 
-        # 5. 打包成 Zip
-        with zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for root, dirs, files in os.walk(vector_db_folder):
-                for file in files:
-                    # 計算相對路徑，保持資料夾結構寫入 zip
-                    arcname = os.path.relpath(os.path.join(root, file), os.path.join(vector_db_folder, '..'))
-                    zipf.write(os.path.join(root, file), arcname)
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                state["status"] = message["status"]
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                # 回應已送完 (背景清理任務不計入請求耗時)
+                finish()
 
-        # 6. 設定背景清理任務 (刪除暫存檔)
-        cleanup_targets_files = [zip_save_path, output_zip_path]
-        cleanup_targets_dirs = [extract_folder, vector_db_folder]
-        background_tasks.add_task(cleanup_files, cleanup_targets_files, cleanup_targets_dirs)
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            finish()  # 例外或用戶端中途斷線時仍要扣回進行中的請求數
+            REQUEST_ENDPOINT.reset(endpoint_token)
+            REQUEST_ID.reset(id_token)
 
-        # 回傳生成的 ZIP 檔給使用者下載
-        return FileResponse(output_zip_path, filename=f"faiss_db_{task_id[:8]}.zip", media_type='application/zip')
+# 最後加入的中介軟體位於最外層，計時涵蓋 CORS 等其他處理
+app.add_middleware(RequestContextMiddleware)
 
-    except Exception as e:
-        # 發生錯誤時清理
-        cleanup_files([zip_save_path], [extract_folder, vector_db_folder])
-        return JSONResponse(status_code=500, content={"error": str(e)})
+# --- [新增] 輔助函數：計算 token 數 (用於統計 Embedding 用量與控制 Prompt 長度) ---
+_TOKEN_ENCODERS: Dict[str, object] = {}
+
+def token_encoder(encoding: str):
+    """
+    取得 tiktoken 編碼器 (cl100k_base 為 text-embedding-3 系列、o200k_base 為 GPT-4o 使用的編碼)
+    編碼檔無法載入時 (例如離線環境) 回傳 None，呼叫端改以 UTF-8 長度粗估
+    """
+    encoder = _TOKEN_ENCODERS.get(encoding)
+    if encoder is None:
+        try:
+            encoder = tiktoken.get_encoding(encoding)
+        except Exception as e:
+            log_event("tokenizer_unavailable", encoding=encoding, error=str(e))
+            encoder = False
+        _TOKEN_ENCODERS[encoding] = encoder
+    return encoder or None
 
+def token_counts(texts: List[str], encoding: str = "cl100k_base") -> List[int]:
+    """
+    逐一計算每段文字的 token 數 (用於依 token 數打包 Embedding 批次)
+    """
+    encoder = token_encoder(encoding)
+    if encoder is None:
+        return [len(t.encode("utf-8")) // 3 + 1 for t in texts]
+    return [len(tokens) for tokens in encoder.encode_ordinary_batch(texts)]
 
-# =========================================================
-# 功能 2: 上傳並直接問答 (支援 RAG Zip 或 原始文件 Zip)
-# =========================================================
-@app.post("/ask_with_zip")
-async def ask_with_zip(
-    background_tasks: BackgroundTasks, # 用於設定背景清理任務
-    question: str = Form(...),         # 接收使用者輸入的問題 (Form Data)
-    file: UploadFile = File(...)       # 接收使用者上傳的檔案 (Zip)
-):
+def count_tokens(texts: List[str], encoding: str = "cl100k_base") -> int:
+    return sum(token_counts(texts, encoding))
+
+def truncate_tokens(text: str, max_tokens: int, encoding: str = "cl100k_base") -> str:
     """
-    這是主要的問答 API。
-    它會自動偵測上傳的 Zip 是「已經做好的 RAG 資料庫」還是「原始文件」。
+    截斷文字到最多 max_tokens 個 token (無法載入編碼器時依粗估的比例截斷字元)
     """
-    # 取得 OpenAI API Key
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+    encoder = token_encoder(encoding)
+    if encoder is None:
+        total = count_tokens([text], encoding)
+        return text if total <= max_tokens else text[:len(text) * max_tokens // total]
+    tokens = encoder.encode_ordinary(text)
+    # 切在多位元組字元中間時 decode 會產生替代字元，去掉
+    return text if len(tokens) <= max_tokens else encoder.decode(tokens[:max_tokens]).rstrip("\ufffd")
 
-    # 產生唯一的 Task ID
-    task_id = str(uuid.uuid4())
-    # 設定檔案存放與解壓縮路徑
-    zip_save_path = os.path.join(UPLOAD_DIR, f"{task_id}_{file.filename}")
-    extract_folder = os.path.join(EXTRACT_DIR, task_id)
+# --- [修改] 支援的檔案格式 ---
+# 可讀取為講義內容的原始文件副檔名
+SUPPORTED_EXTS = ('.pdf', '.docx', '.txt', '.md', '.py', '.html', '.r', '.rmd')
+# 可用於 GIS 實作出題的素材副檔名
+GIS_EXTS = ('.shp', '.csv', '.tif', '.tiff', '.geojson', '.txt', '.json', '.kml')
 
-    # 儲存上傳的檔案
-    with open(zip_save_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+# --- [新增] ZIP 大小限制 (依中央目錄記載的解壓縮後大小檢查，防止 ZIP 炸彈) ---
+ZIP_MAX_MEMBER_BYTES = env_int("ZIP_MAX_MEMBER_MB", 100) * 1024 * 1024  # 單一成員上限，預設 100MB
+ZIP_MAX_TOTAL_BYTES = env_int("ZIP_MAX_TOTAL_MB", 512) * 1024 * 1024    # 需讀取成員的總和上限，預設 512MB
 
+# --- [修改] 輔助函數：讀取單一檔案 (解析實作在 loaders.py，讀檔行程只需匯入該模組) ---
+def load_file_bytes(filename: str, data: bytes) -> List[Document]:
+    """
+    讀取記憶體中的單一檔案，回傳 Document 列表
+    讀取過程發生錯誤 (如檔案損毀) 時記錄錯誤並回傳空列表，確保主程式不崩潰
+    """
     try:
-        # 驗證是否為 ZIP 格式
-        if not zipfile.is_zipfile(zip_save_path):
-             return JSONResponse(status_code=400, content={"error": "無效的 ZIP 檔"})
-
-        # 先進行解壓縮，這樣我們才能檢查裡面的內容
-        with zipfile.ZipFile(zip_save_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_folder)
-
-        # === 關鍵邏輯：偵測是否為 RAG 資料庫 (FAISS) ===
-        is_rag_db = False  # 預設不是 RAG DB
-        db_folder = None   # 用來存放 index.faiss 所在的資料夾路徑
-        
-        # 遍歷解壓縮後的資料夾，尋找 FAISS 關鍵檔案
-        for root, _, files in os.walk(extract_folder):
-            # 如果資料夾內同時包含 index.faiss 和 index.pkl，判定為 RAG 資料庫
-            if "index.faiss" in files and "index.pkl" in files:
-                is_rag_db = True
-                db_folder = root
-                break  # 找到後就停止搜尋
-        
-        # 初始化 Embeddings 模型 (不管是哪種模式，都需要用它來處理問題向量)
-        embeddings = OpenAIEmbeddings(model="text-embedding-3-large", api_key=api_key)
-
-        # 根據偵測結果決定處理流程
-        if is_rag_db:
-            # 【模式 A】使用者上傳的是 RAG Zip (已做好的資料庫)
-            print(f"偵測到 RAG 資料庫，載入路徑: {db_folder}")
-            # 使用 FAISS.load_local 直接載入資料庫，速度極快
-            # allow_dangerous_deserialization=True 是必須的，因為我們正在載入 pickle 檔
-            vectorstore = FAISS.load_local(
-                db_folder, 
-                embeddings, 
-                allow_dangerous_deserialization=True
-            )
-        else:
-            # 【模式 B】使用者上傳的是 原始文件 Zip (PDF/Word 等)
-            print("未偵測到資料庫，嘗試讀取原始文件...")
-            # 呼叫之前的邏輯：讀取所有原始文件
-            all_documents = process_zip_to_docs(zip_save_path, extract_folder)
-            
-            # 如果 Zip 裡既沒有 RAG DB，也沒有支援的原始文件，報錯
-            if not all_documents:
-                return JSONResponse(status_code=400, content={"error": "Zip 內無支援的文件 (亦非 RAG DB)"})
+        return parse_file(filename, data)
+    except Exception as e:
+        log_event("loader_file_failed", file=filename, error=str(e))
+        return []
 
-            # 進行切分 (Chunking)
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            split_docs = text_splitter.split_documents(all_documents)
-            # 現場製作向量資料庫 (In-Memory)
-            vectorstore = FAISS.from_documents(split_docs, embeddings)
+# --- [新增] 讀檔平行化設定 ---
+# LOADER_MODE: "process" 使用多行程平行讀檔；"serial" 在主行程逐一讀檔 (舊行為)
+LOADER_MODE = os.getenv("LOADER_MODE", "process")
+# LOADER_WORKERS: 平行讀檔的行程數，預設為 CPU 核心數
+LOADER_WORKERS = env_int("LOADER_WORKERS", os.cpu_count() or 1)
+# LOADER_FILE_TIMEOUT: 單一檔案的讀取時間上限 (秒，從該檔案開始讀取起算)，避免一個異常的 PDF 卡住整個匯入
+LOADER_FILE_TIMEOUT = env_int("LOADER_FILE_TIMEOUT", 120)
+# LOADER_START_METHOD: 建立讀檔行程的方式；伺服器有許多執行緒，fork 可能讓子行程繼承其他執行緒持有的鎖而卡住，
+# 因此預設使用 forkserver (不支援時改用 spawn)
+LOADER_START_METHOD = os.getenv(
+    "LOADER_START_METHOD",
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn",
+)
 
-        # === 問答流程 (Retrieval & Generation) ===
-        
-        # 將向量庫轉換為檢索器 (Retriever)，設定搜尋最相關的 5 個片段 (k=5)
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 5})
+class LoaderPool:
+    """
+    常駐的讀檔行程池 (第一次使用時建立，所有匯入共用)
+    每個行程一次只處理一個檔案，並記錄開始時間：超過 LOADER_FILE_TIMEOUT 的檔案直接終止該行程並補上新的行程，
+    之後的檔案不會被卡住的行程拖累
+    """
+    def __init__(self, workers: int, start_method: str):
+        self.workers = max(1, workers)
+        self.start_method = start_method
+        self._ctx = multiprocessing.get_context(start_method)
+        self._idle: queue.Queue = queue.Queue()  # 閒置的 (行程, 連線)
+        self._lock = threading.Lock()
+        self._procs: List = []
+        self._started = False
+        self.timeouts = 0  # 因逾時而被終止的行程數
+        self.crashes = 0   # 意外結束的行程數
 
-        # 定義 Prompt Template (提示詞模板)，指導 AI 如何回答
-        prompt_template = """你是一個專業的助教。請根據以下的上下文內容來回答學生的問題。
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
 
-        上下文:
-        {context}
+    def _spawn(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        proc = self._ctx.Process(target=loader_worker_main, args=(child_conn,), name="loader", daemon=True)
+        proc.start()
+        child_conn.close()
+        with self._lock:
+            self._procs.append(proc)
+        return proc, parent_conn
 
-        問題: {question}
+    def _replace(self, worker):
+        proc, conn = worker
+        proc.terminate()
+        proc.join(timeout=5)
+        conn.close()
+        with self._lock:
+            if proc in self._procs:
+                self._procs.remove(proc)
+        self._idle.put(self._spawn())
 
-        回答:"""
+    def _ensure_started(self):
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for _ in range(self.workers):
+            self._idle.put(self._spawn())
 
-        # 建立 LangChain 的 Prompt 物件
-        PROMPT = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
+    def load(self, files: List[tuple], on_loaded: Optional[Callable[[int], None]] = None) -> List[List[Document]]:
+        """
+        平行讀取多個檔案 (files 為 (檔名, 內容) 列表)，回傳結果的順序與輸入相同 (確保輸出可重現)
+        on_loaded: 每讀完一個檔案就以「已完成檔案數」呼叫一次，用於回報進度
+        """
+        self._ensure_started()
+        results: List[Optional[List[Document]]] = [None] * len(files)
+        running: Dict[object, tuple] = {}  # 連線 -> (worker, 檔案位置, 截止時間)
+        next_index = 0
+        done = 0
 
-        # 建立 RetrievalQA Chain (檢索問答鏈)
-        qa_chain = RetrievalQA.from_chain_type(
-            llm=ChatOpenAI(model="gpt-4o", temperature=0, api_key=api_key), # 使用 GPT-4o 模型
-            chain_type="stuff", # "stuff" 模式：把所有檢索到的內容塞進 Prompt
-            retriever=retriever, # 使用剛剛設定的檢索器
-            chain_type_kwargs={"prompt": PROMPT}, # 傳入自訂的 Prompt
-            return_source_documents=True # 要求回傳參考的來源文件，方便顯示出處
-        )
+        def finish(index: int, docs: List[Document]):
+            nonlocal done
+            results[index] = docs
+            done += 1
+            if on_loaded:
+                on_loaded(done)
 
-        # 執行問答鏈，傳入使用者的問題
-        result = qa_chain.invoke({"query": question})
+        try:
+            while done < len(files):
+                # 1. 把檔案分派給閒置的行程 (沒有進行中的工作時等待其他匯入釋放行程)
+                while next_index < len(files):
+                    try:
+                        worker = self._idle.get(block=not running, timeout=1)
+                    except queue.Empty:
+                        break
+                    try:
+                        worker[1].send(files[next_index])
+                    except (BrokenPipeError, OSError):
+                        # 閒置中的行程已結束 (例如被系統終止)，換一個新的再重試
+                        self._count("crashes")
+                        self._replace(worker)
+                        continue
+                    running[worker[1]] = (worker, next_index, time.monotonic() + LOADER_FILE_TIMEOUT)
+                    next_index += 1
+                if not running:
+                    continue
 
-        # === 清理與回傳 ===
-        # 設定背景任務，刪除剛剛上傳和解壓縮的暫存檔
-        cleanup_targets_files = [zip_save_path]
-        cleanup_targets_dirs = [extract_folder]
-        background_tasks.add_task(cleanup_files, cleanup_targets_files, cleanup_targets_dirs)
+                # 2. 等待任一檔案讀完或最早的截止時間到達
+                timeout = max(0.0, min(deadline for _, _, deadline in running.values()) - time.monotonic())
+                for conn in mp_connection.wait(list(running), timeout=timeout):
+                    worker, index, _ = running.pop(conn)
+                    path = files[index][0]
+                    try:
+                        status, payload = conn.recv()
+                    except (EOFError, OSError) as e:
+                        self._count("crashes")
+                        log_event("loader_worker_crashed", file=path, error=str(e))
+                        self._replace(worker)
+                        finish(index, [])
+                        continue
+                    self._idle.put(worker)
+                    if status != "ok":
+                        log_event("loader_file_failed", file=path, error=payload)
+                    finish(index, payload if status == "ok" else [])
 
-        # 回傳 JSON 結果
-        return {
-            "question": question, # 回傳原始問題
-            "answer": result["result"], # 回傳 AI 的回答
-            # 回傳參考資料來源 (去重複)，如果有 metadata 則顯示檔名，否則顯示 unknown
-            "sources": list(set([doc.metadata.get('filename', 'unknown') for doc in result.get("source_documents", [])]))
-        }
+                # 3. 逾時的檔案：終止該行程 (釋放名額) 並略過此檔
+                now = time.monotonic()
+                for conn, (worker, index, deadline) in list(running.items()):
+                    if deadline <= now:
+                        del running[conn]
+                        self._count("timeouts")
+                        log_event("loader_file_timeout", file=files[index][0], timeout=LOADER_FILE_TIMEOUT)
+                        self._replace(worker)
+                        finish(index, [])
+        finally:
+            # 例外中斷時，仍在讀檔的行程狀態未知，一律換掉
+            for worker, _, _ in running.values():
+                self._replace(worker)
+        return results
 
-    except Exception as e:
-        # 如果發生任何未預期的錯誤，也要清理暫存檔
-        cleanup_files([zip_save_path], [extract_folder])
-        # 回傳 500 錯誤與詳細錯誤訊息
-        return JSONResponse(status_code=500, content={"error": str(e)})
+    def close(self):
+        with self._lock:
+            procs, self._procs = self._procs, []
+            self._started = False
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.join(timeout=5)
+        self._idle = queue.Queue()
 
+    def stats(self) -> dict:
+        with self._lock:
+            alive = sum(1 for p in self._procs if p.is_alive())
+            return {"workers": self.workers, "alive": alive, "idle": self._idle.qsize(),
+                    "start_method": self.start_method, "timeouts": self.timeouts, "crashes": self.crashes}
 
-# =========================================================
-# [新增] API 3: 智慧出題 (Generate Question)
-# 邏輯：優先使用上傳的檔案，若無則使用伺服器上的 'rag_db.zip'
-# =========================================================
-@app.post("/api/generate_question")
-async def generate_practice_question_with_upload(
-    background_tasks: BackgroundTasks, # 用於設定背景清理任務
-    file: Optional[UploadFile] = File(None), # [關鍵修改] 檔案為可選 (Optional)，預設為 None
-    qtype: str = Form(...),            # 使用 Form Data 接收題型
-    level: str = Form(...)             # 使用 Form Data 接收難度
-):
+# 建立全域讀檔行程池 (行程在第一次匯入時才啟動)
+LOADER_POOL = LoaderPool(LOADER_WORKERS, LOADER_START_METHOD)
+
+def load_files_parallel(files: List[tuple], on_loaded: Optional[Callable[[int], None]] = None) -> List[List[Document]]:
     """
-    【一條龍出題 API】
-    1. 檢查是否有上傳 ZIP，若有則使用。
-    2. 若無上傳，檢查伺服器同層目錄下是否有 'rag_db.zip'，若有則使用。
-    3. 自動載入向量資料庫 -> 檢索 Context -> 偵測檔案列表 -> 呼叫 GPT-4o 生成題目。
+    使用常駐的行程池平行讀取多個檔案，超過 LOADER_FILE_TIMEOUT 的檔案會被略過 (回傳空列表)
     """
-    # 檢查 API Key
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key: return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
-    
-    # 初始化 OpenAI 原生客戶端
-    client = get_openai_client()
-    
-    # 建立任務 ID 與路徑
-    task_id = str(uuid.uuid4())
-    extract_folder = os.path.join(EXTRACT_DIR, task_id)
+    return LOADER_POOL.load(files, on_loaded)
 
-    # === [關鍵邏輯] 決定使用哪個 ZIP 檔案來源 ===
-    zip_source_path = "" # 用來存放最終要解壓縮的檔案路徑
-    
-    if file:
-        # 情境 A: 使用者有上傳檔案
-        print(f"收到使用者上傳檔案: {file.filename}")
-        zip_source_path = os.path.join(UPLOAD_DIR, f"{task_id}_{file.filename}")
-        with open(zip_source_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer) # 將上傳的內容寫入硬碟
-    else:
-        # 情境 B: 使用者沒上傳，檢查伺服器預設檔案
-        default_zip = "rag_db.zip" # 預設檔案名稱
-        if os.path.exists(default_zip):
-            print(f"使用伺服器預設檔案: {default_zip}")
-            # 複製一份到 upload 資料夾，避免多執行緒同時讀寫同一個檔案造成衝突
-            zip_source_path = os.path.join(UPLOAD_DIR, f"{task_id}_default.zip")
-            shutil.copy(default_zip, zip_source_path)
-        else:
-            # 兩者皆無，回傳錯誤
-            return JSONResponse(status_code=400, content={"error": "未上傳檔案，且伺服器找不到預設的 rag_db.zip"})
+# --- [新增] ZIP 中央目錄掃描結果 ---
+# [新增] 可 memory-map 的索引格式 (取代 index.pkl)：
+# manifest.json (維度、筆數、索引類型等資訊)
+# + 向量：vectors.f32 / vectors.f16 (依列排列，flat 類型) 或 index.faiss (ivf / hnsw / pq 類型)
+# + chunks.bin (每個 Chunk 一筆 UTF-8 JSON，依序串接) + chunks.idx (n+1 個 uint64 位移)
+MMAP_MANIFEST = "manifest.json"
+MMAP_FORMAT = "ragidx"
+MMAP_VERSION = 1
+MMAP_REQUIRED_MEMBERS = ("chunks.bin", "chunks.idx")  # 與 manifest.json 一起出現時判定為新格式
+MMAP_VECTOR_FILES = {"float32": "vectors.f32", "float16": "vectors.f16"}
+# 以 STORED 對齊存入 ZIP 的成員 (才能直接 memory-map)
+MMAP_STORED_MEMBERS = ("vectors.f32", "vectors.f16", "index.faiss", "chunks.bin", "chunks.idx")
+# 設為 0 時改為讀進記憶體；被 memory-map 的 ZIP 不可原地覆寫 (預設語料庫一律先複製成私有快照再載入)
+MMAP_ENABLED = os.getenv("RAG_MMAP", "1") != "0"
 
-    try:
-        # 驗證 ZIP 格式
-        if not zipfile.is_zipfile(zip_source_path):
-             return JSONResponse(status_code=400, content={"error": "無效的 ZIP 檔"})
-
-        # 2. 解壓縮
-        with zipfile.ZipFile(zip_source_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_folder)
-
-        # 3. 偵測 ZIP 內容：是「已經做好的 FAISS DB」還是「原始文件」？
-        is_rag_db = False
-        db_folder = None
-        for root, _, files in os.walk(extract_folder):
-            # 檢查是否有 FAISS 的索引檔案
-            if "index.faiss" in files and "index.pkl" in files:
-                is_rag_db = True
-                db_folder = root
-                break
-        
-        embeddings = OpenAIEmbeddings(model="text-embedding-3-large", api_key=api_key)
+class ZipScan:
+    """
+    只讀取 ZIP 的中央目錄 (central directory)，不解壓縮任何內容
+    doc_members: 需要讀取的講義文件成員 (依路徑排序)
+    gis_files: 可用於出題的 GIS 檔名
+    faiss_dir: 同時含有 index.faiss 與 index.pkl 的資料夾前綴 (None 表示不是舊格式的 RAG 資料庫)
+    mmap_dir: 同時含有 manifest.json、vectors.f32、chunks.bin 與 chunks.idx 的資料夾前綴 (新格式)
+    """
+    def __init__(self, zip_ref: zipfile.ZipFile):
+        infos = [i for i in zip_ref.infolist() if not i.is_dir()]
+        names = {i.filename for i in infos}
+        self.doc_members = sorted(
+            (i for i in infos if i.filename.lower().endswith(SUPPORTED_EXTS)),
+            key=lambda i: i.filename,
+        )
+        self.gis_files = [os.path.basename(i.filename) for i in infos if i.filename.lower().endswith(GIS_EXTS)]
+        self.faiss_dir = None
+        for name in sorted(names):
+            if os.path.basename(name) == "index.faiss":
+                prefix = name[: -len("index.faiss")]
+                if prefix + "index.pkl" in names:
+                    self.faiss_dir = prefix
+                    break
+        self.mmap_dir = None
+        for name in sorted(names):
+            if os.path.basename(name) == MMAP_MANIFEST:
+                prefix = name[: -len(MMAP_MANIFEST)]
+                if all(prefix + member in names for member in MMAP_REQUIRED_MEMBERS):
+                    self.mmap_dir = prefix
+                    break
 
-        # 4. 準備 VectorStore (載入或現場製作)
-        if is_rag_db:
-            # 情況 A: 是處理過的 rag.zip -> 直接載入，速度快
-            vectorstore = FAISS.load_local(db_folder, embeddings, allow_dangerous_deserialization=True)
-        else:
-            # 情況 B: 是原始文件 Zip -> 現場切分向量化 (較慢)
-            all_documents = process_zip_to_docs(zip_source_path, extract_folder)
-            if not all_documents:
-                return JSONResponse(status_code=400, content={"error": "Zip 內無支援的講義文件"})
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            split_docs = text_splitter.split_documents(all_documents)
-            vectorstore = FAISS.from_documents(split_docs, embeddings)
+def check_member_sizes(members: List[zipfile.ZipInfo]):
+    """
+    依中央目錄記載的大小，檢查單一成員與總和是否超過上限
+    """
+    total = 0
+    for info in members:
+        if info.file_size > ZIP_MAX_MEMBER_BYTES:
+            raise CorpusInputError(f"ZIP 內的檔案 {info.filename} 超過大小上限 ({ZIP_MAX_MEMBER_BYTES // (1024 * 1024)}MB)")
+        total += info.file_size
+    if total > ZIP_MAX_TOTAL_BYTES:
+        raise CorpusInputError(f"ZIP 解壓縮後總大小超過上限 ({ZIP_MAX_TOTAL_BYTES // (1024 * 1024)}MB)")
 
-        # 5. 自動偵測檔案列表 (File List) - 讓 AI 知道有哪些 GIS 檔案可用
-        # 使用輔助函數掃描解壓縮目錄
-        file_names = get_gis_filenames(extract_folder)
-        file_names_str = ", ".join(file_names) if file_names else "None"
+def read_member(zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo) -> bytes:
+    """
+    讀取單一成員到記憶體；多讀 1 byte 以防中央目錄記載的大小與實際不符
+    """
+    with zip_ref.open(info) as f:
+        data = f.read(ZIP_MAX_MEMBER_BYTES + 1)
+    if len(data) > ZIP_MAX_MEMBER_BYTES:
+        raise CorpusInputError(f"ZIP 內的檔案 {info.filename} 超過大小上限")
+    return data
 
-        # 6. RAG 檢索 (Retrieval) - 找出與「題型/難度」相關的內容
-        query = f"空間分析 {level} {qtype} 重點概念與操作步驟"
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 5}) # 撈前 5 個相關段落
-        docs = retriever.invoke(query)
-        context_text = "\n\n".join([d.page_content for d in docs]) # 組合 Context 文字
+def open_zip(zip_source) -> zipfile.ZipFile:
+    """
+    開啟 ZIP (可傳入檔案路徑或檔案物件)，格式錯誤時拋出 CorpusInputError
+    """
+    if hasattr(zip_source, "seek"):
+        zip_source.seek(0)
+    try:
+        return zipfile.ZipFile(zip_source, 'r')
+    except zipfile.BadZipFile:
+        raise CorpusInputError("無效的 ZIP 檔")
 
-        # 7. 組合 Prompt (System Prompt) - 嚴格限制 AI 行為
-        sys_role = "你是頂尖的空間分析助教。請使用 GPT-4o 的強大邏輯來出題。"
-        r_rules = """⚠️ 嚴格限制：
-1. 實作內容必須限定使用 **R 語言** (例如使用 sf, terra, tmap, tidyverse 等套件)。
-2. 🚫 禁止提及 "ArcGIS", "QGIS" 或通用的 "GIS 軟體" 字眼。
-3. 題目應引導學生寫出 R 程式碼來解決問題。
-4. **請務必使用繁體中文 (Traditional Chinese) 出題。**"""
-        
-        system_instruction = f"""你必須從提供的「真實檔案列表」中選擇一個檔案來設計操作任務。
-真實檔案列表: [{file_names_str}]
-(若選擇 Shapefile，請只提及 .shp 檔，不要提及 .dbf 或 .shx)
-{r_rules}
-【出題重要規範】
-1. 在 'question_content' (題目) 中：只說明**任務目標**與**使用資料**。❌ 嚴禁直接列出步驟 1, 2, 3。請保留思考空間給學生。
-2. 在 'hint' (提示) 中：才列出詳細的解題步驟、建議使用的 R 套件與函數。"""
+# --- 共通函數：處理 ZIP 並回傳 Documents (用於處理原始文件 Zip) ---
+def process_zip_to_docs(zip_source, zip_ref: Optional[zipfile.ZipFile] = None, scan: Optional[ZipScan] = None,
+                        progress: Optional[Callable[..., None]] = None):
+    """
+    [修改] 直接逐一讀取 ZIP 成員 (不使用 extractall 解壓到硬碟)，只讀取支援的原始文件
+    回傳所有讀取到的 Document 物件列表 (依 ZIP 內路徑排序，順序固定)
+    progress: 可選的進度回報函數，會以 files_total / files_loaded 關鍵字參數呼叫
+    """
+    own_ref = zip_ref is None
+    if own_ref:
+        zip_ref = open_zip(zip_source)
+    try:
+        scan = scan or ZipScan(zip_ref)
+        # 先依中央目錄檢查大小上限，再讀取內容
+        check_member_sizes(scan.doc_members)
+        files = [(info.filename, read_member(zip_ref, info)) for info in scan.doc_members]
+    finally:
+        if own_ref:
+            zip_ref.close()
 
-        task_instruction = f"目前的題型任務是：【{qtype}】。難度：{level}。"
-        core_point = f"🔥 **本次題目核心考點：請根據以下參考講義內容設計**"
+    def on_loaded(count: int):
+        if progress:
+            progress(files_total=len(files), files_loaded=count)
 
-        final_system_prompt = f"""
-{sys_role}
-{task_instruction}
-{core_point}
-(Please design the question around the core concept above.)
-{system_instruction}
-請以 JSON 格式回傳：
-{{ "question_content": "Question content (Markdown)...", "hint": "Hint for students...", "target_filename": "AI選擇的檔案名稱" }}
-"""
-        user_prompt_text = f"參考講義內容：\n{context_text}"
+    # 讀取所有檔案：檔案數大於 1 且啟用行程池時平行讀取，否則逐一讀取
+    on_loaded(0)
+    if LOADER_MODE == "process" and LOADER_WORKERS > 1 and len(files) > 1:
+        loaded = load_files_parallel(files, on_loaded)
+    else:
+        loaded = []
+        for name, data in files:
+            loaded.append(load_file_bytes(name, data))
+            on_loaded(len(loaded))
 
-        # 8. 呼叫 GPT-4o 生成題目
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": final_system_prompt}, 
-                {"role": "user", "content": user_prompt_text}
-            ],
-            response_format={"type": "json_object"}, # 強制回傳 JSON
-            temperature=0.7 # 保持一點創造力
-        )
-        
-        # 設定背景清理任務 (刪除暫存檔，包含複製出來的 zip 和解壓資料夾)
-        background_tasks.add_task(cleanup_files, [zip_source_path], [extract_folder])
-        
-        # 回傳生成的 JSON
-        return json.loads(response.choices[0].message.content)
+    all_documents = []  # 用於存放所有讀取到的文件
+    for (rel_path, _), docs in zip(files, loaded):
+        # 為讀取到的文件加入 Metadata (元數據)，這對 RAG 溯源很重要
+        # rel_path 為 ZIP 內的相對路徑 (例如: "subfolder/doc.pdf")
+        for d in docs:
+            d.metadata["filename"] = os.path.basename(rel_path)  # 紀錄檔名
+            d.metadata["source"] = rel_path                       # 紀錄相對路徑來源
+        # 將處理好的文件加入總列表
+        all_documents.extend(docs)
 
-    except Exception as e:
-        # 發生錯誤時清理
-        cleanup_files([zip_source_path], [extract_folder])
-        return JSONResponse(status_code=500, content={"error": str(e)})
+    return all_documents
 
+# --- [新增] 共通函數：切分文件並在向量化之前去除重複的 Chunk ---
+# 講義包常同時附上 PDF 與 DOCX 版本的相同投影片，重複的 Chunk 只需向量化與存入索引一次
+# CHUNK_DEDUP: 設為 0 時停用去重
+# CHUNK_NEAR_DUP_PERCENT: MinHash 估計的相似度 (Jaccard) 達到此百分比時視為近似重複
+CHUNK_DEDUP = os.getenv("CHUNK_DEDUP", "1") != "0"
+CHUNK_NEAR_DUP_PERCENT = env_int("CHUNK_NEAR_DUP_PERCENT", 90)
+MINHASH_PERMUTATIONS = 64                # MinHash 簽章長度
+MINHASH_BANDS = 16                       # LSH 分段數 (每段 4 個值)，至少一段完全相同的 Chunk 才進一步比對
+MINHASH_PRIME = (1 << 32) + 15          # 大於 CRC32 值域的質數 (a * h + b 不會超出 uint64)
+MINHASH_SEED = 20240917                  # 固定種子：同一份講義每次建庫的結果相同
+CHUNKS_DEDUPLICATED = METRICS.add("rag_chunks_deduplicated_total",
+                                  "Chunks collapsed into an earlier chunk before embedding", "counter", ("kind",))
 
-# =========================================================
-# [新增] API 4: 智慧評分 (Grade Submission)
-# 邏輯：優先使用上傳的檔案，若無則使用伺服器上的 'rag_db.zip'
-# =========================================================
-@app.post("/api/grade_submission")
-async def grade_submission_with_upload(
-    background_tasks: BackgroundTasks,
-    file: Optional[UploadFile] = File(None), # [關鍵修改] 檔案為可選 (Optional)
-    question_text: str = Form(...),    # 題目內容
-    student_answer: str = Form(...),   # 學生回答
-    qtype: str = Form(...)             # 題型
-):
+def split_documents(documents: List[Document]) -> List[Document]:
     """
-    【評分 API】
-    1. 依據上傳或預設的 ZIP 準備評分標準庫。
-    2. 根據「題目內容」檢索相關講義 (Context)。
-    3. 呼叫 GPT-4o 進行評分。
+    切分文件：每塊 1000 字元，重疊 200 字元 (建庫、現場建庫與增量更新共用)
     """
-    # 檢查 API Key
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key: return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    chunks = text_splitter.split_documents(documents)
+    # [新增] 記錄每個 Chunk 在來源檔案中的順序 (增量更新時依此還原完整重建的 Chunk 順序)
+    counters: Dict[str, int] = {}
+    for chunk in chunks:
+        source = chunk.metadata.get("source")
+        chunk.metadata["chunk_index"] = counters.get(source, 0)
+        counters[source] = chunk.metadata["chunk_index"] + 1
+    return chunks
 
-    client = get_openai_client()
-    task_id = str(uuid.uuid4())
-    extract_folder = os.path.join(EXTRACT_DIR, task_id)
+def chunk_members(doc: Document) -> List[Document]:
+    """
+    還原合併前的 Chunk：主要的 Chunk 加上 metadata["duplicates"] 中被合併掉的每個重複 Chunk
+    (增量更新移除來源後，重新去重即可選出與完整重建相同的代表)
+    """
+    duplicates = doc.metadata.get("duplicates") or []
+    metadata = {k: v for k, v in doc.metadata.items() if k not in ("sources", "duplicates")}
+    return [Document(page_content=doc.page_content, metadata=metadata)] + [
+        Document(page_content=d["page_content"], metadata=d["metadata"]) for d in duplicates
+    ]
 
-    # === [關鍵邏輯] 決定使用哪個 ZIP 檔案來源 ===
-    zip_source_path = ""
-    
-    if file:
-        print(f"收到使用者上傳評分參考檔: {file.filename}")
-        zip_source_path = os.path.join(UPLOAD_DIR, f"{task_id}_{file.filename}")
-        with open(zip_source_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+def chunk_sources(doc: Document) -> List[str]:
+    """
+    回傳 Chunk 的所有來源 (合併過的重複 Chunk 會在 metadata["sources"] 列出每個來源，第一個為主要來源)
+    """
+    sources = doc.metadata.get("sources")
+    if sources:
+        return list(sources)
+    source = doc.metadata.get("source")
+    return [source] if source is not None else []
+
+def source_filenames(docs: List[Document]) -> List[str]:
+    """
+    回傳參考資料的檔名 (去重複)，包含重複 Chunk 被合併掉的其他來源
+    """
+    names = set()
+    for doc in docs:
+        names.add(doc.metadata.get("filename", "unknown"))
+        names.update(os.path.basename(s) for s in doc.metadata.get("sources") or [])
+    return list(names)
+
+def restrict_sources(doc: Document, sources: List[str]) -> Document:
+    """
+    只保留指定的來源 (增量更新移除來源時使用)；主要來源被移除時，改由下一個來源代表
+    頁碼等屬於原主要來源的欄位一併移除
+    """
+    if sources == chunk_sources(doc):
+        return doc
+    metadata = dict(doc.metadata)
+    if metadata.get("source") not in sources:
+        metadata = {k: v for k, v in metadata.items() if k not in ("page", "title")}
+        metadata["source"] = sources[0]
+        metadata["filename"] = os.path.basename(sources[0])
+    if len(sources) > 1:
+        metadata["sources"] = sources
     else:
-        default_zip = "rag_db.zip"
-        if os.path.exists(default_zip):
-            print(f"使用伺服器預設檔案評分: {default_zip}")
-            zip_source_path = os.path.join(UPLOAD_DIR, f"{task_id}_default.zip")
-            shutil.copy(default_zip, zip_source_path) # 複製一份，確保執行緒安全
-        else:
-            return JSONResponse(status_code=400, content={"error": "未上傳檔案，且伺服器找不到預設的 rag_db.zip"})
+        metadata.pop("sources", None)
+    return Document(page_content=doc.page_content, metadata=metadata)
 
-    try:
-        if not zipfile.is_zipfile(zip_source_path):
-             return JSONResponse(status_code=400, content={"error": "無效的 ZIP 檔"})
-
-        # 2. 解壓縮
-        with zipfile.ZipFile(zip_source_path, 'r') as zip_ref:
-            zip_ref.extractall(extract_folder)
-
-        # 3. 偵測並載入向量資料庫
-        is_rag_db = False
-        db_folder = None
-        for root, _, files in os.walk(extract_folder):
-            if "index.faiss" in files and "index.pkl" in files:
-                is_rag_db = True
-                db_folder = root
-                break
-        
-        embeddings = OpenAIEmbeddings(model="text-embedding-3-large", api_key=api_key)
+@functools.lru_cache(maxsize=None)
+def minhash_params():
+    """
+    MinHash 的雜湊參數 (a, b)，第一次使用時才產生 (NumPy 延遲載入)
+    """
+    rng = np.random.default_rng(MINHASH_SEED)
+    return (rng.integers(1, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64),
+            rng.integers(0, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64))
 
-        if is_rag_db:
-            vectorstore = FAISS.load_local(db_folder, embeddings, allow_dangerous_deserialization=True)
-        else:
-            all_documents = process_zip_to_docs(zip_source_path, extract_folder)
-            if not all_documents:
-                return JSONResponse(status_code=400, content={"error": "Zip 內無支援的講義文件"})
-            text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            split_docs = text_splitter.split_documents(all_documents)
-            vectorstore = FAISS.from_documents(split_docs, embeddings)
+def minhash_signature(text: str) -> np.ndarray:
+    """
+    以字元 5-gram (中英文皆適用，不需斷詞) 計算 MinHash 簽章
+    """
+    compact = "".join(text.split())
+    grams = {compact[i:i + 5] for i in range(max(1, len(compact) - 4))}
+    hashes = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+    a, b = minhash_params()
+    return ((np.outer(hashes, a) + b) % np.uint64(MINHASH_PRIME)).min(axis=0)
 
-        # 4. RAG 檢索 (Retrieval) - 用「題目」去撈出「標準答案/相關概念」作為評分依據 (Context)
-        # 這樣 AI 才能根據講義內容評分，而不只是根據通用知識
-        query = question_text
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 5})
-        docs = retriever.invoke(query)
-        context_text = "\n\n".join([d.page_content for d in docs])
-
-        # 5. 判斷題型並設定 Prompt
-        is_conceptual = any(k in qtype for k in ["簡答", "Short Answer", "Intro"])
-        
-        if is_conceptual:
-            # 情境 A：觀念簡答題 Prompt
-            prompt = f"""你是一位空間分析助教。請批改這道**「觀念簡答題」**。
-目標：評估學生對 GIS 原理的理解、邏輯推演與解釋清晰度。
-【重要限制】
-1. **請務必使用繁體中文 (Traditional Chinese) 撰寫所有評語、優點、弱點與行動建議。**
-2. 若參考資料為英文，請自行翻譯並內化成中文回饋。
-【評分標準】A) 概念正確性 (3分), B) 邏輯與解釋 (4分), C) 完整性 (3分)。
-【輸出 JSON】{{ "score": int, "level": str, "rubric": [], "strengths": [], "weaknesses": [], "missing_items": [], "action_items": [] }}
-[題目] {question_text}
-[學生回答] {student_answer}
-[講義依據] {context_text}"""
+def dedup_chunks(docs: List[Document]):
+    """
+    去除重複的 Chunk：先比對正規化空白後的內容雜湊 (完全相同)，再以 MinHash + LSH 找出近似重複
+    重複的 Chunk 合併進第一次出現的 Chunk，其 metadata["sources"] 列出每個來源，
+    metadata["duplicates"] 保存被合併掉的 Chunk (內容與 metadata，增量更新時用來重新選出代表)
+    回傳 (保留的 Chunk, 保留的 Chunk 在 docs 中的位置, 統計數據)
+    """
+    stats = {"chunks_exact_duplicates": 0, "chunks_near_duplicates": 0}
+    if not CHUNK_DEDUP:
+        return list(docs), list(range(len(docs))), stats
+
+    rows = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    kept: List[Document] = []
+    positions: List[int] = []
+    signatures: List[np.ndarray] = []
+    by_hash: Dict[str, int] = {}
+    buckets: Dict[tuple, List[int]] = {}
+    for position, doc in enumerate(docs):
+        normalized = " ".join(doc.page_content.split())
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        target = by_hash.get(digest)
+        if target is not None:
+            stats["chunks_exact_duplicates"] += 1
         else:
-            # 情境 B：實作題 Prompt (預設)
-            prompt = f"""你是一位空間分析助教。請批改這道**「R 語言實作題」**。
-目標：評估 R 程式碼的正確性、可重現性與空間邏輯。
-【重要限制】
-1. **請務必使用繁體中文 (Traditional Chinese) 撰寫所有評語、優點、弱點與行動建議。**
-2. 若參考資料為英文，請自行翻譯並內化成中文回饋。
-【評分標準】A) 需求覆蓋 (3分), B) 空間邏輯 (4分), C) R 程式嚴謹度 (3分)。
-【輸出 JSON】{{ "score": int, "level": str, "rubric": [], "strengths": [], "weaknesses": [], "missing_items": [], "action_items": [] }}
-[題目] {question_text}
-[學生回答] {student_answer}
-[講義依據] {context_text}"""
+            signature = minhash_signature(normalized)
+            bands = [(b, signature[b * rows:(b + 1) * rows].tobytes()) for b in range(MINHASH_BANDS)]
+            for candidate in sorted({i for band in bands for i in buckets.get(band, ())}):
+                if np.count_nonzero(signatures[candidate] == signature) * 100 >= CHUNK_NEAR_DUP_PERCENT * MINHASH_PERMUTATIONS:
+                    target = candidate
+                    stats["chunks_near_duplicates"] += 1
+                    break
+            if target is None:
+                by_hash[digest] = len(kept)
+                for band in bands:
+                    buckets.setdefault(band, []).append(len(kept))
+                signatures.append(signature)
+                kept.append(doc)
+                positions.append(position)
+                continue
 
-        # 6. 呼叫 OpenAI 進行評分
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"},
-            temperature=0.3 # 評分建議使用低溫度，保持客觀一致
-        )
-        
-        # 設定背景清理任務
-        background_tasks.add_task(cleanup_files, [zip_source_path], [extract_folder])
-        
-        # 回傳 JSON 結果
-        return json.loads(response.choices[0].message.content)
+        # 合併來源 (不修改原本的 Document，其 metadata 可能與其他物件共用)
+        first = kept[target]
+        sources = chunk_sources(first)
+        sources += [s for s in chunk_sources(doc) if s not in sources]
+        metadata = {**first.metadata, "duplicates": list(first.metadata.get("duplicates") or []) + [
+            {"page_content": doc.page_content, "metadata": doc.metadata}]}
+        if len(sources) > 1:
+            metadata["sources"] = sources
+        kept[target] = Document(page_content=first.page_content, metadata=metadata)
 
-    except Exception as e:
-        # 發生錯誤時清理
-        cleanup_files([zip_source_path], [extract_folder])
-        return JSONResponse(status_code=500, content={"error": str(e)})
\ No newline at end of file
+    for kind, key in (("exact", "chunks_exact_duplicates"), ("near", "chunks_near_duplicates")):
+        if stats[key]:
+            CHUNKS_DEDUPLICATED.inc(stats[key], kind=kind)
+    log_event("chunk_dedup", chunks=len(docs), kept=len(kept), **stats)
+    return kept, positions, stats
+
+# --- [新增] 可回報使用量的 HTTP 傳輸層 ---
+class _CountingStream(httpx.SyncByteStream):
+    """
+    包裝回應內容的串流，在回應關閉 (內容讀完) 時通知傳輸層，讓串流回應也能正確計入使用中
+    """
+    def __init__(self, stream, on_close: Callable[[], None]):
+        self._stream = stream
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self):
+        yield from self._stream
+
+    def close(self):
+        try:
+            self._stream.close()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._on_close()
+
+class PoolTransport(httpx.HTTPTransport):
+    """
+    httpx 的連線池傳輸層，額外記錄請求數、進行中的請求數與連線池狀態
+    """
+    def __init__(self, limits: httpx.Limits):
+        super().__init__(limits=limits)
+        self.limits = limits
+        self._lock = threading.Lock()
+        self.requests_total = 0  # 累計送出的請求數
+        self.in_flight = 0       # 目前進行中的請求數
+        self.peak_in_flight = 0  # 進行中請求數的最高紀錄
+
+    def _release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        with self._lock:
+            self.requests_total += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            response = super().handle_request(request)
+        except BaseException:
+            self._release()
+            raise
+        response.stream = _CountingStream(response.stream, self._release)
+        return response
+
+    def stats(self) -> dict:
+        # httpcore 連線池的 connections 列出目前所有連線 (含閒置的 keep-alive 連線)
+        connections = list(getattr(self._pool, "connections", []))
+        idle = sum(1 for c in connections if c.is_idle())
+        with self._lock:
+            return {
+                "max_connections": self.limits.max_connections,
+                "max_keepalive_connections": self.limits.max_keepalive_connections,
+                "connections": len(connections),
+                "idle_connections": idle,
+                "active_connections": len(connections) - idle,
+                "utilisation": (len(connections) - idle) / self.limits.max_connections if self.limits.max_connections else 0.0,
+                "requests_total": self.requests_total,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+            }
+
+# --- [新增] 應用程式層級共用的 OpenAI 客戶端 ---
+# OPENAI_TIMEOUT: 單次請求逾時秒數；OPENAI_MAX_RETRIES: SDK 自動重試次數 (含指數退避)
+# OPENAI_POOL_MAX_CONNECTIONS / OPENAI_POOL_MAX_KEEPALIVE / OPENAI_KEEPALIVE_EXPIRY: 連線池大小與閒置連線保留秒數
+OPENAI_TIMEOUT = env_int("OPENAI_TIMEOUT", 120)
+OPENAI_MAX_RETRIES = env_int("OPENAI_MAX_RETRIES", 3)
+# EMBED_CHECK_CTX_LENGTH: 設為 0 時 LangChain 不先以 tiktoken 切 token (Chunk 只有 1000 字元，不會超過模型上限；
+# 離線環境無法下載 tiktoken 編碼檔時使用，例如測試)
+EMBED_CHECK_CTX_LENGTH = os.getenv("EMBED_CHECK_CTX_LENGTH", "1") != "0"
+
+class OpenAIClients:
+    """
+    整個應用程式共用同一組 OpenAI / Embeddings / Chat 客戶端與 HTTP 連線池
+    避免每個請求都重新建立物件並重新進行 TLS 交握
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._api_key: Optional[str] = None
+        self.transport: Optional[PoolTransport] = None
+        self.http_client: Optional[httpx.Client] = None
+        self._client: Optional[OpenAI] = None
+        self._embeddings: Dict[tuple, OpenAIEmbeddings] = {}
+
+    def _ensure(self, api_key: str):
+        """
+        第一次使用 (或 API Key 變更) 時建立連線池與客戶端
+        """
+        if self._api_key == api_key and self.http_client is not None:
+            return
+        with self._lock:
+            if self._api_key == api_key and self.http_client is not None:
+                return
+            old_http = self.http_client
+            limits = httpx.Limits(
+                max_connections=env_int("OPENAI_POOL_MAX_CONNECTIONS", 100),
+                max_keepalive_connections=env_int("OPENAI_POOL_MAX_KEEPALIVE", 20),
+                keepalive_expiry=env_int("OPENAI_KEEPALIVE_EXPIRY", 30),
+            )
+            self.transport = PoolTransport(limits)
+            self.http_client = httpx.Client(transport=self.transport, timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10))
+            self._client = OpenAI(
+                api_key=api_key,
+                base_url=os.getenv("OPENAI_BASE_URL") or None,
+                http_client=self.http_client,
+                max_retries=OPENAI_MAX_RETRIES,
+                timeout=OPENAI_TIMEOUT,
+            )
+            self._embeddings = {}
+            self._api_key = api_key
+            if old_http is not None:
+                old_http.close()
+
+    def client(self, api_key: str) -> OpenAI:
+        self._ensure(api_key)
+        return self._client
+
+    def cached(self, api_key: str) -> Optional[OpenAI]:
+        """
+        已建立 (且 API Key 相同) 時回傳客戶端，否則回傳 None (不會匯入套件或建立連線池)
+        """
+        client = self._client
+        return client if client is not None and self._api_key == api_key else None
+
+    def embeddings(self, api_key: str, model: str, dimensions: Optional[int] = None) -> OpenAIEmbeddings:
+        """
+        共用的 OpenAIEmbeddings (使用同一個連線池)，依 (模型, 輸出維度) 各建一個
+        """
+        self._ensure(api_key)
+        key = (model, dimensions)
+        with self._lock:
+            if key not in self._embeddings:
+                self._embeddings[key] = OpenAIEmbeddings(
+                    model=model,
+                    dimensions=dimensions,
+                    api_key=api_key,
+                    base_url=os.getenv("OPENAI_BASE_URL") or None,
+                    http_client=self.http_client,
+                    max_retries=0,  # 由 CachedEmbeddings 退避重試，不與 SDK 的重試疊加
+                    check_embedding_ctx_length=EMBED_CHECK_CTX_LENGTH,
+                    timeout=OPENAI_TIMEOUT,
+                )
+            return self._embeddings[key]
+
+    def close(self):
+        with self._lock:
+            if self.http_client is not None:
+                self.http_client.close()
+            self.http_client, self._client, self._api_key = None, None, None
+
+    def stats(self) -> dict:
+        transport = self.transport
+        stats = transport.stats() if transport else {"connections": 0, "requests_total": 0, "in_flight": 0}
+        stats.update({"timeout": OPENAI_TIMEOUT, "max_retries": OPENAI_MAX_RETRIES})
+        return stats
+
+# 建立全域共用的客戶端實例
+OPENAI_CLIENTS = OpenAIClients()
+
+# --- [修改] 輔助函數：取得 OpenAI Client ---
+def get_openai_client():
+    """
+    回傳應用程式共用的 OpenAI 原生客戶端 (不再每次呼叫都重新建立)
+    """
+    api_key = os.getenv("OPENAI_API_KEY")  # 從環境變數讀取 Key
+    if not api_key:
+        raise ValueError("未設定 OPENAI_API_KEY")  # 若無 Key 則報錯
+    return OPENAI_CLIENTS.client(api_key)  # 回傳共用的 Client 物件
+
+async def resolve_openai_client() -> OpenAI:
+    """
+    [新增] 在事件迴圈中取得共用客戶端：已建立時直接回傳
+    否則 (暖機尚未完成) 在 llm 階段的執行緒池中匯入 openai 並建立，不阻塞事件迴圈
+    """
+    client = OPENAI_CLIENTS.cached(os.getenv("OPENAI_API_KEY"))
+    if client is not None:
+        return client
+    return await STAGES["llm"].run(get_openai_client)
+
+# --- [新增] 輔助函數：呼叫 Chat Completions 並記錄耗時與 token 用量 ---
+def record_llm_usage(model: str, usage):
+    """
+    將 OpenAI 回傳的 usage 計入 token 指標並輸出一行日誌
+    """
+    if usage is None:
+        return
+    prompt_tokens = usage.prompt_tokens or 0
+    completion_tokens = usage.completion_tokens or 0
+    endpoint = REQUEST_ENDPOINT.get()
+    LLM_TOKENS.inc(prompt_tokens, endpoint=endpoint, model=model, kind="prompt")
+    LLM_TOKENS.inc(completion_tokens, endpoint=endpoint, model=model, kind="completion")
+    log_event("llm_usage", model=model, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+def chat_completion(client: OpenAI, **kwargs):
+    """
+    呼叫 Chat Completions (阻塞，交給 llm 階段的執行緒池執行)，並記錄 llm 階段耗時與 token 用量
+    """
+    with timed_stage("llm"):
+        response = client.chat.completions.create(**kwargs)
+    record_llm_usage(kwargs.get("model", ""), getattr(response, "usage", None))
+    return response
+
+# --- [修改] 輔助函數：計算上傳檔的 SHA-256 ---
+def hash_upload(upload: UploadFile) -> str:
+    """
+    以串流方式計算上傳檔案內容的 SHA-256 (不另外複製到暫存資料夾)
+    這個雜湊值就是 ZIP 的「內容指紋」，用來當作索引快取的 Key
+    """
+    sha = hashlib.sha256()
+    upload.file.seek(0)
+    for chunk in iter(lambda: upload.file.read(1024 * 1024), b""):  # 每次讀 1MB，避免大檔一次佔滿記憶體
+        sha.update(chunk)
+    upload.file.seek(0)  # 讀完後回到開頭，讓後續可以直接當作 ZIP 開啟
+    return sha.hexdigest()
+
+# --- [新增] 輔助函數：計算既有檔案的 SHA-256 ---
+def file_sha256(path: str) -> str:
+    """
+    計算硬碟上檔案的 SHA-256 (用於伺服器預設的 rag_db.zip)
+    """
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+# --- [新增] 自訂例外：使用者上傳的 ZIP 內容不合法 (對應 HTTP 400) ---
+class CorpusInputError(ValueError):
+    """
+    ZIP 格式錯誤或內容不含可用文件時拋出，端點會將其轉為 400 回應
+    """
+
+# --- [新增] 資料結構：準備好的語料庫 (向量庫 + GIS 檔案列表) ---
+class PreparedCorpus:
+    """
+    一份已經可以直接檢索的語料庫
+    fingerprint: ZIP 內容的 SHA-256
+    vectorstore: 載入或建立好的 FAISS 向量庫
+    gis_files: ZIP 內可用於出題的 GIS 檔名 (原本每次都要 os.walk 掃描)
+    size_bytes: 估計佔用的記憶體大小，供快取計算上限
+    """
+    def __init__(self, fingerprint: str, vectorstore, gis_files: List[str]):
+        self.fingerprint = fingerprint
+        self.vectorstore = vectorstore
+        self.gis_files = gis_files
+        self.size_bytes = estimate_vectorstore_bytes(vectorstore)
+
+def estimate_vectorstore_bytes(vectorstore) -> int:
+    """
+    粗估 FAISS 向量庫佔用的記憶體：向量 (float32) + 文件文字與 metadata
+    """
+    index = vectorstore.index
+    # 每個向量 d 維，每維 4 bytes；memory-map 的索引只計算實際佔用 heap 的部分
+    total = getattr(index, "resident_bytes", int(index.ntotal) * int(index.d) * 4)
+    total += getattr(vectorstore.docstore, "resident_bytes", 0)
+    for doc in getattr(vectorstore.docstore, "_dict", {}).values():
+        total += len(doc.page_content.encode("utf-8"))  # 文件內容
+        total += len(json.dumps(doc.metadata, ensure_ascii=False, default=str))  # metadata 粗估
+    return total
+
+# --- [新增] 內容定址的索引快取 (LRU + 記憶體上限) ---
+class IndexCache:
+    """
+    以 ZIP 內容的 SHA-256 為 Key，快取已經準備好的 PreparedCorpus
+    同一份課程 ZIP 重複上傳時，可直接跳過解壓縮、讀檔與 Embedding
+    超過筆數或記憶體上限時，淘汰最久未使用 (LRU) 的項目
+    """
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries  # 最多保留幾份語料庫
+        self.max_bytes = max_bytes      # 估計記憶體上限 (bytes)
+        self._entries: "OrderedDict[str, PreparedCorpus]" = OrderedDict()
+        self._lock = threading.Lock()   # 保護 _entries 與計數器
+        self._build_locks: Dict[str, threading.Lock] = {}  # 每個 Key 一把鎖，避免同一份 ZIP 被重複建立
+        self.current_bytes = 0
+        self.hits = 0       # 命中次數
+        self.misses = 0     # 未命中次數
+        self.evictions = 0  # 淘汰次數
+        self.on_evict: Optional[Callable[[str], None]] = None  # [新增] 淘汰時的通知 (用於清除檢索快取)
+
+    def _lookup(self, key: str) -> Optional[PreparedCorpus]:
+        # 呼叫端需持有 self._lock；命中時將該項目移到最新位置 (不計入命中率)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)  # 標記為最近使用
+        return entry
+
+    def get(self, key: str) -> Optional[PreparedCorpus]:
+        """
+        查詢快取，命中時將該項目移到最新位置
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: PreparedCorpus):
+        """
+        放入快取，並依筆數與記憶體上限淘汰舊項目
+        """
+        if entry.size_bytes > self.max_bytes:
+            # 單一語料庫就超過上限，不放入快取 (避免把其他項目全部擠掉)
+            log_event("index_cache_skip_oversized", fingerprint=key[:12], size_bytes=entry.size_bytes,
+                      max_bytes=self.max_bytes)
+            return
+        evicted_keys = []
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old.size_bytes
+            self._entries[key] = entry
+            self.current_bytes += entry.size_bytes
+            # 淘汰最久未使用的項目，直到符合上限
+            while self._entries and (len(self._entries) > self.max_entries or self.current_bytes > self.max_bytes):
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.size_bytes
+                self.evictions += 1
+                evicted_keys.append(evicted_key)
+        if self.on_evict:
+            for evicted_key in evicted_keys:
+                self.on_evict(evicted_key)
+
+    def evict(self, key: str) -> bool:
+        """
+        [新增] 移除指定的語料庫 (例如已註冊的語料庫被刪除)，回傳是否在快取中
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= entry.size_bytes
+        if entry is not None and self.on_evict:
+            self.on_evict(key)
+        return entry is not None
+
+    def get_or_build(self, key: str, builder: Callable[[], PreparedCorpus]) -> PreparedCorpus:
+        """
+        查詢快取，未命中時呼叫 builder 建立並放入快取
+        同一個 Key 同時有多個請求時，只有第一個會真的建立，其餘等待後直接命中
+        [修改] 每個請求只計一次：自己建立的算 miss，直接命中或等到其他請求建好的算 hit
+        """
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+        with build_lock:
+            # 取得鎖後再查一次 (可能已經被其他請求建立好了)
+            with self._lock:
+                entry = self._lookup(key)
+                if entry is not None:
+                    self.hits += 1
+                    return entry
+                self.misses += 1
+            try:
+                entry = builder()
+                self.put(key, entry)
+                return entry
+            finally:
+                with self._lock:
+                    self._build_locks.pop(key, None)
+
+    def stats(self) -> dict:
+        """
+        回傳快取統計數據，用於調整快取大小
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            }
+
+# 建立全域索引快取實例 (所有檢索端點共用)
+INDEX_CACHE = IndexCache(
+    max_entries=env_int("INDEX_CACHE_MAX_ENTRIES", 16),                  # 預設最多 16 份語料庫
+    max_bytes=env_int("INDEX_CACHE_MAX_MB", 1024) * 1024 * 1024,         # 預設 1GB
+)
+
+# --- [新增] 檢索結果快取 (查詢向量 + Top-K 段落) ---
+class RetrievalCache:
+    """
+    出題的檢索查詢完全由題型與難度決定，評分也會對同一題目重複檢索
+    以 (語料庫指紋, 查詢文字, k) 為 Key 快取 Top-K 段落，並以 (Embedding 模型與維度, 查詢文字) 為 Key 另外快取查詢向量
+    - 語料庫變更 (熱更新或被索引快取淘汰) 時只清除該語料庫的檢索結果，查詢向量仍可沿用
+    - 超過存活時間 (TTL) 的項目視為過期；超過筆數或大小上限時淘汰最久未使用 (LRU) 的項目
+    """
+    def __init__(self, max_entries: int, max_bytes: int, ttl_seconds: int):
+        self.max_entries = max_entries  # 檢索結果與查詢向量各自最多保留幾筆
+        self.max_bytes = max_bytes      # 估計大小上限 (bytes)
+        self.ttl_seconds = ttl_seconds  # 存活時間 (秒)
+        self._results: "OrderedDict[tuple, tuple]" = OrderedDict()  # Key -> (建立時間, 大小, 段落列表)
+        self._vectors: "OrderedDict[tuple, tuple]" = OrderedDict()  # (模型, 查詢文字) -> (建立時間, 大小, 向量)
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0            # 檢索結果命中次數
+        self.misses = 0          # 檢索結果未命中次數
+        self.vector_hits = 0     # 查詢向量命中次數 (省下一次 Embedding API 呼叫)
+        self.invalidations = 0   # 因語料庫變更而清除的項目數
+
+    def _lookup(self, table: OrderedDict, key):
+        # 呼叫端需持有 self._lock；過期的項目直接移除
+        entry = table.get(key)
+        if entry is None:
+            return None
+        created, size, value = entry
+        if self.ttl_seconds > 0 and time.time() - created > self.ttl_seconds:
+            del table[key]
+            self.current_bytes -= size
+            return None
+        table.move_to_end(key)
+        return value
+
+    def _store(self, table: OrderedDict, key, value, size: int):
+        # 呼叫端需持有 self._lock
+        old = table.pop(key, None)
+        if old is not None:
+            self.current_bytes -= old[1]
+        table[key] = (time.time(), size, value)
+        self.current_bytes += size
+        while table and (len(table) > self.max_entries or self.current_bytes > self.max_bytes):
+            _, (_, evicted_size, _) = table.popitem(last=False)
+            self.current_bytes -= evicted_size
+
+    def get(self, fingerprint: str, query: str, k: int) -> Optional[List[Document]]:
+        with self._lock:
+            docs = self._lookup(self._results, (fingerprint, query, k))
+            if docs is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return docs
+
+    def put(self, fingerprint: str, query: str, k: int, docs: List[Document]):
+        size = sum(len(d.page_content.encode("utf-8")) for d in docs)
+        with self._lock:
+            self._store(self._results, (fingerprint, query, k), docs, size)
+
+    def get_vector(self, model: str, query: str) -> Optional[List[float]]:
+        with self._lock:
+            vector = self._lookup(self._vectors, (model, query))
+            if vector is not None:
+                self.vector_hits += 1
+            return vector
+
+    def put_vector(self, model: str, query: str, vector: List[float]):
+        with self._lock:
+            self._store(self._vectors, (model, query), vector, len(vector) * 4)
+
+    def invalidate(self, fingerprint: str):
+        """
+        清除某份語料庫的所有檢索結果
+        """
+        with self._lock:
+            for key in [key for key in self._results if key[0] == fingerprint]:
+                _, size, _ = self._results.pop(key)
+                self.current_bytes -= size
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._results),
+                "vectors": len(self._vectors),
+                "max_entries": self.max_entries,
+                "current_bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "vector_hits": self.vector_hits,
+                "invalidations": self.invalidations,
+                "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            }
+
+# 建立全域檢索快取實例，並在索引快取淘汰語料庫時一併清除其檢索結果
+RETRIEVAL_CACHE = RetrievalCache(
+    max_entries=env_int("RETRIEVAL_CACHE_MAX_ENTRIES", 1024),
+    max_bytes=env_int("RETRIEVAL_CACHE_MAX_MB", 64) * 1024 * 1024,       # 預設 64MB
+    ttl_seconds=env_int("RETRIEVAL_CACHE_TTL", 3600),                    # 預設 1 小時
+)
+INDEX_CACHE.on_evict = RETRIEVAL_CACHE.invalidate
+
+# --- [新增] 分階段的並行限制與背壓 (ingest / embed / llm) ---
+class StageOverloaded(Exception):
+    """
+    某個處理階段已滿載時拋出，端點會轉為 429 (排隊已滿) 或 503 (等待逾時) 回應
+    """
+    def __init__(self, stage: str, status_code: int, message: str):
+        super().__init__(message)
+        self.stage = stage
+        self.status_code = status_code
+
+class StageLimiter:
+    """
+    限制單一處理階段 (例如 LLM 呼叫) 同時執行的數量
+    concurrency: 同時執行的上限
+    max_waiting: 最多允許幾個請求排隊等待，超過直接回 429，而不是無限排隊
+    wait_timeout: 排隊等待的秒數上限，逾時回 503
+    """
+    def __init__(self, name: str, concurrency: int, max_waiting: int, wait_timeout: int):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.max_waiting = max(0, max_waiting)
+        self.wait_timeout = wait_timeout
+        self._sem = threading.BoundedSemaphore(self.concurrency)
+        self._lock = threading.Lock()
+        self.active = 0    # 正在執行的數量
+        self.waiting = 0   # 正在排隊的數量
+        self.rejected = 0  # 因排隊已滿被拒絕 (429) 的次數
+        self.timeouts = 0  # 排隊逾時 (503) 的次數
+
+    def _admit(self, force: bool = False):
+        """
+        檢查是否還能排隊，可以的話登記為等待中 (force=True 時不檢查排隊上限)
+        """
+        with self._lock:
+            if not force and self.active >= self.concurrency and self.waiting >= self.max_waiting:
+                self.rejected += 1
+                raise StageOverloaded(self.name, 429, f"伺服器忙碌中 ({self.name} 排隊已滿)，請稍後再試")
+            self.waiting += 1
+
+    @contextlib.contextmanager
+    def slot(self, admitted: bool = False, wait: bool = False):
+        """
+        在目前執行緒取得一個執行名額 (可在已經位於執行緒池中的程式碼內使用，例如 Embedding)
+        wait=True: [新增] 不受排隊上限與等待逾時限制，一直等到有名額 (給已由自己的佇列限制數量的背景工作使用)
+        """
+        if not admitted:
+            self._admit(force=wait)
+        start = time.perf_counter()
+        try:
+            acquired = self._sem.acquire(timeout=None if wait else self.wait_timeout)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+            LIMITER_WAIT.observe(time.perf_counter() - start, limiter=self.name)
+        if not acquired:
+            with self._lock:
+                self.timeouts += 1
+            raise StageOverloaded(self.name, 503, f"伺服器忙碌中 ({self.name} 等待逾時)，請稍後再試")
+        with self._lock:
+            self.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.active -= 1
+            self._sem.release()
+
+    async def run(self, fn: Callable, *args, **kwargs):
+        """
+        在有上限的執行緒池中執行阻塞函數，事件迴圈不會被卡住
+        排隊已滿時立即拒絕 (不佔用執行緒)
+        """
+        self._admit()
+
+        def _call():
+            with self.slot(admitted=True):
+                return fn(*args, **kwargs)
+
+        loop = asyncio.get_running_loop()
+        ctx = contextvars.copy_context()  # 保留請求的 context (例如日誌用的 request id)
+        return await loop.run_in_executor(STAGE_EXECUTOR, functools.partial(ctx.run, _call))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "concurrency": self.concurrency,
+                "max_waiting": self.max_waiting,
+                "active": self.active,
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+            }
+
+def make_stage(name: str, concurrency: int, max_waiting: int, wait_timeout: int) -> StageLimiter:
+    """
+    依環境變數 STAGE_<NAME>_CONCURRENCY / _QUEUE / _TIMEOUT 建立階段限制
+    """
+    prefix = f"STAGE_{name.upper()}_"
+    return StageLimiter(
+        name,
+        concurrency=env_int(prefix + "CONCURRENCY", concurrency),
+        max_waiting=env_int(prefix + "QUEUE", max_waiting),
+        wait_timeout=env_int(prefix + "TIMEOUT", wait_timeout),
+    )
+
+# 各階段的並行上限：ingest = 讀取/建立語料庫，embed = 向量化與檢索，llm = GPT-4o 呼叫
+STAGES: Dict[str, StageLimiter] = {
+    "ingest": make_stage("ingest", concurrency=2, max_waiting=8, wait_timeout=60),
+    "embed": make_stage("embed", concurrency=8, max_waiting=32, wait_timeout=30),
+    "llm": make_stage("llm", concurrency=16, max_waiting=64, wait_timeout=30),
+}
+
+# 所有阻塞工作共用的執行緒池：大小足以容納各階段「執行中 + 排隊中」的總數
+STAGE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=sum(st.concurrency + st.max_waiting for st in STAGES.values()),
+    thread_name_prefix="stage",
+)
+
+def overloaded_response(e: StageOverloaded) -> JSONResponse:
+    """
+    將 StageOverloaded 轉為 429/503 回應，並附上 Retry-After 提示前端稍後重試
+    """
+    return JSONResponse(status_code=e.status_code, content={"error": str(e)}, headers={"Retry-After": "5"})
+
+# --- [新增] 暫存空間管理：每個請求一個資料夾、總量上限、小檔放 RAM、清理孤兒資料夾 ---
+# WORKSPACE_QUOTA_MB: 硬碟暫存空間的總上限 (超過時新的請求回 503)
+# WORKSPACE_RAM_DIR / WORKSPACE_RAM_QUOTA_MB / WORKSPACE_RAM_MAX_MB: RAM (tmpfs) 暫存空間的位置、總上限與單一請求上限
+#   (WORKSPACE_RAM_DIR 設為空字串時停用)
+# WORKSPACE_BUILD_FACTOR: 建庫時預留的空間為上傳檔大小的幾倍 (向量通常比原始文字大得多)
+# WORKSPACE_ORPHAN_SECONDS: 不屬於任何進行中請求的資料夾超過此秒數即由清理執行緒刪除
+# WORKSPACE_STREAM_SECONDS: 交給串流回應的資料夾最長保留秒數 (用戶端中途斷線時由清理執行緒釋放)
+WORKSPACE_QUOTA_BYTES = env_int("WORKSPACE_QUOTA_MB", 4096) * 1024 * 1024
+WORKSPACE_RAM_DIR = os.getenv("WORKSPACE_RAM_DIR", "/dev/shm" if os.path.isdir("/dev/shm") else "")
+WORKSPACE_RAM_QUOTA_BYTES = env_int("WORKSPACE_RAM_QUOTA_MB", 256) * 1024 * 1024
+WORKSPACE_RAM_MAX_BYTES = env_int("WORKSPACE_RAM_MAX_MB", 32) * 1024 * 1024
+WORKSPACE_BUILD_FACTOR = env_int("WORKSPACE_BUILD_FACTOR", 8)
+WORKSPACE_ORPHAN_SECONDS = env_int("WORKSPACE_ORPHAN_SECONDS", 600)
+WORKSPACE_STREAM_SECONDS = env_int("WORKSPACE_STREAM_SECONDS", 3600)  # 串流下載最長可使用暫存資料夾的秒數
+WORKSPACE_BYTES = METRICS.add("rag_workspace_bytes", "Bytes reserved or used by live temp workspaces", "gauge", ("medium",))
+WORKSPACE_REJECTED = METRICS.add("rag_workspace_rejected_total", "Requests rejected because the temp workspace quota was full",
+                                 "counter", ("medium",))
+
+def dir_size(path: str) -> int:
+    """
+    回傳資料夾內所有檔案的大小總和 (找不到時為 0)
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def upload_size(upload: UploadFile) -> int:
+    """
+    回傳上傳檔案的大小 (不讀取內容)
+    """
+    upload.file.seek(0, os.SEEK_END)
+    size = upload.file.tell()
+    upload.file.seek(0)
+    return size
+
+class Workspace:
+    """
+    一個請求 (或非同步工作) 專用的暫存資料夾
+    以 with 使用時離開區塊就會釋放 (包含提早 return 與例外)；
+    若內容要在回應之後繼續使用 (例如串流下載)，呼叫 detach() 把釋放的責任交給背景任務
+    """
+    def __init__(self, manager: WorkspaceManager, path: str, medium: str, reserved: int):
+        self.manager = manager
+        self.path = path
+        self.medium = medium          # disk 或 ram
+        self.reserved = reserved      # 預留的空間 (bytes)
+        self.created = time.time()
+        self.expires: Optional[float] = None  # detach 後的最長保留時間，逾時由清理執行緒釋放
+        self.released = False
+        self.pins = 0  # [新增] 正在使用內容的下載數 (大於 0 時清理執行緒不會因逾時而釋放)
+
+    def file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def detach(self, ttl_seconds: float) -> Workspace:
+        self.expires = time.time() + ttl_seconds
+        return self
+
+    def release(self):
+        self.manager.release(self)
+
+    def pin(self) -> bool:
+        """
+        [新增] 標記內容正在被使用 (例如串流下載中)；資料夾已釋放時回傳 False
+        """
+        with self.manager._lock:
+            if self.released:
+                return False
+            self.pins += 1
+            return True
+
+    def unpin(self):
+        with self.manager._lock:
+            self.pins -= 1
+
+    def __enter__(self) -> Workspace:
+        return self
+
+    def __exit__(self, *exc):
+        if self.expires is None:
+            self.release()
+
+class WorkspaceManager:
+    """
+    管理所有暫存資料夾：
+    - 取得資料夾前先預留空間，總量超過上限時拒絕 (StageOverloaded -> 503)，避免硬碟被塞滿
+    - 小於 ram_max_bytes 的請求優先放在 RAM (tmpfs)，不寫入硬碟
+    - 資料夾以「行程 ID-隨機碼」命名；清理執行緒會刪除已結束行程留下的資料夾與逾時的資料夾
+    """
+    def __init__(self, root: str, ram_root: Optional[str], quota_bytes: int, ram_quota_bytes: int,
+                 ram_max_bytes: int, orphan_seconds: int):
+        self.roots = {"disk": root}
+        os.makedirs(root, exist_ok=True)
+        if ram_root:
+            try:
+                os.makedirs(ram_root, exist_ok=True)
+                self.roots["ram"] = ram_root
+            except OSError as e:
+                log_event("workspace_ram_unavailable", path=ram_root, error=str(e))  # 改用硬碟
+        self.quotas = {"disk": quota_bytes, "ram": ram_quota_bytes}
+        self.ram_max_bytes = ram_max_bytes
+        self.orphan_seconds = orphan_seconds
+        self._live: Dict[str, Workspace] = {}
+        self._lock = threading.Lock()
+        self._janitor: Optional[threading.Thread] = None
+        self.rejected = 0
+        self.orphans_removed = 0
+
+    def _used(self, medium: str) -> int:
+        # 呼叫端需持有 _lock
+        return sum(ws.reserved for ws in self._live.values() if ws.medium == medium)
+
+    def acquire(self, kind: str, reserve: int = 0, allow_ram: bool = True) -> Workspace:
+        """
+        預留 reserve bytes 並建立暫存資料夾；空間不足時拋出 StageOverloaded
+        """
+        with self._lock:
+            medium = "disk"
+            if (allow_ram and "ram" in self.roots and reserve <= self.ram_max_bytes
+                    and self._used("ram") + reserve <= self.quotas["ram"]):
+                medium = "ram"
+            elif self._used("disk") + reserve > self.quotas["disk"]:
+                self.rejected += 1
+                WORKSPACE_REJECTED.inc(medium="disk")
+                raise StageOverloaded("workspace", 503, "伺服器暫存空間不足，請稍後再試")
+            name = f"{os.getpid()}-{kind}-{uuid.uuid4().hex[:12]}"
+            path = os.path.join(self.roots[medium], name)
+            os.makedirs(path)
+            ws = Workspace(self, path, medium, reserve)
+            self._live[path] = ws
+        return ws
+
+    def release(self, ws: Workspace):
+        with self._lock:
+            if ws.released:
+                return
+            ws.released = True
+            self._live.pop(ws.path, None)
+        shutil.rmtree(ws.path, ignore_errors=True)
+
+    def purge(self, startup: bool = False):
+        """
+        釋放逾時的資料夾，並刪除不屬於任何進行中請求的孤兒資料夾：
+        - 名稱中的行程已不存在 (例如當機或重新啟動前留下的)
+        - 本行程的資料夾但已不在使用中，且超過 orphan_seconds
+        - 舊版留下的 uploads/outputs 等其他項目 (啟動時一律刪除，之後超過 orphan_seconds 才刪)
+        """
+        now = time.time()
+        with self._lock:
+            live = list(self._live.values())
+        for ws in live:
+            if ws.expires is not None and ws.expires < now and ws.pins == 0:
+                log_event("workspace_expired", path=ws.path)
+                self.release(ws)
+            else:
+                # 預留量只是估計，以實際用量校正，總量上限才會反映真實的硬碟使用
+                ws.reserved = max(ws.reserved, dir_size(ws.path))
+
+        pid = os.getpid()
+        for medium, root in self.roots.items():
+            try:
+                entries = list(os.scandir(root))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                owner = entry.name.split("-", 1)[0]
+                if owner.isdigit() and int(owner) != pid and process_alive(int(owner)):
+                    continue  # 同一台機器上其他 worker 的資料夾
+                with self._lock:
+                    if entry.path in self._live:
+                        continue
+                try:
+                    age = now - entry.stat(follow_symlinks=False).st_mtime
+                except OSError:
+                    continue
+                stale = (owner.isdigit() and int(owner) != pid) or (startup and not owner.isdigit())
+                if not stale and age < self.orphan_seconds:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+                self.orphans_removed += 1
+                log_event("workspace_orphan_removed", path=entry.path, age=round(age, 1))
+
+    def start_janitor(self, interval: int = 60):
+        if self._janitor is not None:
+            return
+        self.purge(startup=True)
+
+        def _loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.purge()
+                except Exception as e:
+                    log_event("workspace_purge_failed", error=str(e))
+
+        self._janitor = threading.Thread(target=_loop, name="workspace-janitor", daemon=True)
+        self._janitor.start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            live = list(self._live.values())
+            stats = {
+                medium: {
+                    "root": root,
+                    "quota_bytes": self.quotas[medium],
+                    "reserved_bytes": sum(ws.reserved for ws in live if ws.medium == medium),
+                    "workspaces": sum(1 for ws in live if ws.medium == medium),
+                }
+                for medium, root in self.roots.items()
+            }
+        stats.update({"ram_max_bytes": self.ram_max_bytes, "rejected": self.rejected,
+                      "orphans_removed": self.orphans_removed})
+        return stats
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # 行程存在但屬於其他使用者
+    return True
+
+# 建立全域暫存空間管理器 (RAM 暫存放在 tmpfs 下的專用資料夾)
+WORKSPACES = WorkspaceManager(
+    root=BASE_TEMP_DIR,
+    ram_root=os.path.join(WORKSPACE_RAM_DIR, "rag_workspaces") if WORKSPACE_RAM_DIR else None,
+    quota_bytes=WORKSPACE_QUOTA_BYTES,
+    ram_quota_bytes=WORKSPACE_RAM_QUOTA_BYTES,
+    ram_max_bytes=WORKSPACE_RAM_MAX_BYTES,
+    orphan_seconds=WORKSPACE_ORPHAN_SECONDS,
+)
+
+@app.on_event("startup")
+def start_workspace_janitor_on_startup():
+    WORKSPACES.start_janitor()
+
+# --- [新增] 持久化的 Chunk Embedding 快取 (SQLite) ---
+EMBEDDING_MODEL = "text-embedding-3-large"  # 全站使用的 Embedding 模型名稱
+EMBEDDING_DIM = 3072  # [新增] 模型預設輸出的向量維度 (可在建庫時指定較小的 dimensions)
+
+class EmbeddingStore:
+    """
+    以 (模型名稱, Chunk 文字的 SHA-256) 為 Key，把 Embedding 向量存在 SQLite
+    重新上傳稍作修改的講義包時，只有沒看過的 Chunk 才需要呼叫 OpenAI API
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()  # sqlite3 連線跨執行緒共用，需自行加鎖
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")  # 讀寫並行較佳，且寫入中斷不易損毀
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.commit()
+        self.reused = 0    # 累計直接沿用的 Chunk 數
+        self.embedded = 0  # 累計實際送去 API 的 Chunk 數
+
+    @staticmethod
+    def text_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        """
+        批次查詢向量，回傳 {text_hash: 向量}，查不到的不會出現在結果中
+        """
+        found: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(hashes))
+        with self._lock:
+            for i in range(0, len(unique), 500):  # SQLite 參數數量有上限，分批查詢
+                batch = unique[i:i + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *batch],
+                ).fetchall()
+                for text_hash, blob in rows:
+                    found[text_hash] = np.frombuffer(blob, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, items: Dict[str, List[float]]):
+        """
+        批次寫入向量 (以 float32 二進位保存)
+        """
+        rows = [(model, h, len(v), np.asarray(v, dtype=np.float32).tobytes()) for h, v in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def record(self, reused: int, embedded: int):
+        with self._lock:
+            self.reused += reused
+            self.embedded += embedded
+
+    def stats(self) -> dict:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            total = self.reused + self.embedded
+            return {
+                "path": self.db_path,
+                "stored_vectors": count,
+                "reused_chunks": self.reused,
+                "embedded_chunks": self.embedded,
+                "reuse_ratio": (self.reused / total) if total else 0.0,
+            }
+
+# 建立全域 Embedding 快取實例
+EMBEDDING_STORE = EmbeddingStore(os.path.join(CACHE_DIR, "embeddings.sqlite3"))
+
+# --- [新增] 並行、依 token 數打包的 Embedding 批次 ---
+# EMBED_BATCH_TOKENS: 每批最多的 token 數 (API 單次請求上限為 300k)；EMBED_BATCH_MAX_ITEMS: 每批最多的 Chunk 數
+# (不超過 LangChain 的 chunk_size，一批只發出一次請求)
+# EMBED_CONCURRENCY: 同時送出的批次數 (全站共用)；EMBED_BATCH_RETRIES: 遇到限流或暫時性錯誤時整批重試的次數
+EMBED_BATCH_TOKENS = env_int("EMBED_BATCH_TOKENS", 100000)
+EMBED_BATCH_MAX_ITEMS = env_int("EMBED_BATCH_MAX_ITEMS", 1000)
+EMBED_CONCURRENCY = env_int("EMBED_CONCURRENCY", 4)
+EMBED_BATCH_RETRIES = env_int("EMBED_BATCH_RETRIES", 5)
+EMBED_RETRY_MAX_DELAY = 60  # 退避等待的上限秒數
+EMBED_BATCH_RETRIED = METRICS.add("rag_embedding_batch_retries_total",
+                                  "Embedding batches retried after a rate limit or transient error", "counter", ("error",))
+EMBED_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, EMBED_CONCURRENCY), thread_name_prefix="embed-batch")
+
+def pack_batches(counts: List[int], max_tokens: int, max_items: int) -> List[List[int]]:
+    """
+    依 token 數把文字 (以位置表示) 依序打包成批次：每批不超過 max_tokens 與 max_items
+    單段就超過 max_tokens 的文字自成一批
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    tokens = 0
+    for i, count in enumerate(counts):
+        if current and (tokens + count > max_tokens or len(current) >= max_items):
+            batches.append(current)
+            current, tokens = [], 0
+        current.append(i)
+        tokens += count
+    if current:
+        batches.append(current)
+    return batches
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """
+    計算重試前的等待秒數：優先使用 API 回傳的 Retry-After，否則指數退避 (加上隨機抖動)
+    """
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after is not None:
+            return min(EMBED_RETRY_MAX_DELAY, max(0.0, float(retry_after)))
+    except ValueError:
+        pass
+    return min(EMBED_RETRY_MAX_DELAY, 2 ** attempt) * (0.5 + random.random() / 2)
+
+class CachedEmbeddings:
+    """
+    包裝 OpenAIEmbeddings：embed_documents 先查 EmbeddingStore，只把沒看過的 Chunk 送去 API
+    沒看過的 Chunk 依 token 數打包成批次並行送出，每批完成就寫入快取
+    (中途失敗時已完成的批次不會遺失，重新建庫只需補上剩下的批次)
+    每個實例各自記錄本次建庫沿用與新計算的數量，方便回報給呼叫端
+    重試由這一層負責 (底層客戶端 max_retries=0)，避免與 SDK 的自動重試疊加
+    """
+    def __init__(self, underlying: Embeddings, model: str, store: EmbeddingStore):
+        # 確保 Embeddings 介面已匯入 (觸發下方的虛擬子類別註冊)，不依賴暖機的順序
+        # 否則 LangChain FAISS 的 isinstance 檢查失敗時會把本物件當成函數呼叫
+        Embeddings.load()
+        self.underlying = underlying
+        self.model = model
+        self.store = store
+        self.reused = 0    # 本實例沿用快取的 Chunk 數
+        self.embedded = 0  # 本實例新計算的 Chunk 數
+
+    def embed_documents(self, texts: List[str],
+                        progress: Optional[Callable[[int], None]] = None) -> List[List[float]]:
+        """
+        progress: 可選的進度回報函數，每完成一批就以「已取得向量的文字數」呼叫一次
+        """
+        hashes = [EmbeddingStore.text_hash(t) for t in texts]
+        found = self.store.get_many(self.model, hashes)
+
+        # 找出快取中沒有的文字 (同一批內重複的文字只送一次)
+        missing: Dict[str, str] = {}
+        for h, t in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = t
+        reused = len(texts) - len(missing)
+        self.reused += reused
+        self.store.record(reused, 0)
+        if progress:
+            progress(reused)
+        if missing:
+            done = reused
+            for batch_hashes, vectors in self._embed_missing(missing):
+                found.update(zip(batch_hashes, vectors))
+                self.embedded += len(batch_hashes)
+                done += len(batch_hashes)
+                if progress:
+                    progress(done)
+        return [found[h] for h in hashes]
+
+    def _embed_missing(self, missing: Dict[str, str]):
+        """
+        依 token 數打包並行送出，依完成順序逐批產生 (hashes, 向量)
+        任一批重試後仍失敗時取消尚未開始的批次並拋出例外
+        """
+        items = list(missing.items())
+        counts = token_counts([t for _, t in items])
+        batches = pack_batches(counts, EMBED_BATCH_TOKENS, EMBED_BATCH_MAX_ITEMS)
+        log_event("embedding_batches", chunks=len(items), batches=len(batches), tokens=sum(counts))
+        futures = [
+            EMBED_EXECUTOR.submit(contextvars.copy_context().run, self._embed_batch,
+                                  [items[i] for i in batch], sum(counts[i] for i in batch))
+            for batch in batches
+        ]
+        try:
+            for future in as_completed(futures):
+                yield future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    @staticmethod
+    def _with_retries(call: Callable):
+        """
+        呼叫 Embedding API，遇到限流或暫時性錯誤時退避重試 (最多 EMBED_BATCH_RETRIES 次)
+        """
+        for attempt in range(EMBED_BATCH_RETRIES + 1):
+            try:
+                return call()
+            except (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError) as e:
+                if attempt >= EMBED_BATCH_RETRIES:
+                    raise
+                delay = retry_delay(e, attempt)
+                EMBED_BATCH_RETRIED.inc(error=type(e).__name__)
+                log_event("embedding_batch_retry", attempt=attempt + 1, delay=round(delay, 2), error=type(e).__name__)
+                time.sleep(delay)
+
+    def _embed_batch(self, batch: List[tuple], tokens: int):
+        """
+        送出一批 (遇到限流或暫時性錯誤時退避重試)，完成後立即寫入快取
+        """
+        texts = [t for _, t in batch]
+
+        def _call():
+            # 呼叫 Embedding API 前先取得 embed 階段的執行名額 (退避等待時不佔用名額)
+            with STAGES["embed"].slot():
+                return self.underlying.embed_documents(texts)
+        vectors = self._with_retries(_call)
+        EMBEDDING_TOKENS.inc(tokens, endpoint=REQUEST_ENDPOINT.get(), model=self.model)
+        hashes = [h for h, _ in batch]
+        self.store.put_many(self.model, dict(zip(hashes, vectors)))
+        self.store.record(0, len(batch))
+        return hashes, vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        # 問題向量不做持久快取，直接呼叫原始模型
+        vector = self._with_retries(lambda: self.underlying.embed_query(text))
+        self.record_tokens([text])
+        return vector
+
+    def record_tokens(self, texts: List[str]):
+        # [新增] 記錄實際送去 API 的 token 數 (快取命中的 Chunk 不計)
+        EMBEDDING_TOKENS.inc(count_tokens(texts), endpoint=REQUEST_ENDPOINT.get(), model=self.model)
+
+# 註冊為 Embeddings 的虛擬子類別，讓 LangChain FAISS 的 isinstance 檢查成立
+# (Embeddings 匯入時才註冊，不拖慢冷啟動；建立 CachedEmbeddings 時一定會先匯入)
+Embeddings.on_load(lambda base: base.register(CachedEmbeddings))
+
+def get_embeddings(api_key: str, dimensions: Optional[int] = None) -> CachedEmbeddings:
+    """
+    建立帶有持久快取的 Embedding 模型 (text-embedding-3-large，底層使用共用的客戶端與連線池)
+    dimensions: 縮減後的向量維度 (None 或 3072 表示使用完整維度)；不同維度的向量分開快取
+    """
+    if dimensions == EMBEDDING_DIM:
+        dimensions = None
+    cache_model = EMBEDDING_MODEL if dimensions is None else f"{EMBEDDING_MODEL}@{dimensions}"
+    return CachedEmbeddings(OPENAI_CLIENTS.embeddings(api_key, EMBEDDING_MODEL, dimensions), cache_model, EMBEDDING_STORE)
+
+# --- [新增] 輔助函數：直接從 ZIP 成員載入 FAISS 資料庫 ---
+def load_faiss_from_zip(zip_ref: zipfile.ZipFile, prefix: str, api_key: str) -> FAISS:
+    """
+    讀取 index.faiss 與 index.pkl 兩個成員並在記憶體中還原 FAISS 向量庫 (等同 FAISS.load_local)
+    注意：index.pkl 是 pickle 檔，與原本 allow_dangerous_deserialization=True 的行為相同
+    查詢用的 Embedding 維度依索引的維度決定 (建庫時可能指定了較小的 dimensions)
+    """
+    index_info = zip_ref.getinfo(prefix + "index.faiss")
+    pkl_info = zip_ref.getinfo(prefix + "index.pkl")
+    check_member_sizes([index_info, pkl_info])
+    index = faiss.deserialize_index(np.frombuffer(read_member(zip_ref, index_info), dtype=np.uint8))
+    docstore, index_to_docstore_id = pickle.loads(read_member(zip_ref, pkl_info))
+    return FAISS(get_embeddings(api_key, dimensions=int(index.d)), index, docstore, index_to_docstore_id)
+
+# --- [新增] 向量索引類型 (建庫時選擇，記錄在產出的索引中) ---
+# flat: 精確搜尋 (float32)；flat_f16: 精確搜尋 (float16，記憶體減半)
+# ivf: 倒排索引 (先找最近的群集再搜尋)；hnsw: 圖索引；pq: 乘積量化 (壓縮約 32 倍，近似距離)
+INDEX_TYPES = ("flat", "flat_f16", "ivf", "hnsw", "pq")
+INDEX_IVF_NPROBE = env_int("INDEX_IVF_NPROBE", 8)                # IVF 每次搜尋的群集數
+INDEX_HNSW_M = env_int("INDEX_HNSW_M", 32)                       # HNSW 每個節點的鄰居數
+INDEX_HNSW_EF_CONSTRUCTION = env_int("INDEX_HNSW_EF_CONSTRUCTION", 80)
+INDEX_HNSW_EF_SEARCH = env_int("INDEX_HNSW_EF_SEARCH", 64)
+
+def build_faiss_index(matrix: np.ndarray, index_type: str):
+    """
+    依索引類型建立 FAISS 索引並加入所有向量，回傳 (索引, 參數)
+    參數中的 type 為實際使用的類型：向量太少無法訓練 IVF/PQ 時退回 flat
+    搜尋參數 (nprobe / efSearch) 會隨 FAISS 索引一起序列化
+    """
+    n, d = matrix.shape
+    params: Dict[str, object] = {"type": index_type}
+    if index_type == "ivf" and n >= 39:
+        nlist = max(1, min(int(4 * n ** 0.5), n // 39))  # FAISS 建議每個群集至少 39 個訓練點
+        index = faiss.index_factory(d, f"IVF{nlist},Flat")
+        index.train(matrix)
+        faiss.extract_index_ivf(index).nprobe = min(nlist, INDEX_IVF_NPROBE)
+        params.update(nlist=nlist, nprobe=min(nlist, INDEX_IVF_NPROBE))
+    elif index_type == "pq" and n >= 256:
+        m = max(i for i in range(1, max(1, d // 8) + 1) if d % i == 0)  # 每個子向量約 8 維
+        index = faiss.index_factory(d, f"PQ{m}x8")
+        index.train(matrix)
+        params.update(m=m, nbits=8)
+    elif index_type == "hnsw":
+        index = faiss.index_factory(d, f"HNSW{INDEX_HNSW_M},Flat")
+        index.hnsw.efConstruction = INDEX_HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = INDEX_HNSW_EF_SEARCH
+        params.update(m=INDEX_HNSW_M, ef_construction=INDEX_HNSW_EF_CONSTRUCTION, ef_search=INDEX_HNSW_EF_SEARCH)
+    elif index_type == "flat_f16":
+        index = faiss.index_factory(d, "SQfp16")
+        index.train(matrix)
+    else:
+        if index_type != "flat":
+            params.update(type="flat", requested=index_type)
+        index = faiss.IndexFlatL2(d)
+    index.add(matrix)
+    return index, params
+
+# --- [新增] memory-map 索引格式：讀取端 ---
+class MmapFlatIndex:
+    """
+    以 NumPy 直接在 memory-map 的向量 (float32 或 float16) 上做暴力 L2 搜尋 (與 IndexFlatL2 結果相同)
+    提供 LangChain FAISS 會用到的 d / ntotal / search / reconstruct，載入時不需複製向量
+    多個 worker 載入同一個檔案時，由作業系統的 page cache 共用同一份記憶體
+    """
+    block_rows = 65536  # 每次轉成 float32 計算的列數，避免一次配置整個矩陣
+
+    def __init__(self, vectors: np.ndarray):
+        self.vectors = vectors
+        self.ntotal, self.d = vectors.shape
+        self._norms: Optional[np.ndarray] = None  # 每個向量的平方長度，第一次搜尋時才計算
+
+    @property
+    def resident_bytes(self) -> int:
+        # memory-map 的向量不佔用行程的 heap，只計算額外配置的陣列
+        own = 0 if isinstance(self.vectors, np.memmap) else self.vectors.nbytes
+        return own + self.ntotal * 4
+
+    def _blocks(self):
+        for start in range(0, self.ntotal, self.block_rows):
+            yield start, np.asarray(self.vectors[start:start + self.block_rows], dtype=np.float32)
+
+    def _squared_norms(self) -> np.ndarray:
+        if self._norms is None:
+            norms = [np.einsum("ij,ij->i", block, block) for _, block in self._blocks()]
+            self._norms = np.concatenate(norms) if norms else np.zeros(0, dtype=np.float32)
+        return self._norms
+
+    def search(self, x: np.ndarray, k: int):
+        x = np.asarray(x, dtype=np.float32).reshape(-1, self.d)
+        nq, k_found = len(x), min(k, self.ntotal)
+        distances = np.full((nq, k), np.inf, dtype=np.float32)
+        labels = np.full((nq, k), -1, dtype=np.int64)
+        if k_found == 0:
+            return distances, labels
+        norms = self._squared_norms()
+        q_norms = np.einsum("ij,ij->i", x, x)[:, None]
+        best_d = np.empty((nq, 0), dtype=np.float32)
+        best_i = np.empty((nq, 0), dtype=np.int64)
+        for start, block in self._blocks():
+            # ||v - q||^2 = ||v||^2 - 2 v·q + ||q||^2，每個區塊只保留目前最好的 k 個
+            dist = norms[None, start:start + len(block)] - 2.0 * (x @ block.T) + q_norms
+            ids = np.broadcast_to(np.arange(start, start + len(block)), dist.shape)
+            cand_d = np.concatenate([best_d, dist], axis=1)
+            cand_i = np.concatenate([best_i, ids], axis=1)
+            top = np.argpartition(cand_d, min(k_found, cand_d.shape[1]) - 1, axis=1)[:, :k_found]
+            best_d = np.take_along_axis(cand_d, top, axis=1)
+            best_i = np.take_along_axis(cand_i, top, axis=1)
+        order = np.argsort(best_d, axis=1)
+        distances[:, :k_found] = np.maximum(np.take_along_axis(best_d, order, axis=1), 0.0)
+        labels[:, :k_found] = np.take_along_axis(best_i, order, axis=1)
+        return distances, labels
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        return np.array(self.vectors[int(i)], dtype=np.float32)
+
+class LazyDocstore:
+    """
+    依 chunks.idx 的位移，從 chunks.bin 取出單一 Chunk 並在需要時才解析成 Document
+    取代 index.pkl：載入時不需要把整個 docstore 反序列化成 Python 物件
+    """
+    def __init__(self, blob, offsets: np.ndarray):
+        self.blob = blob        # chunks.bin 內容 (memory-map 或 bytes)
+        self.offsets = offsets  # uint64，長度為 Chunk 數 + 1
+
+    @property
+    def resident_bytes(self) -> int:
+        if isinstance(self.blob, np.memmap):
+            return 0
+        return len(self.blob) + self.offsets.nbytes
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def search(self, search: str):
+        i = int(search)
+        if not 0 <= i < len(self):
+            return f"ID {search} not found."  # 與 InMemoryDocstore 找不到時的行為相同
+        record = json.loads(bytes(self.blob[int(self.offsets[i]):int(self.offsets[i + 1])]).decode("utf-8"))
+        return Document(page_content=record["page_content"], metadata=record.get("metadata", {}))
+
+class RangeIds(Mapping):
+    """
+    唯讀的 index 位置 -> docstore id 對照表 (位置 i 對應 id "i")，不必為每個 Chunk 建立字典項目
+    """
+    def __init__(self, n: int):
+        self.n = n
+
+    def __getitem__(self, i):
+        if not isinstance(i, (int, np.integer)) or not 0 <= i < self.n:
+            raise KeyError(i)
+        return str(int(i))
+
+    def __len__(self) -> int:
+        return self.n
+
+    def __iter__(self):
+        return iter(range(self.n))
+
+def member_data_offset(zip_ref: zipfile.ZipFile, info: zipfile.ZipInfo) -> int:
+    """
+    讀取成員的 local file header，計算 STORED 資料在 ZIP 檔中的起始位移
+    """
+    fp = zip_ref.fp
+    fp.seek(info.header_offset)
+    header = fp.read(30)
+    if len(header) != 30 or header[:4] != b"PK\x03\x04":
+        raise CorpusInputError(f"ZIP 成員 {info.filename} 的標頭損毀")
+    name_len, extra_len = struct.unpack("<HH", header[26:30])
+    return info.header_offset + 30 + name_len + extra_len
+
+def map_member(zip_ref: zipfile.ZipFile, zip_source, info: zipfile.ZipInfo, dtype) -> np.ndarray:
+    """
+    取得成員內容的 NumPy 陣列：ZIP 為硬碟上的檔案且成員為 STORED 時直接 memory-map (O(1) 載入)
+    否則 (上傳中的檔案物件或有壓縮的成員) 讀進記憶體
+    """
+    itemsize = np.dtype(dtype).itemsize
+    if info.file_size % itemsize:
+        raise CorpusInputError(f"索引檔 {info.filename} 大小不正確")
+    if MMAP_ENABLED and isinstance(zip_source, str) and info.compress_type == zipfile.ZIP_STORED:
+        offset = member_data_offset(zip_ref, info)
+        if info.file_size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(zip_source, dtype=dtype, mode="r", offset=offset, shape=(info.file_size // itemsize,))
+    check_member_sizes([info])
+    return np.frombuffer(read_member(zip_ref, info), dtype=dtype)
+
+def load_mmap_from_zip(zip_ref: zipfile.ZipFile, zip_source, prefix: str, api_key: str) -> FAISS:
+    """
+    載入新格式的索引：讀取 manifest.json 後將向量與 Chunk 內容 memory-map，不做任何反序列化
+    ivf / hnsw / pq 類型的 index.faiss 由 FAISS 還原；查詢用的 Embedding 維度依 manifest 決定
+    """
+    manifest_info = zip_ref.getinfo(prefix + MMAP_MANIFEST)
+    check_member_sizes([manifest_info])
+    try:
+        manifest = json.loads(read_member(zip_ref, manifest_info).decode("utf-8"))
+        count, dim = int(manifest["count"]), int(manifest["dim"])
+    except (ValueError, KeyError, TypeError):
+        raise CorpusInputError("索引 manifest.json 格式錯誤")
+    if manifest.get("format") != MMAP_FORMAT or int(manifest.get("version", 0)) > MMAP_VERSION:
+        raise CorpusInputError(f"不支援的索引格式: {manifest.get('format')} v{manifest.get('version')}")
+
+    offsets = map_member(zip_ref, zip_source, zip_ref.getinfo(prefix + "chunks.idx"), "<u8")
+    blob = map_member(zip_ref, zip_source, zip_ref.getinfo(prefix + "chunks.bin"), np.uint8)
+    if len(offsets) != count + 1 or (count and int(offsets[-1]) != len(blob)):
+        raise CorpusInputError("索引檔內容與 manifest.json 不一致")
+
+    vector_file = manifest.get("vectors")
+    try:
+        if vector_file:
+            # flat / flat_f16：直接在 memory-map 的向量上搜尋
+            dtype = {"float32": "<f4", "float16": "<f2"}[manifest.get("dtype", "float32")]
+            vectors = map_member(zip_ref, zip_source, zip_ref.getinfo(prefix + vector_file), dtype)
+            if vectors.size != count * dim:
+                raise CorpusInputError("索引檔內容與 manifest.json 不一致")
+            index = MmapFlatIndex(vectors.reshape(count, dim))
+        else:
+            # ivf / hnsw / pq：由 FAISS 還原 (搜尋參數已隨索引保存)
+            index_info = zip_ref.getinfo(prefix + "index.faiss")
+            check_member_sizes([index_info])
+            index = faiss.deserialize_index(np.frombuffer(read_member(zip_ref, index_info), dtype=np.uint8))
+            if index.ntotal != count or index.d != dim:
+                raise CorpusInputError("索引檔內容與 manifest.json 不一致")
+    except KeyError as e:
+        raise CorpusInputError(f"索引缺少必要的檔案或欄位: {e}")
+
+    embeddings = get_embeddings(api_key, dimensions=manifest.get("dimensions") or dim)
+    return FAISS(embeddings, index, LazyDocstore(blob, offsets), RangeIds(count))
+
+# --- [新增] memory-map 索引格式：寫入端 ---
+def write_mmap_artifact(folder: str, vectors: List[List[float]], docs: List[Document], embedding_model: str,
+                        index_type: str = "flat"):
+    """
+    將向量與 Chunk 寫成 manifest.json / chunks.bin / chunks.idx
+    以及 vectors.f32 (flat)、vectors.f16 (flat_f16) 或 index.faiss (ivf / hnsw / pq)
+    """
+    os.makedirs(folder, exist_ok=True)
+    matrix = np.asarray(vectors, dtype=np.float32)
+    dim = int(matrix.shape[1]) if matrix.ndim == 2 else 0
+    vector_file, dtype = None, "float32"
+    if index_type in ("flat", "flat_f16") or len(docs) == 0:
+        dtype = "float16" if index_type == "flat_f16" else "float32"
+        vector_file = MMAP_VECTOR_FILES[dtype]
+        matrix.astype("<f2" if dtype == "float16" else "<f4").tofile(os.path.join(folder, vector_file))
+        index_params: Dict[str, object] = {"type": index_type if len(docs) else "flat"}
+    else:
+        index, index_params = build_faiss_index(matrix, index_type)
+        if index_params["type"] == "flat":
+            # 向量太少無法訓練，改存原始向量
+            vector_file = MMAP_VECTOR_FILES[dtype]
+            matrix.astype("<f4").tofile(os.path.join(folder, vector_file))
+        else:
+            faiss.write_index(index, os.path.join(folder, "index.faiss"))
+
+    offsets = [0]
+    with open(os.path.join(folder, "chunks.bin"), "wb") as f:
+        for doc in docs:
+            record = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata},
+                                ensure_ascii=False, default=str).encode("utf-8")
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+    np.asarray(offsets, dtype="<u8").tofile(os.path.join(folder, "chunks.idx"))
+
+    manifest = {
+        "format": MMAP_FORMAT,
+        "version": MMAP_VERSION,
+        "count": len(docs),
+        "dim": dim,
+        "dtype": dtype,
+        "vectors": vector_file,
+        "metric": "l2",
+        "index": index_params,
+        "embedding_model": embedding_model,
+        "dimensions": dim,
+    }
+    with open(os.path.join(folder, MMAP_MANIFEST), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+def needs_zip64(info: zipfile.ZipInfo) -> bool:
+    """
+    [新增] 與 zipfile 寫入成員時的判斷相同：大小接近 ZIP64_LIMIT (約 2GB) 以上的成員需要 zip64
+    此時 local header 會在 extra 欄位之後再加上 20 bytes 的 zip64 欄位 (寫入時以 force_zip64 傳入，兩邊一致)
+    """
+    return info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+
+def aligned_zipinfo(zipf: zipfile.ZipFile, src_path: str, arcname: str, align: int = 64) -> zipfile.ZipInfo:
+    """
+    建立 STORED (不壓縮) 成員的 ZipInfo，並在 local header 的 extra 欄位補齊長度
+    讓資料起點對齊 align bytes，載入時可直接 memory-map 成 float32/uint64 陣列
+    需在寫入該成員之前呼叫 (依目前的寫入位置計算)；寫入時需傳入 force_zip64=needs_zip64(info)
+    """
+    info = zipfile.ZipInfo.from_file(src_path, arcname)
+    info.compress_type = zipfile.ZIP_STORED
+    zip64_extra = 20 if needs_zip64(info) else 0  # [修改] zipfile 另外加上的 zip64 欄位也會推移資料起點
+    data_start = zipf.fp.tell() + 30 + len(info.filename.encode("utf-8")) + 4 + zip64_extra
+    pad = (-data_start) % align
+    info.extra = struct.pack("<HH", 0xD935, pad) + b"\0" * pad  # 0xD935：Android zipalign 使用的對齊欄位
+    return info
+
+# --- [新增] 共通函數：由 ZIP 準備語料庫 (載入 RAG DB 或現場建立) ---
+def prepare_corpus_from_zip(zip_source, api_key: str, fingerprint: str,
+                            empty_error: str = "Zip 內無支援的文件") -> PreparedCorpus:
+    """
+    [修改] 只掃描 ZIP 的中央目錄，自動偵測是「已經做好的 FAISS DB」還是「原始文件」
+    全程不解壓縮到硬碟，回傳可直接檢索的 PreparedCorpus
+    zip_source 可以是檔案路徑或檔案物件 (例如上傳檔案的 file)
+    """
+    # 開啟 ZIP 並驗證格式
+    with open_zip(zip_source) as zip_ref:
+        # 偵測 ZIP 內容：如果同一資料夾內同時包含 index.faiss 和 index.pkl，判定為 RAG 資料庫
+        scan = ZipScan(zip_ref)
+
+        # 載入現成的資料庫時，查詢用的 Embeddings 依索引的維度建立 (建庫時可能縮減了 dimensions)
+        if scan.mmap_dir is not None:
+            # 情況 A: 是新格式的 RAG Zip -> memory-map 向量與 Chunk，不需反序列化
+            log_event("corpus_detected", kind="mmap", prefix=scan.mmap_dir or "/")
+            with timed_stage("load_index"):
+                vectorstore = load_mmap_from_zip(zip_ref, zip_source, scan.mmap_dir, api_key)
+        elif scan.faiss_dir is not None:
+            # 情況 A-2: 是舊格式的 RAG Zip (index.faiss + index.pkl) -> 直接從成員載入
+            log_event("corpus_detected", kind="faiss", prefix=scan.faiss_dir or "/")
+            with timed_stage("load_index"):
+                vectorstore = load_faiss_from_zip(zip_ref, scan.faiss_dir, api_key)
+        else:
+            # 情況 B: 是原始文件 Zip -> 現場切分向量化 (較慢)
+            log_event("corpus_detected", kind="documents")
+            with timed_stage("parse"):
+                all_documents = process_zip_to_docs(zip_source, zip_ref=zip_ref, scan=scan)
+            if not all_documents:
+                raise CorpusInputError(empty_error)
+            with timed_stage("split"):
+                split_docs = split_documents(all_documents)
+            with timed_stage("dedup"):
+                split_docs, _, _ = dedup_chunks(split_docs)
+            # 現場建庫時，已計算過的 Chunk 會直接從持久快取取用 (向量化與建立索引一起計時)
+            with timed_stage("embed_index"):
+                vectorstore = FAISS.from_documents(split_docs, get_embeddings(api_key))
+
+    # GIS 檔案列表直接取自中央目錄，一起放進快取
+    return PreparedCorpus(fingerprint, vectorstore, scan.gis_files)
+
+# --- [新增] 常駐記憶體的預設語料庫 (rag_db.zip) ---
+class DefaultCorpus:
+    """
+    伺服器啟動時載入一次 rag_db.zip (FAISS 索引、docstore 與 GIS 檔案列表) 並常駐記憶體
+    請求直接使用記憶體中的語料庫，不再複製、解壓縮或重新載入檔案
+    背景執行緒會定期檢查檔案的修改時間與大小，變更時自動熱更新 (hot-reload)
+    載入前先把檔案複製成 snapshot_dir 中的私有快照再 memory-map：
+    營運人員原地覆寫 rag_db.zip 時不會改到使用中的分頁 (避免 SIGBUS 或讀到錯誤內容)
+    """
+    def __init__(self, zip_path: str, poll_seconds: int, snapshot_dir: str):
+        self.zip_path = zip_path          # 預設語料庫檔案路徑
+        self.poll_seconds = poll_seconds  # 檢查檔案變更的間隔秒數 (0 表示不監看)
+        self.snapshot_dir = snapshot_dir  # 私有快照的資料夾 (檔名為內容的 SHA-256)
+        self._corpus: Optional[PreparedCorpus] = None
+        self._stamp = None                # 目前載入版本的 (mtime_ns, size)
+        self._lock = threading.Lock()     # 同一時間只允許一個載入動作
+        self._watcher: Optional[threading.Thread] = None
+        self.loads = 0                    # 成功載入次數
+        self.last_error: Optional[str] = None
+        self.checked = threading.Event()  # [新增] 啟動後第一次檢查 (載入或確認檔案不存在) 完成時設定
+
+    def get(self) -> Optional[PreparedCorpus]:
+        """
+        取得目前常駐的語料庫 (不做任何檔案 I/O)
+        若伺服器剛啟動、尚未載入完成，會等待第一次載入結束
+        """
+        corpus = self._corpus
+        if corpus is None:
+            self.reload_if_changed()
+            corpus = self._corpus
+        return corpus
+
+    def peek(self) -> Optional[PreparedCorpus]:
+        """
+        取得目前常駐的語料庫，尚未載入時直接回傳 None (不等待)
+        """
+        return self._corpus
+
+    def reload_if_changed(self, force: bool = False) -> bool:
+        """
+        檢查 rag_db.zip 是否變更，若有則重新載入並原子性地替換
+        回傳是否有載入新版本
+        """
+        with self._lock:
+            try:
+                st = os.stat(self.zip_path)
+            except FileNotFoundError:
+                # 檔案被移除：卸載語料庫，請求會回傳「找不到預設的 rag_db.zip」
+                if self._corpus is not None:
+                    log_event("default_corpus_removed", path=self.zip_path)
+                    RETRIEVAL_CACHE.invalidate(self._corpus.fingerprint)
+                self._corpus, self._stamp = None, None
+                return False
+
+            stamp = (st.st_mtime_ns, st.st_size)
+            if not force and stamp == self._stamp and self._corpus is not None:
+                return False  # 沒有變更
+
+            api_key = os.getenv("OPENAI_API_KEY")
+            if not api_key:
+                self.last_error = "未設定 OPENAI_API_KEY"
+                return False
+
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            tmp_path = os.path.join(self.snapshot_dir, f".tmp-{uuid.uuid4()}")
+            try:
+                # 複製成私有快照，指紋以快照的內容計算 (複製期間原檔被覆寫時，下次檢查會再載入一次)
+                shutil.copyfile(self.zip_path, tmp_path)
+                fingerprint = file_sha256(tmp_path)
+                if self._corpus is not None and fingerprint == self._corpus.fingerprint:
+                    # 只是修改時間變了，內容相同，不必重新載入
+                    os.remove(tmp_path)
+                    self._stamp = stamp
+                    return False
+                snapshot = os.path.join(self.snapshot_dir, f"{fingerprint}.zip")
+                os.replace(tmp_path, snapshot)
+                log_event("default_corpus_loading", path=self.zip_path, fingerprint=fingerprint[:12])
+                corpus = prepare_corpus_from_zip(snapshot, api_key, fingerprint,
+                                                 empty_error="Zip 內無支援的講義文件")
+            except Exception as e:
+                # 載入失敗 (例如檔案正在被覆寫) 時保留舊版本，下次檢查再重試
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                self.last_error = str(e)
+                log_event("default_corpus_load_failed", path=self.zip_path, error=str(e))
+                return False
+
+            old = self._corpus
+            self._corpus, self._stamp = corpus, stamp  # 原子性替換，進行中的請求仍使用舊版本
+            if old is not None:
+                RETRIEVAL_CACHE.invalidate(old.fingerprint)  # [新增] 舊版本的檢索結果不再需要
+            self._remove_snapshots(keep=f"{fingerprint}.zip")
+            self.loads += 1
+            self.last_error = None
+            return True
+
+    def _remove_snapshots(self, keep: str):
+        """
+        刪除舊版本的快照 (仍在使用舊版本的請求已經 memory-map，刪除檔案不影響已對應的分頁)
+        """
+        for name in os.listdir(self.snapshot_dir):
+            if name != keep and not name.startswith(".tmp-"):
+                try:
+                    os.remove(os.path.join(self.snapshot_dir, name))
+                except OSError:
+                    pass
+
+    def start_watcher(self):
+        """
+        啟動背景執行緒：先載入一次，之後定期檢查檔案變更
+        """
+        if self._watcher is not None:
+            return
+
+        def _watch():
+            while True:
+                self.reload_if_changed()
+                self.checked.set()
+                if self.poll_seconds <= 0:
+                    return  # 不監看，只載入一次
+                time.sleep(self.poll_seconds)
+
+        self._watcher = threading.Thread(target=_watch, name="default-corpus-watcher", daemon=True)
+        self._watcher.start()
+
+    def stats(self) -> dict:
+        corpus = self._corpus
+        return {
+            "path": self.zip_path,
+            "loaded": corpus is not None,
+            "fingerprint": corpus.fingerprint if corpus else None,
+            "size_bytes": corpus.size_bytes if corpus else 0,
+            "loads": self.loads,
+            "checked": self.checked.is_set(),
+            "last_error": self.last_error,
+        }
+
+# 建立全域預設語料庫實例
+DEFAULT_CORPUS = DefaultCorpus(
+    zip_path=os.getenv("DEFAULT_RAG_ZIP", "rag_db.zip"),                 # 預設檔案名稱
+    poll_seconds=env_int("DEFAULT_CORPUS_POLL_SECONDS", 30),             # 每 30 秒檢查一次是否變更
+    snapshot_dir=os.path.join(CACHE_DIR, "default_corpus"),              # 載入用的私有快照
+)
+
+# [新增] 伺服器啟動時，於背景載入預設語料庫並開始監看檔案變更
+@app.on_event("startup")
+def load_default_corpus_on_startup():
+    DEFAULT_CORPUS.start_watcher()
+
+# --- [新增] 背景暖機：啟動後預先載入延遲匯入的套件並建立共用的 OpenAI 客戶端 ---
+class WarmUp:
+    """
+    伺服器一啟動就能回應存活檢查 (/healthz)；重量級套件與連線池在背景執行緒中準備，
+    完成後 (且預設語料庫已檢查過) 就緒檢查 (/readyz) 才回傳 200
+    """
+    def __init__(self, imports):
+        self.imports = imports
+        self.done = threading.Event()
+        self.timings: Dict[str, float] = {}  # 各套件的載入秒數
+        self.errors: Dict[str, str] = {}     # 載入失敗的套件與錯誤訊息
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.started_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="warm-up", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        for lazy in self.imports:
+            start = time.perf_counter()
+            try:
+                lazy.load()
+            except Exception as e:
+                self.errors[lazy.name] = str(e)
+                log_event("warm_up_failed", module=lazy.name, error=str(e))
+            self.timings[lazy.name] = round(time.perf_counter() - start, 3)
+        # 建立共用的 OpenAI 客戶端與連線池
+        api_key = os.getenv("OPENAI_API_KEY")
+        if api_key:
+            try:
+                OPENAI_CLIENTS.client(api_key)
+            except Exception as e:
+                self.errors["openai_client"] = str(e)
+        self.finished_at = time.time()
+        self.done.set()
+        log_event("warm_up_done", seconds=round(self.finished_at - self.started_at, 3), errors=len(self.errors))
+
+    @property
+    def ready(self) -> bool:
+        return self.done.is_set() and not self.errors
+
+    def stats(self) -> dict:
+        return {
+            "done": self.done.is_set(),
+            "seconds": round(self.finished_at - self.started_at, 3) if self.finished_at else None,
+            "timings": dict(self.timings),
+            "errors": dict(self.errors),
+        }
+
+# 建立全域暖機實例
+WARM_UP = WarmUp(HEAVY_IMPORTS)
+
+# [修改] 伺服器啟動時在背景暖機 (不阻塞啟動)，關閉時釋放連線
+@app.on_event("startup")
+def start_warm_up_on_startup():
+    WARM_UP.start()
+
+@app.on_event("shutdown")
+def close_openai_clients_on_shutdown():
+    OPENAI_CLIENTS.close()
+    LOADER_POOL.close()
+
+# --- [新增] 共通函數：取得本次請求要使用的語料庫 ---
+async def resolve_corpus(file: Optional[UploadFile], api_key: str, empty_error: str,
+                         corpus_id: Optional[str] = None) -> PreparedCorpus:
+    """
+    [修改] 有 corpus_id 時使用已註冊的語料庫 (不必重新上傳)
+    有上傳檔案時由索引快取取得 (未命中才建立)，否則使用常駐的預設語料庫
+    計算指紋、讀檔與建立向量庫都是阻塞工作，在 ingest 階段的執行緒池中執行
+    找不到可用的語料庫時拋出 CorpusInputError (corpus_id 不存在時為 CorpusNotFoundError)
+    """
+    if corpus_id:
+        return await STAGES["ingest"].run(CORPUS_REGISTRY.load, corpus_id, api_key)
+    if file:
+        def _load():
+            with timed_stage("fingerprint"):
+                fingerprint = hash_upload(file)  # 計算內容指紋 (上傳檔直接當作 ZIP 讀取，不另存)
+            return INDEX_CACHE.get_or_build(
+                fingerprint,
+                lambda: prepare_corpus_from_zip(file.file, api_key, fingerprint, empty_error=empty_error),
+            )
+        return await STAGES["ingest"].run(_load)
+
+    # 預設語料庫已載入時直接使用 (不做任何檔案 I/O)；剛啟動尚未載入完成時才在執行緒中等待
+    corpus = DEFAULT_CORPUS.peek()
+    if corpus is None:
+        corpus = await STAGES["ingest"].run(DEFAULT_CORPUS.get)
+    if corpus is None:
+        raise CorpusInputError("未上傳檔案，且伺服器找不到預設的 rag_db.zip")
+    return corpus
+
+# --- [新增] 共通函數：檢索 Top-K 段落 (經過檢索快取) ---
+async def retrieve_docs(corpus: PreparedCorpus, query: str, k: int = 5) -> List[Document]:
+    """
+    依序查詢檢索快取與查詢向量快取，都未命中時才呼叫 Embedding API
+    查詢向量化與 FAISS 搜尋為阻塞工作，在 embed 階段的執行緒池中執行 (命中時不佔用名額)
+    """
+    docs = RETRIEVAL_CACHE.get(corpus.fingerprint, query, k)
+    if docs is not None:
+        return docs
+
+    def _search():
+        embeddings = corpus.vectorstore.embeddings
+        model = getattr(embeddings, "model", "")  # 包含縮減後的維度，不同維度的向量不會混用
+        vector = RETRIEVAL_CACHE.get_vector(model, query)
+        if vector is None:
+            vector = embeddings.embed_query(query)
+            RETRIEVAL_CACHE.put_vector(model, query, vector)
+        return corpus.vectorstore.similarity_search_by_vector(vector, k=k)
+
+    def _timed_search():
+        with timed_stage("retrieval"):
+            return _search()
+
+    docs = await STAGES["embed"].run(_timed_search)
+    RETRIEVAL_CACHE.put(corpus.fingerprint, query, k, docs)
+    return docs
+
+# --- [新增] 共通函數：組合 Prompt 用的講義內容 (合併重疊段落、去除近似重複、控制 token 預算) ---
+# CONTEXT_TOKEN_BUDGET: 講義內容最多佔用的 token 數 (0 表示不限制)
+# CONTEXT_NEAR_DUP_PERCENT: 段落有多少比例的內容已出現在較前面的段落時視為重複而略過
+CONTEXT_TOKEN_BUDGET = env_int("CONTEXT_TOKEN_BUDGET", 3000)
+CONTEXT_NEAR_DUP_PERCENT = env_int("CONTEXT_NEAR_DUP_PERCENT", 90)
+CONTEXT_ENCODING = "o200k_base"   # GPT-4o 使用的 tiktoken 編碼
+CONTEXT_SEPARATOR = "\n\n"        # 段落之間以空行分隔 (與原本的 "stuff" 模式相同)
+CONTEXT_MIN_OVERLAP = 20          # 相鄰 Chunk 的重疊至少要這麼多字元才合併，避免誤判
+CONTEXT_MAX_OVERLAP = 400         # 切分器的 chunk_overlap 為 200，保留一些餘裕
+CONTEXT_MIN_TAIL_TOKENS = 64      # 預算剩餘不到這麼多 token 時不再放入截斷的段落
+CONTEXT_TOKENS_SAVED = METRICS.add("rag_context_tokens_saved_total",
+                                   "Prompt tokens saved by merging, dedup and budget packing", "counter", ("endpoint",))
+
+class BuiltContext:
+    """
+    組合好的講義內容
+    text: 放進 Prompt 的文字；docs: 原始檢索結果 (評分快取的 Key 與參考來源使用)
+    raw_tokens: 直接串接所有段落的 token 數；tokens: 實際使用的 token 數
+    """
+    def __init__(self, text: str, docs: List[Document], raw_tokens: int, tokens: int, merged: int, dropped: int,
+                 truncated: bool):
+        self.text = text
+        self.docs = docs
+        self.raw_tokens = raw_tokens
+        self.tokens = tokens
+        self.merged = merged        # 因與同一來源的段落重疊而合併的數量
+        self.dropped = dropped      # 因近似重複或超出預算而略過的數量
+        self.truncated = truncated  # 最後一段是否被截斷
+
+    @property
+    def tokens_saved(self) -> int:
+        return max(0, self.raw_tokens - self.tokens)
+
+    def headers(self) -> Dict[str, str]:
+        return {"X-Context-Tokens": str(self.tokens), "X-Context-Tokens-Saved": str(self.tokens_saved)}
+
+def overlap_length(head: str, tail: str) -> int:
+    """
+    回傳 head 的結尾與 tail 的開頭重疊的字元數 (取最長的；小於 CONTEXT_MIN_OVERLAP 視為不重疊)
+    """
+    for size in range(min(len(head), len(tail), CONTEXT_MAX_OVERLAP), CONTEXT_MIN_OVERLAP - 1, -1):
+        if head.endswith(tail[:size]):
+            return size
+    return 0
+
+def merge_overlapping(docs: List[Document]) -> List[tuple]:
+    """
+    將同一來源中互相重疊或包含的段落合併 (切分器的 chunk_overlap 讓相鄰 Chunk 重複約 200 字)
+    回傳 [(來源, 文字)]，順序依各組中排名最前的段落 (維持檢索的相關度排序)
+    """
+    segments = [(d.metadata.get("source"), d.page_content) for d in docs]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(len(segments)):
+            for j in range(i + 1, len(segments)):
+                source, a = segments[i]
+                other_source, b = segments[j]
+                if source is None or source != other_source:
+                    continue
+                if b in a:
+                    merged = a
+                elif a in b:
+                    merged = b
+                elif overlap_length(a, b):
+                    merged = a + b[overlap_length(a, b):]
+                elif overlap_length(b, a):
+                    merged = b + a[overlap_length(b, a):]
+                else:
+                    continue
+                segments[i] = (source, merged)
+                del segments[j]
+                changed = True
+                break
+            if changed:
+                break
+    return segments
+
+def shingles(text: str, size: int = 5) -> set:
+    # 以字元 n-gram 表示段落內容 (中英文皆適用，不需斷詞)
+    compact = "".join(text.split())
+    return {compact[i:i + size] for i in range(max(1, len(compact) - size + 1))}
+
+def build_context(docs: List[Document], budget: Optional[int] = None) -> BuiltContext:
+    """
+    將檢索到的段落組合成 Prompt 用的講義內容：
+    1. 合併同一來源中重疊的相鄰段落
+    2. 略過內容幾乎都已出現在前面段落的近似重複 (例如不同檔案中的相同段落)
+    3. 依相關度排序放入段落直到用完 token 預算，最後一段可截斷
+    """
+    budget = CONTEXT_TOKEN_BUDGET if budget is None else budget
+    raw_tokens = count_tokens([CONTEXT_SEPARATOR.join(d.page_content for d in docs)], CONTEXT_ENCODING) if docs else 0
+    segments = merge_overlapping(docs)
+    merged = len(docs) - len(segments)
+
+    kept: List[str] = []
+    seen: set = set()
+    dropped = 0
+    for _, text in segments:
+        grams = shingles(text)
+        if seen and len(grams & seen) * 100 >= CONTEXT_NEAR_DUP_PERCENT * len(grams):
+            dropped += 1
+            continue
+        seen |= grams
+        kept.append(text)
+
+    parts: List[str] = []
+    used = 0
+    truncated = False
+    separator_tokens = count_tokens([CONTEXT_SEPARATOR], CONTEXT_ENCODING)
+    for index, text in enumerate(kept):
+        cost = count_tokens([text], CONTEXT_ENCODING) + (separator_tokens if parts else 0)
+        if budget <= 0 or used + cost <= budget:
+            parts.append(text)
+            used += cost
+            continue
+        remaining = budget - used - (separator_tokens if parts else 0)
+        if remaining >= CONTEXT_MIN_TAIL_TOKENS:
+            parts.append(truncate_tokens(text, remaining, CONTEXT_ENCODING))
+            truncated = True
+        dropped += len(kept) - index - (1 if truncated else 0)
+        break
+
+    text = CONTEXT_SEPARATOR.join(parts)
+    context = BuiltContext(text, docs, raw_tokens, count_tokens([text], CONTEXT_ENCODING) if text else 0,
+                           merged, dropped, truncated)
+    CONTEXT_TOKENS_SAVED.inc(context.tokens_saved, endpoint=REQUEST_ENDPOINT.get())
+    log_event("context", chunks=len(docs), merged=merged, dropped=dropped, truncated=truncated,
+              raw_tokens=raw_tokens, tokens=context.tokens, tokens_saved=context.tokens_saved)
+    return context
+
+async def assemble_context(docs: List[Document], budget: Optional[int] = None) -> BuiltContext:
+    """
+    [新增] 在 embed 階段的執行緒池中執行 build_context (tiktoken 計算 token 數為 CPU 工作，不阻塞事件迴圈)
+    使用 embed 而非 llm 階段：llm 的名額多半被 GPT-4o 呼叫長時間占用，毫秒級的工作不應排在其後
+    """
+    return await STAGES["embed"].run(build_context, docs, budget)
+
+# 定義根路徑 (Root Endpoint)
+@app.get("/")
+def home():
+    # 回傳簡單的 JSON 訊息，確認伺服器正在運作，並告知可用的 API 路徑
+    return {"message": "RAG Server Ready. Endpoints: /healthz, /readyz, /process_zip, /api/jobs/process_zip, /ask_with_zip, /ask_with_zip/stream, /api/generate_question, /api/generate_question/stream, /api/grade_submission, /api/grade_batch, /api/corpora, /api/update_index, /metrics"}
+
+# [新增] 存活檢查 (liveness)：事件迴圈能回應即回傳 200，不做任何 I/O，也不觸發套件載入
+@app.get("/healthz")
+def liveness():
+    return {"status": "ok"}
+
+# [新增] 就緒檢查 (readiness)：背景暖機完成且預設語料庫已檢查過才回傳 200，否則 503
+@app.get("/readyz")
+def readiness():
+    ready = WARM_UP.ready and DEFAULT_CORPUS.checked.is_set()
+    return JSONResponse(status_code=200 if ready else 503, content={
+        "ready": ready,
+        "warm_up": WARM_UP.stats(),
+        "default_corpus": {
+            "checked": DEFAULT_CORPUS.checked.is_set(),
+            "loaded": DEFAULT_CORPUS.peek() is not None,
+            "last_error": DEFAULT_CORPUS.last_error,
+        },
+    })
+
+# [新增] 快取與伺服器統計資訊 (用於觀察命中率並調整快取大小)
+@app.get("/api/stats")
+def server_stats():
+    return {
+        "index_cache": INDEX_CACHE.stats(),
+        "default_corpus": DEFAULT_CORPUS.stats(),
+        "embedding_cache": EMBEDDING_STORE.stats(),
+        "retrieval_cache": RETRIEVAL_CACHE.stats(),
+        "grading_cache": GRADING_CACHE.stats(),
+        "question_pool": QUESTION_POOL.stats(),
+        "stages": {name: stage.stats() for name, stage in STAGES.items()},
+        "openai_pool": OPENAI_CLIENTS.stats(),
+        "jobs": JOB_MANAGER.stats(),
+        "corpora": CORPUS_REGISTRY.stats(),
+        "warm_up": WARM_UP.stats(),
+        "workspaces": WORKSPACES.stats(),
+        "loader_pool": LOADER_POOL.stats(),
+    }
+
+# [新增] Prometheus 格式的指標 (各階段耗時、token 用量、快取命中率、進行中的請求數)
+def collect_runtime_metrics():
+    """
+    抓取指標前，把各快取、階段限制與連線池自行累計的數字同步到指標
+    """
+    caches = {
+        "index": INDEX_CACHE.stats(),
+        "retrieval": RETRIEVAL_CACHE.stats(),
+        "question_pool": QUESTION_POOL.stats(),
+    }
+    for name, stats in caches.items():
+        CACHE_HITS.set(stats["hits"], cache=name)
+        CACHE_MISSES.set(stats["misses"], cache=name)
+        CACHE_HIT_RATIO.set(stats["hit_ratio"], cache=name)
+    grading = GRADING_CACHE.stats()
+    CACHE_HITS.set(grading["hits"] + grading["coalesced"], cache="grading")  # 合併的請求也不需呼叫 GPT-4o
+    CACHE_MISSES.set(grading["misses"], cache="grading")
+    CACHE_HIT_RATIO.set(grading["hit_ratio"], cache="grading")
+    embedding = EMBEDDING_STORE.stats()
+    CACHE_HITS.set(embedding["reused_chunks"], cache="embedding")
+    CACHE_MISSES.set(embedding["embedded_chunks"], cache="embedding")
+    CACHE_HIT_RATIO.set(embedding["reuse_ratio"], cache="embedding")
+
+    for name, stage in STAGES.items():
+        stats = stage.stats()
+        LIMITER_ACTIVE.set(stats["active"], limiter=name)
+        LIMITER_WAITING.set(stats["waiting"], limiter=name)
+        LIMITER_REJECTED.set(stats["rejected"], limiter=name, reason="queue_full")
+        LIMITER_REJECTED.set(stats["timeouts"], limiter=name, reason="timeout")
+
+    pool = OPENAI_CLIENTS.stats()
+    OPENAI_IN_FLIGHT.set(pool["in_flight"])
+    OPENAI_CONNECTIONS.set(pool["connections"])
+
+    workspaces = WORKSPACES.stats()
+    for medium in WORKSPACES.roots:
+        WORKSPACE_BYTES.set(workspaces[medium]["reserved_bytes"], medium=medium)
+
+@app.get("/metrics")
+def metrics():
+    collect_runtime_metrics()
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# =========================================================
+# 功能 1: 製作並下載 Vector DB (原始文件 -> RAG Zip)
+# =========================================================
+@app.post("/process_zip")
+async def process_zip_file(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    artifact_format: str = Form("mmap"),         # [新增] 輸出格式：mmap (預設) 或 faiss (舊格式)
+    dimensions: Optional[int] = Form(None),      # [新增] 縮減 Embedding 維度 (例如 1024 或 256)，預設 3072
+    index_type: str = Form("flat")               # [新增] 索引類型：flat / flat_f16 / ivf / hnsw / pq
+):
+    """
+    接收原始文件 Zip，製作成向量資料庫，並回傳 Zip 供使用者下載。
+    """
+    # 從環境變數取得 OpenAI API Key，這是呼叫 Embedding 模型必需的
+    api_key = os.getenv("OPENAI_API_KEY")
+    # 如果沒有設定 API Key，回傳 500 錯誤
+    if not api_key:
+        return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+    try:
+        build_options = parse_build_options(artifact_format, dimensions, index_type)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    # 產生一個唯一的 Task ID，用於隔離不同使用者的請求
+    task_id = str(uuid.uuid4())
+
+    try:
+        # [修改] 取得本請求專用的暫存資料夾 (依上傳檔大小預留空間，空間不足時回 503)
+        # 上傳的 Zip 直接從記憶體/暫存檔讀取，不再另存與解壓縮；輸出 Zip 邊打包邊送出，不另存
+        workspace = WORKSPACES.acquire("process_zip", reserve=upload_size(file) * WORKSPACE_BUILD_FACTOR)
+    except StageOverloaded as e:
+        return overloaded_response(e)
+
+    # 離開 with 區塊時 (包含提早 return 與例外) 一律釋放暫存資料夾，除非已交給串流回應
+    with workspace:
+        vector_db_folder = workspace.file(task_id)
+        try:
+            # 1~4. 讀檔、切分、向量化與建立索引都是阻塞工作，交給 ingest 階段的執行緒池處理
+            try:
+                summary = await STAGES["ingest"].run(
+                    build_vector_db_zip, file.file, api_key, vector_db_folder, None, **build_options
+                )
+            except CorpusInputError as e:
+                # ZIP 格式錯誤、檔案超過大小上限或無支援的文件，回傳 400 錯誤
+                return JSONResponse(status_code=400, content={"error": str(e)})
+
+            # 5. 設定背景清理任務 (串流送完後才釋放暫存資料夾)
+            background_tasks.add_task(workspace.detach(WORKSPACE_STREAM_SECONDS).release)
+
+            # 6. 邊打包邊回傳 ZIP 給使用者下載 (不在硬碟上另存一份)
+            # 透過 Header 回報 Chunk 數、去除的重複 Chunk 數，以及本次 Embedding 沿用與新計算的 Chunk 數
+            return artifact_stream_response(vector_db_folder, f"faiss_db_{task_id[:8]}.zip", build_summary_headers(summary))
+
+        except StageOverloaded as e:
+            # 伺服器忙碌：回傳 429/503，請前端稍後重試
+            return overloaded_response(e)
+        except Exception as e:
+            return JSONResponse(status_code=500, content={"error": str(e)})
+
+# [新增] /process_zip 可選的輸出格式：mmap (新格式，預設) 或 faiss (舊格式 index.faiss + index.pkl)
+ARTIFACT_FORMATS = ("mmap", "faiss")
+
+def parse_build_options(artifact_format: str, dimensions: Optional[int], index_type: str) -> dict:
+    """
+    檢查 /process_zip 的建庫選項，回傳傳給 build_vector_db_zip 的參數；不合法時拋出 ValueError
+    """
+    if artifact_format not in ARTIFACT_FORMATS:
+        raise ValueError(f"artifact_format 必須是 {', '.join(ARTIFACT_FORMATS)}")
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"index_type 必須是 {', '.join(INDEX_TYPES)}")
+    if dimensions is not None and not 1 <= dimensions <= EMBEDDING_DIM:
+        raise ValueError(f"dimensions 必須介於 1 與 {EMBEDDING_DIM} 之間")
+    return {"artifact_format": artifact_format, "dimensions": dimensions, "index_type": index_type}
+
+def build_vector_db_zip(zip_source, api_key: str, vector_db_folder: str, output_zip_path: Optional[str],
+                        progress: Optional[Callable[..., None]] = None,
+                        artifact_format: str = "mmap", dimensions: Optional[int] = None,
+                        index_type: str = "flat") -> dict:
+    """
+    [新增] /process_zip 的阻塞工作：讀取文件 -> 切分 -> 去除重複 -> 向量化 -> 存檔 -> 打包 Zip
+    回傳統計數據 (Chunk 數、去除的重複 Chunk 數與 Embedding 快取沿用數)
+    progress: 可選的進度回報函數 (非同步匯入工作用來更新各階段進度)
+    artifact_format: 輸出格式，見 ARTIFACT_FORMATS
+    dimensions: 縮減後的 Embedding 維度 (None 表示完整的 3072 維)
+    index_type: 向量索引類型，見 INDEX_TYPES
+    """
+    def report(**fields):
+        if progress:
+            progress(**fields)
+
+    # 1. 呼叫共通函數：直接逐一讀取 ZIP 成員中的所有文件
+    report(stage="loading")
+    with timed_stage("parse"):
+        all_documents = process_zip_to_docs(zip_source, progress=report)
+    # 如果沒有讀取到任何支援的文件，回傳 400 錯誤
+    if not all_documents:
+        raise CorpusInputError("Zip 內無支援的文件")
+
+    # 2. 文字切分 (Chunking)
+    # 設定切分器：每塊 1000 字元，重疊 200 字元
+    report(stage="splitting")
+    with timed_stage("split"):
+        split_docs = split_documents(all_documents)
+    report(chunks_split=len(split_docs))
+
+    # 2-1. [新增] 去除重複的 Chunk (例如同一份投影片的 PDF 與 DOCX 版本)，只向量化一次
+    report(stage="deduplicating")
+    with timed_stage("dedup"):
+        split_docs, _, dedup_stats = dedup_chunks(split_docs)
+    report(chunks_total=len(split_docs), **dedup_stats)
+
+    # 3. 向量化 (Embedding)
+    # 初始化 OpenAI Embeddings 模型 (使用 text-embedding-3-large)，外層包一層持久快取
+    # 已經計算過的 Chunk 直接沿用，只有新的文字才會送去 API
+    report(stage="embedding", chunks_embedded=0)
+    embeddings = get_embeddings(api_key, dimensions=dimensions)
+    texts = [d.page_content for d in split_docs]
+    # 依 token 數打包成批次並行向量化，每完成一批就寫入快取並回報進度
+    with timed_stage("embed"):
+        vectors = embeddings.embed_documents(texts, progress=lambda done: report(chunks_embedded=done))
+    log_event("embedding_cache", reused=embeddings.reused, embedded=embeddings.embedded)
+
+    # 4. 建立索引並存檔
+    report(stage="indexing")
+    with timed_stage("index"):
+        write_artifact(vector_db_folder, artifact_format, vectors, split_docs, embeddings, index_type)
+    report(index_built=True)
+
+    # 5. 打包成 Zip (output_zip_path 為 None 時由呼叫端以串流方式打包回傳)
+    if output_zip_path is not None:
+        report(stage="packaging")
+        package_artifact(vector_db_folder, output_zip_path)
+
+    return {
+        "chunks_total": len(split_docs),
+        **dedup_stats,
+        "embedding_reused": embeddings.reused,
+        "embedding_new": embeddings.embedded,
+    }
+
+def build_summary_headers(summary: dict) -> Dict[str, str]:
+    """
+    [新增] 將建庫的統計數據轉為回應 Header (/process_zip 與非同步工作下載共用)
+    """
+    return {
+        "X-Chunks-Total": str(summary["chunks_total"]),
+        "X-Chunks-Exact-Duplicates": str(summary["chunks_exact_duplicates"]),
+        "X-Chunks-Near-Duplicates": str(summary["chunks_near_duplicates"]),
+        "X-Embedding-Reused": str(summary["embedding_reused"]),
+        "X-Embedding-New": str(summary["embedding_new"]),
+    }
+
+def write_artifact(vector_db_folder: str, artifact_format: str, vectors: List[List[float]],
+                   docs: List[Document], embeddings: Embeddings, index_type: str = "flat"):
+    """
+    [新增] 依輸出格式將向量與 Chunk 存到資料夾 (建庫與增量更新共用)
+    """
+    if artifact_format == "faiss":
+        # 舊格式：使用 FAISS 將向量與文件建立索引，儲存為 index.faiss 和 index.pkl
+        vectorstore = FAISS.from_embeddings(
+            list(zip([d.page_content for d in docs], vectors)), embeddings, metadatas=[d.metadata for d in docs]
+        )
+        if index_type != "flat":
+            # 換成指定類型的索引 (向量加入的順序不變，docstore 對照表仍然有效)
+            vectorstore.index, _ = build_faiss_index(np.asarray(vectors, dtype=np.float32), index_type)
+        vectorstore.save_local(vector_db_folder)
+    else:
+        # 新格式：直接寫出原始向量 (或 ANN 索引) 與以位移索引的 Chunk 內容 (載入時可 memory-map)
+        write_mmap_artifact(vector_db_folder, vectors, docs, EMBEDDING_MODEL, index_type=index_type)
+
+# [新增] 打包時每次讀取/送出的大小
+ARTIFACT_STREAM_CHUNK = 1024 * 1024
+
+def write_artifact_members(zipf: zipfile.ZipFile, vector_db_folder: str):
+    """
+    [新增] 將索引資料夾的檔案逐一寫入 zipf，每寫入一塊就 yield 一次 (讓串流打包可以隨時送出資料)
+    向量等二進位成員 (與需 memory-map 的 chunks.bin) 以 STORED 對齊寫入，文字成員才壓縮
+    """
+    for root, dirs, files in os.walk(vector_db_folder):
+        dirs.sort()
+        for name in sorted(files):
+            src_path = os.path.join(root, name)
+            # 計算相對路徑，保持資料夾結構寫入 zip
+            arcname = os.path.relpath(src_path, os.path.join(vector_db_folder, '..'))
+            if name in MMAP_STORED_MEMBERS:
+                info = aligned_zipinfo(zipf, src_path, arcname)
+            else:
+                info = zipfile.ZipInfo.from_file(src_path, arcname)
+                info.compress_type = zipfile.ZIP_DEFLATED
+            with open(src_path, "rb") as src, zipf.open(info, "w", force_zip64=needs_zip64(info)) as dst:
+                while True:
+                    block = src.read(ARTIFACT_STREAM_CHUNK)
+                    if not block:
+                        break
+                    dst.write(block)
+                    yield
+        yield
+
+def package_artifact(vector_db_folder: str, output_zip_path: str):
+    """
+    [新增] 將索引資料夾打包成硬碟上的 Zip (語料庫註冊需要保存可 memory-map 的檔案)
+    """
+    with timed_stage("package"), zipfile.ZipFile(output_zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for _ in write_artifact_members(zipf, vector_db_folder):
+            pass
+
+class _ZipStreamBuffer(io.RawIOBase):
+    """
+    只能往後寫的緩衝區：zipfile 寫入的資料先暫存，由串流產生器取出後送給用戶端
+    不支援 seek，zipfile 會自動改用 data descriptor 記錄大小
+    """
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+def iter_artifact_zip(vector_db_folder: str):
+    """
+    [新增] 邊打包邊產生 Zip 內容 (不在硬碟上另存一份 Zip)，供 StreamingResponse 直接送給用戶端
+    """
+    buffer = _ZipStreamBuffer()
+    with timed_stage("package"), zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        for _ in write_artifact_members(zipf, vector_db_folder):
+            data = buffer.drain()
+            if data:
+                yield data
+    yield buffer.drain()  # 中央目錄 (central directory)
+
+def artifact_stream_response(vector_db_folder: str, filename: str, headers: Dict[str, str]) -> StreamingResponse:
+    """
+    [新增] 以串流方式回傳索引 Zip (取代先寫出 Zip 再用 FileResponse 回傳)
+    """
+    headers = dict(headers)
+    headers["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return StreamingResponse(iter_artifact_zip(vector_db_folder), media_type="application/zip", headers=headers)
+
+
+# =========================================================
+# [新增] 功能 1-B: 非同步匯入工作 (大型講義包避免代理伺服器逾時)
+# 流程：送出工作取得 job_id -> 查詢各階段進度 -> 完成後下載 FAISS Zip
+# =========================================================
+class IngestJob:
+    """
+    一個非同步匯入工作的狀態
+    status: queued / running / done / failed
+    progress: 各階段進度 (files_loaded, chunks_split, chunks_total, chunks_embedded, index_built 等)
+    """
+    def __init__(self, job_id: str, workspace: Workspace, filename: str, build_options: Optional[dict] = None):
+        self.job_id = job_id
+        self.workspace = workspace  # [新增] 工作專用的暫存資料夾 (結果過期時釋放)
+        self.upload_path = workspace.file("upload.zip")  # 上傳 Zip 的暫存路徑 (工作成功後刪除)
+        self.filename = filename
+        self.build_options = build_options or {}  # [新增] 傳給 build_vector_db_zip 的選項 (例如 artifact_format)
+        self.status = "queued"
+        self.progress: Dict[str, object] = {"stage": "queued"}
+        self.error: Optional[str] = None
+        self.result_path: Optional[str] = None  # 完成後的索引資料夾 (下載時串流打包)
+        self.result_headers: Dict[str, str] = {}
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def update(self, **fields):
+        self.progress.update(fields)
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "filename": self.filename,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "download_url": f"/api/jobs/{self.job_id}/download" if self.status == "done" else None,
+        }
+
+class JobManager:
+    """
+    以固定數量的背景執行緒處理匯入工作
+    排隊中的工作數有上限 (超過回 429)，完成的結果保留 ttl 秒後自動清除
+    """
+    def __init__(self, workers: int, max_queue: int, ttl_seconds: int):
+        self.max_queue = max_queue
+        self.ttl_seconds = ttl_seconds
+        self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="ingest-job")
+        self._jobs: Dict[str, IngestJob] = {}
+        self._lock = threading.Lock()
+        self._janitor: Optional[threading.Thread] = None
+
+    def _check_queue(self):
+        # 呼叫端需持有 _lock
+        queued = sum(1 for j in self._jobs.values() if j.status == "queued")
+        if queued >= self.max_queue:
+            raise StageOverloaded("jobs", 429, "匯入工作排隊已滿，請稍後再試")
+
+    def submit(self, job: IngestJob, api_key: str):
+        with self._lock:
+            self._check_queue()
+            self._jobs[job.job_id] = job
+        # 沿用送出工作的請求 context，工作的日誌與指標可以對應回同一個 request id
+        self._executor.submit(contextvars.copy_context().run, self._run, job, api_key)
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def retry(self, job: IngestJob, api_key: str):
+        """
+        [新增] 重新執行失敗的工作：已向量化的批次都在 Embedding 快取中，只需補上剩下的批次
+        """
+        with self._lock:
+            if job.status != "failed" or not os.path.exists(job.upload_path):
+                raise ValueError("只有失敗且仍保留上傳檔的工作可以重試")
+            self._check_queue()  # [修改] 重試的工作同樣受排隊上限限制
+            job.status, job.error, job.finished_at = "queued", None, None
+            job.progress = {"stage": "queued", "attempt": job.progress.get("attempt", 1) + 1}
+        self._executor.submit(contextvars.copy_context().run, self._run, job, api_key)
+
+    def _run(self, job: IngestJob, api_key: str):
+        """
+        在背景執行緒中執行完整的建庫流程，並更新工作狀態
+        """
+        vector_db_folder = job.workspace.file(job.job_id)
+        try:
+            # [修改] 與 /process_zip 等請求共用 ingest 階段的執行名額 (排隊數已由 max_queue 限制，這裡只等待不拒絕)
+            with STAGES["ingest"].slot(wait=True):
+                job.status = "running"
+                # 只保留索引資料夾，下載時再以串流方式打包 (不另存 Zip)
+                summary = build_vector_db_zip(job.upload_path, api_key, vector_db_folder, None,
+                                              progress=job.update, **job.build_options)
+            job.result_path = vector_db_folder
+            job.result_headers = build_summary_headers(summary)
+            job.update(stage="done")
+            job.status = "done"
+            # 上傳的原始 Zip 用完即刪，只保留建好的索引資料夾 (失敗時保留上傳檔以便重試)
+            cleanup_files([job.upload_path], [])
+        except Exception as e:
+            log_event("job_failed", job_id=job.job_id, error=str(e))
+            job.error = str(e)
+            job.update(stage="failed")
+            job.status = "failed"
+            cleanup_files([], [vector_db_folder])
+        finally:
+            job.finished_at = time.time()
+
+    def purge_expired(self):
+        """
+        刪除超過保留時間的已完成工作與其結果檔
+        """
+        now = time.time()
+        with self._lock:
+            # [修改] 仍在下載中的工作等下載結束後再清除
+            expired = [j for j in self._jobs.values()
+                       if j.finished_at is not None and now - j.finished_at > self.ttl_seconds
+                       and j.workspace.pins == 0]
+            for j in expired:
+                del self._jobs[j.job_id]
+        for j in expired:
+            j.workspace.release()
+
+    def pin_result(self, job: IngestJob) -> bool:
+        """
+        [新增] 下載開始前固定工作的暫存資料夾，下載結束前 purge_expired 不會釋放；工作已被清除時回傳 False
+        """
+        with self._lock:
+            return job.job_id in self._jobs and job.workspace.pin()
+
+    def start_janitor(self):
+        if self._janitor is not None:
+            return
+
+        def _loop():
+            while True:
+                time.sleep(max(10, min(self.ttl_seconds, 300)))
+                self.purge_expired()
+
+        self._janitor = threading.Thread(target=_loop, name="ingest-job-janitor", daemon=True)
+        self._janitor.start()
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for j in self._jobs.values():
+                counts[j.status] = counts.get(j.status, 0) + 1
+            return {"max_queue": self.max_queue, "ttl_seconds": self.ttl_seconds, "jobs": counts}
+
+# 建立全域工作管理器：JOB_WORKERS 個背景執行緒，最多 JOB_QUEUE_MAX 個排隊，結果保留 JOB_RESULT_TTL 秒
+JOB_MANAGER = JobManager(
+    workers=env_int("JOB_WORKERS", 2),
+    max_queue=env_int("JOB_QUEUE_MAX", 16),
+    ttl_seconds=env_int("JOB_RESULT_TTL", 3600),
+)
+
+@app.on_event("startup")
+def start_job_janitor_on_startup():
+    JOB_MANAGER.start_janitor()
+
+def save_upload(upload: UploadFile, dest_path: str):
+    """
+    將上傳檔案寫入硬碟 (非同步工作需要在請求結束後繼續讀取)
+    """
+    upload.file.seek(0)
+    with open(dest_path, "wb") as buffer:
+        shutil.copyfileobj(upload.file, buffer)
+
+@app.post("/api/jobs/process_zip", status_code=202)
+async def submit_process_zip_job(
+    file: UploadFile = File(...),
+    artifact_format: str = Form("mmap"),     # 輸出格式：mmap (預設) 或 faiss (舊格式)
+    dimensions: Optional[int] = Form(None),  # 縮減 Embedding 維度，預設 3072
+    index_type: str = Form("flat")           # 索引類型：flat / flat_f16 / ivf / hnsw / pq
+):
+    """
+    送出非同步匯入工作，立即回傳 job_id
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+    try:
+        build_options = parse_build_options(artifact_format, dimensions, index_type)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    job_id = str(uuid.uuid4())
+    try:
+        # [修改] 工作專用的暫存資料夾 (上傳檔與建好的索引)，預留上傳檔與建庫所需的空間
+        workspace = WORKSPACES.acquire("job", reserve=upload_size(file) * (1 + WORKSPACE_BUILD_FACTOR))
+    except StageOverloaded as e:
+        return overloaded_response(e)
+
+    with workspace:
+        try:
+            # 上傳檔需保留到背景工作處理完為止，先寫入暫存資料夾
+            job = IngestJob(job_id, workspace, file.filename, build_options=build_options)
+            await STAGES["ingest"].run(save_upload, file, job.upload_path)
+            JOB_MANAGER.submit(job, api_key)
+            # 送出成功後由工作管理器在結果過期時釋放 (保險起見設定上限，逾時由清理執行緒釋放)
+            workspace.detach(JOB_MANAGER.ttl_seconds + 24 * 3600)
+        except StageOverloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            return JSONResponse(status_code=500, content={"error": str(e)})
+
+    return {
+        "job_id": job_id,
+        "status_url": f"/api/jobs/{job_id}",
+        "download_url": f"/api/jobs/{job_id}/download",
+    }
+
+@app.get("/api/jobs/{job_id}")
+def get_process_zip_job(job_id: str):
+    """
+    查詢匯入工作的狀態與各階段進度
+    """
+    job = JOB_MANAGER.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "找不到此工作 (可能已過期)"})
+    return job.to_dict()
+
+@app.get("/api/jobs/{job_id}/download")
+def download_process_zip_job(job_id: str, background_tasks: BackgroundTasks):
+    """
+    下載已完成的 FAISS Zip
+    """
+    job = JOB_MANAGER.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "找不到此工作 (可能已過期)"})
+    if job.status == "failed":
+        return JSONResponse(status_code=400, content={"error": job.error})
+    if job.status != "done" or not job.result_path:
+        return JSONResponse(status_code=409, content={"error": "工作尚未完成", "status": job.status})
+    # [新增] 串流送完 (或用戶端斷線) 前固定暫存資料夾，避免結果過期時在下載途中被刪除
+    if not JOB_MANAGER.pin_result(job):
+        return JSONResponse(status_code=404, content={"error": "找不到此工作 (可能已過期)"})
+    background_tasks.add_task(job.workspace.unpin)
+    return artifact_stream_response(job.result_path, f"faiss_db_{job_id[:8]}.zip", job.result_headers)
+
+@app.post("/api/jobs/{job_id}/retry", status_code=202)
+def retry_process_zip_job(job_id: str):
+    """
+    [新增] 重試失敗的匯入工作 (例如中途遇到 API 限流)，已完成的 Embedding 批次直接沿用快取
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+    job = JOB_MANAGER.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "找不到此工作 (可能已過期)"})
+    try:
+        JOB_MANAGER.retry(job, api_key)
+    except StageOverloaded as e:
+        return overloaded_response(e)
+    except ValueError as e:
+        return JSONResponse(status_code=409, content={"error": str(e), "status": job.status})
+    return job.to_dict()
+
+
+# =========================================================
+# [新增] 功能 1-C: 語料庫註冊 (上傳一次，之後以 corpus_id 引用)
+# 流程：POST /api/corpora 上傳 ZIP -> 取得 corpus_id (內容 SHA-256) -> 各 API 以 corpus_id 取代 file
+# =========================================================
+CORPUS_DIR = os.getenv("RAG_CORPUS_DIR", os.path.join(CACHE_DIR, "corpora"))
+os.makedirs(CORPUS_DIR, exist_ok=True)
+
+class CorpusNotFoundError(CorpusInputError):
+    """
+    corpus_id 不存在或已被淘汰時拋出，端點會將其轉為 404 回應
+    """
+    status_code = 404
+
+def corpus_error_response(e: CorpusInputError) -> JSONResponse:
+    """
+    將語料庫相關的錯誤轉為 HTTP 回應 (預設 400，找不到 corpus_id 時 404)
+    """
+    return JSONResponse(status_code=getattr(e, "status_code", 400), content={"error": str(e)})
+
+class CorpusRegistry:
+    """
+    在硬碟上保存已準備好的語料庫：CORPUS_DIR/<corpus_id>/corpus.zip + meta.json
+    - corpus.zip 一律是 RAG 資料庫 (原始文件的 ZIP 在註冊時就建好 mmap 格式的索引)，載入時可直接 memory-map
+    - meta.json 記錄原始檔名、GIS 檔案列表、大小與最後使用時間
+    - 超過存活時間 (TTL) 未使用的語料庫會被刪除；總大小超過配額時淘汰最久未使用 (LRU) 的語料庫
+    """
+    touch_interval = 60  # 最後使用時間最多每 60 秒寫回一次 meta.json
+
+    def __init__(self, root: str, ttl_seconds: int, quota_bytes: int):
+        self.root = root
+        self.ttl_seconds = ttl_seconds
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        self._build_locks: Dict[str, threading.Lock] = {}  # 同一份 ZIP 同時註冊時只建立一次
+        self.evictions = 0
+
+    @staticmethod
+    def valid_id(corpus_id: str) -> bool:
+        return len(corpus_id) == 64 and all(c in "0123456789abcdef" for c in corpus_id)
+
+    def _dir(self, corpus_id: str) -> str:
+        return os.path.join(self.root, corpus_id)
+
+    def _read_meta(self, corpus_id: str) -> Optional[dict]:
+        try:
+            with open(os.path.join(self._dir(corpus_id), "meta.json"), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_meta(self, corpus_id: str, meta: dict):
+        path = os.path.join(self._dir(corpus_id), "meta.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)  # 原子性替換，避免讀到寫一半的檔案
+
+    def _expired(self, meta: dict) -> bool:
+        return self.ttl_seconds > 0 and time.time() - meta.get("last_used", 0) > self.ttl_seconds
+
+    def meta(self, corpus_id: str) -> Optional[dict]:
+        """
+        取得語料庫資訊，不存在或已過期時回傳 None
+        """
+        if not self.valid_id(corpus_id):
+            return None
+        meta = self._read_meta(corpus_id)
+        if meta is None:
+            return None
+        if self._expired(meta):
+            self.delete(corpus_id)
+            return None
+        return meta
+
+    def _touch(self, corpus_id: str, meta: dict):
+        now = time.time()
+        if now - meta.get("last_used", 0) > self.touch_interval:
+            meta["last_used"] = now
+            self._write_meta(corpus_id, meta)
+
+    def register(self, upload_path: str, filename: str, api_key: str) -> tuple:
+        """
+        註冊一份 ZIP (已存在時直接回傳)，回傳 (meta, 是否新建立)
+        原始文件的 ZIP 會在此建立向量索引，之後的請求只需載入
+        """
+        corpus_id = file_sha256(upload_path)
+        with self._lock:
+            build_lock = self._build_locks.setdefault(corpus_id, threading.Lock())
+        try:
+            with build_lock:
+                meta = self.meta(corpus_id)
+                if meta is not None:
+                    self._touch(corpus_id, meta)
+                    return meta, False
+                self._build(corpus_id, upload_path, filename, api_key)
+        finally:
+            with self._lock:
+                self._build_locks.pop(corpus_id, None)
+        self.purge(keep=corpus_id)
+        return self._read_meta(corpus_id), True
+
+    def _build(self, corpus_id: str, upload_path: str, filename: str, api_key: str):
+        # 在暫存資料夾中準備好 corpus.zip 與 meta.json，完成後才原子性地改名為正式資料夾
+        with open_zip(upload_path) as zip_ref:
+            scan = ZipScan(zip_ref)
+        tmp_dir = os.path.join(self.root, f".tmp-{uuid.uuid4()}")
+        os.makedirs(tmp_dir)
+        try:
+            corpus_zip = os.path.join(tmp_dir, "corpus.zip")
+            if scan.mmap_dir is not None or scan.faiss_dir is not None:
+                shutil.copyfile(upload_path, corpus_zip)  # 已經是 RAG 資料庫，原樣保存
+            else:
+                build_vector_db_zip(upload_path, api_key, os.path.join(tmp_dir, "build"), corpus_zip)
+                shutil.rmtree(os.path.join(tmp_dir, "build"), ignore_errors=True)
+            now = time.time()
+            meta = {
+                "corpus_id": corpus_id,
+                "filename": filename,
+                "gis_files": scan.gis_files,  # 原始 ZIP 中的 GIS 檔名 (建好的索引中不含這些檔案)
+                "size_bytes": os.path.getsize(corpus_zip),
+                "created": now,
+                "last_used": now,
+            }
+            with open(os.path.join(tmp_dir, "meta.json"), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False)
+            os.replace(tmp_dir, self._dir(corpus_id))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+    def load(self, corpus_id: str, api_key: str) -> PreparedCorpus:
+        """
+        取得可檢索的語料庫 (經過索引快取，未命中時才從 corpus.zip 載入)
+        """
+        meta = self.meta(corpus_id)
+        if meta is None:
+            raise CorpusNotFoundError(f"找不到語料庫 {corpus_id} (可能已過期，請重新上傳)")
+        self._touch(corpus_id, meta)
+
+        def _build() -> PreparedCorpus:
+            corpus_zip = os.path.join(self._dir(corpus_id), "corpus.zip")
+            corpus = prepare_corpus_from_zip(corpus_zip, api_key, corpus_id)
+            corpus.gis_files = meta.get("gis_files", [])
+            return corpus
+        return INDEX_CACHE.get_or_build(corpus_id, _build)
+
+    def delete(self, corpus_id: str) -> bool:
+        if not self.valid_id(corpus_id) or not os.path.isdir(self._dir(corpus_id)):
+            return False
+        shutil.rmtree(self._dir(corpus_id), ignore_errors=True)
+        # 一併移出索引快取與檢索快取，已刪除的語料庫不再佔用記憶體或被查到
+        INDEX_CACHE.evict(corpus_id)
+        RETRIEVAL_CACHE.invalidate(corpus_id)
+        return True
+
+    def list(self) -> List[dict]:
+        metas = []
+        for name in os.listdir(self.root):
+            meta = self.meta(name)
+            if meta is not None:
+                metas.append(meta)
+        return sorted(metas, key=lambda m: m.get("last_used", 0), reverse=True)
+
+    def purge(self, keep: Optional[str] = None):
+        """
+        刪除過期的語料庫，並在總大小超過配額時依最久未使用的順序淘汰 (剛註冊的 keep 不淘汰)
+        """
+        metas = self.list()  # 過期的項目在讀取時就會被刪除
+        total = sum(m.get("size_bytes", 0) for m in metas)
+        for meta in reversed(metas):  # 由最久未使用的開始
+            if total <= self.quota_bytes:
+                break
+            if meta["corpus_id"] == keep:
+                continue
+            if self.delete(meta["corpus_id"]):
+                total -= meta.get("size_bytes", 0)
+                self.evictions += 1
+                log_event("corpus_evicted", corpus_id=meta["corpus_id"], size_bytes=meta.get("size_bytes", 0))
+
+    def stats(self) -> dict:
+        metas = self.list()
+        return {
+            "path": self.root,
+            "corpora": len(metas),
+            "disk_bytes": sum(m.get("size_bytes", 0) for m in metas),
+            "quota_bytes": self.quota_bytes,
+            "ttl_seconds": self.ttl_seconds,
+            "evictions": self.evictions,
+        }
+
+# 建立全域語料庫註冊表
+CORPUS_REGISTRY = CorpusRegistry(
+    root=CORPUS_DIR,
+    ttl_seconds=env_int("CORPUS_TTL_HOURS", 24 * 30) * 3600,             # 預設 30 天未使用即刪除
+    quota_bytes=env_int("CORPUS_DISK_QUOTA_MB", 4096) * 1024 * 1024,     # 預設 4GB
+)
+
+@app.post("/api/corpora")
+async def register_corpus(file: UploadFile = File(...)):
+    """
+    上傳課程 ZIP (原始文件或 RAG 資料庫) 並取得 corpus_id
+    同一份 ZIP 重複上傳時直接回傳既有的 corpus_id (狀態碼 200)；新建立時回傳 201
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+
+    try:
+        # [修改] 上傳檔先寫入本請求專用的暫存資料夾，離開 with 區塊時一律釋放
+        with WORKSPACES.acquire("corpus", reserve=upload_size(file)) as workspace:
+            upload_path = workspace.file("upload.zip")
+
+            def _register():
+                save_upload(file, upload_path)
+                return CORPUS_REGISTRY.register(upload_path, file.filename, api_key)
+            try:
+                meta, created = await STAGES["ingest"].run(_register)
+            except CorpusInputError as e:
+                return corpus_error_response(e)
+            return JSONResponse(status_code=201 if created else 200, content=meta)
+    except StageOverloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+@app.get("/api/corpora")
+def list_corpora():
+    return {"corpora": CORPUS_REGISTRY.list()}
+
+@app.get("/api/corpora/{corpus_id}")
+def get_corpus(corpus_id: str):
+    meta = CORPUS_REGISTRY.meta(corpus_id)
+    if meta is None:
+        return JSONResponse(status_code=404, content={"error": "找不到此語料庫 (可能已過期)"})
+    return meta
+
+@app.delete("/api/corpora/{corpus_id}")
+def delete_corpus(corpus_id: str):
+    if not CORPUS_REGISTRY.delete(corpus_id):
+        return JSONResponse(status_code=404, content={"error": "找不到此語料庫"})
+    return {"deleted": corpus_id}
+
+# [新增] 伺服器啟動時清理過期或超過配額的語料庫
+@app.on_event("startup")
+def purge_corpora_on_startup():
+    CORPUS_REGISTRY.purge()
+
+
+
+# =========================================================
+# [新增] 功能 1-D: 增量更新索引 (新增/移除文件，不必重新處理整份講義包)
+# 只有新增的 Chunk 需要 Embedding；結果與用完整來源重新執行 /process_zip 幾乎相同 (差異見 update_vector_db_zip)
+# =========================================================
+class ArtifactContents:
+    """
+    從既有索引 ZIP 讀出的內容
+    docs: 所有 Chunk (依索引中的順序)
+    index: 載入的向量索引 (FAISS 索引或 MmapFlatIndex)
+    vectors: 對應的向量 (索引無法還原原始向量時為 None，例如 pq，改由 Embedding 快取取得)
+    """
+    def __init__(self, artifact_format: str, index_type: str, dimensions: int,
+                 docs: List[Document], index, vectors: Optional[np.ndarray]):
+        self.artifact_format = artifact_format
+        self.index_type = index_type
+        self.dimensions = dimensions
+        self.docs = docs
+        self.index = index
+        self.vectors = vectors
+
+def faiss_index_type(index) -> str:
+    """
+    判斷舊格式 index.faiss 的索引類型 (對應 INDEX_TYPES)
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexFlat):
+        return "flat"
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return "flat_f16"
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexPQ):
+        return "pq"
+    return "ivf"
+
+def read_artifact(zip_path: str, api_key: str) -> ArtifactContents:
+    """
+    讀取既有的索引 ZIP (mmap 或舊的 faiss 格式)，取出所有 Chunk 與可還原的向量
+    """
+    with open_zip(zip_path) as zip_ref:
+        scan = ZipScan(zip_ref)
+        if scan.mmap_dir is not None:
+            manifest = json.loads(read_member(zip_ref, zip_ref.getinfo(scan.mmap_dir + MMAP_MANIFEST)).decode("utf-8"))
+            vectorstore = load_mmap_from_zip(zip_ref, zip_path, scan.mmap_dir, api_key)
+            artifact_format = "mmap"
+            index_type = (manifest.get("index") or {}).get("type", "flat")
+        elif scan.faiss_dir is not None:
+            vectorstore = load_faiss_from_zip(zip_ref, scan.faiss_dir, api_key)
+            artifact_format = "faiss"
+            index_type = faiss_index_type(vectorstore.index)
+        else:
+            raise CorpusInputError("上傳的檔案不是索引 ZIP (找不到 manifest.json 或 index.faiss/index.pkl)")
+
+    index = vectorstore.index
+    n = int(index.ntotal)
+    docs = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in range(n)]
+    if any(not isinstance(d, Document) for d in docs):
+        raise CorpusInputError("索引內容與 docstore 不一致")
+    vectors = None
+    if isinstance(index, MmapFlatIndex):
+        vectors = np.asarray(index.vectors, dtype=np.float32)
+    elif index_type in ("flat", "flat_f16", "hnsw", "ivf") and n:
+        # 這些索引保存了原始向量 (flat_f16 為 float16，重建時量化結果相同)，可直接還原
+        ivf = faiss.try_extract_index_ivf(index)
+        if ivf is not None:
+            ivf.make_direct_map()  # IVF 需要 id -> 位置的對照表才能還原
+        vectors = index.reconstruct_n(0, n)
+    return ArtifactContents(artifact_format, index_type, int(index.d), docs, index, vectors)
+
+def surviving_vectors(base: ArtifactContents, removed_ids: List[int]) -> Dict[str, np.ndarray]:
+    """
+    依 id 移除向量，回傳保留下來的 Chunk 向量 (以內容雜湊對應)
+    flat 的 FAISS 索引直接以 remove_ids 移除；索引無法還原向量時回傳空 dict
+    """
+    removed = set(removed_ids)
+    keep = [i for i in range(len(base.docs)) if i not in removed]
+    if isinstance(base.index, faiss.IndexFlat):
+        base.index.remove_ids(np.asarray(removed_ids, dtype=np.int64))
+        vectors = base.index.reconstruct_n(0, base.index.ntotal)
+    elif base.vectors is not None:
+        vectors = base.vectors[keep]
+    else:
+        return {}
+    return {EmbeddingStore.text_hash(base.docs[i].page_content): v for i, v in zip(keep, vectors)}
+
+def parse_source_list(raw: Optional[str]) -> List[str]:
+    """
+    解析要移除的來源：JSON 陣列或以換行分隔的 ZIP 內相對路徑
+    """
+    if not raw or not raw.strip():
+        return []
+    raw = raw.strip()
+    if raw.startswith("["):
+        try:
+            items = json.loads(raw)
+        except json.JSONDecodeError:
+            raise CorpusInputError("remove_sources 不是合法的 JSON 陣列")
+        if not all(isinstance(i, str) for i in items):
+            raise CorpusInputError("remove_sources 必須是字串陣列")
+        return items
+    return [line.strip() for line in raw.splitlines() if line.strip()]
+
+def update_vector_db_zip(base_zip_path: str, add_source, remove_sources: List[str], api_key: str,
+                         vector_db_folder: str, output_zip_path: Optional[str] = None) -> dict:
+    """
+    /api/update_index 的阻塞工作：讀取既有索引 -> 移除指定來源 -> 新增文件 (只向量化新 Chunk) -> 重建索引 -> 打包
+    新增的檔案若與既有來源同路徑，視為新版本並取代舊的 Chunk
+    重複 Chunk 群組會還原成合併前的成員再重新去重，主要來源被移除時由剩下的成員 (以其自己的內容) 代表，
+    結果與用完整講義包重新執行 /process_zip 相同
+    (舊版建立、沒有保存 metadata["duplicates"] 的索引無法還原成員，仍沿用被移除那份的內容)
+    回傳統計數據 (去重後新增/移除的 Chunk 數與 Embedding 快取沿用數)
+    """
+    with timed_stage("load_index"):
+        base = read_artifact(base_zip_path, api_key)
+    embeddings = get_embeddings(api_key, dimensions=base.dimensions)
+
+    # 1. 讀取並切分要新增的文件 (與 /process_zip 相同的讀取與切分方式)
+    new_docs: List[Document] = []
+    if add_source is not None:
+        with timed_stage("parse"):
+            added_documents = process_zip_to_docs(add_source)
+        if not added_documents:
+            raise CorpusInputError("新增的 Zip 內無支援的文件")
+        with timed_stage("split"):
+            new_docs = split_documents(added_documents)
+
+    # 2. 移除指定來源與被新版本取代的來源：還原每個 Chunk 合併前的成員，只留下未被移除的來源
+    existing_sources = {s for d in base.docs for s in chunk_sources(d)}
+    missing = [src for src in remove_sources if src not in existing_sources]
+    if missing:
+        raise CorpusInputError(f"索引中找不到以下來源: {', '.join(missing)}")
+    dropped = set(remove_sources) | {d.metadata.get("source") for d in new_docs}
+    removed_ids: List[int] = []  # 主要來源被移除的 Chunk，其向量由索引中刪除
+    members: List[Document] = []
+    for i, d in enumerate(base.docs):
+        if d.metadata.get("source") in dropped:
+            removed_ids.append(i)
+        if "duplicates" not in d.metadata and len(chunk_sources(d)) > 1:
+            # 舊版索引：無法還原成員，改由下一個來源代表
+            remaining = [s for s in chunk_sources(d) if s not in dropped]
+            if remaining:
+                members.append(restrict_sources(d, remaining))
+            continue
+        members.extend(m for m in chunk_members(d) if m.metadata.get("source") not in dropped)
+
+    # 3. 依來源路徑與來源內的順序排序 (與完整重建時依 ZIP 路徑讀檔、切分的順序相同)，再重新去重
+    # 新增的 Chunk 若與既有的重複，直接併入既有的 Chunk，不必向量化
+    merged = members + new_docs
+    order = sorted(range(len(merged)), key=lambda i: (merged[i].metadata.get("source", ""),
+                                                     merged[i].metadata.get("chunk_index", i), i))
+    with timed_stage("dedup"):
+        docs, _, dedup_stats = dedup_chunks([merged[i] for i in order])
+    if not docs:
+        raise CorpusInputError("更新後索引沒有任何 Chunk")
+
+    # 4. 保留的 Chunk 沿用索引中的向量 (依 id 移除被刪掉的向量)；其餘 (新的代表或無法還原向量的索引)
+    # 由 Embedding 快取取得，快取也沒有時才呼叫 Embedding API
+    kept = surviving_vectors(base, removed_ids)
+    if kept and base.index_type in ("flat", "hnsw", "ivf"):
+        # float32 的原始向量順便寫回 Embedding 快取，之後的建庫也能沿用
+        EMBEDDING_STORE.put_many(embeddings.model, {h: v.tolist() for h, v in kept.items()})
+    hashes = [EmbeddingStore.text_hash(d.page_content) for d in docs]
+    vectors: List[Optional[np.ndarray]] = [kept.get(h) for h in hashes]
+    pending = [i for i, v in enumerate(vectors) if v is None]
+    with timed_stage("embed"):
+        new_vectors = embeddings.embed_documents([docs[i].page_content for i in pending]) if pending else []
+    for i, v in zip(pending, new_vectors):
+        vectors[i] = np.asarray(v, dtype=np.float32)
+
+    # 5. 以原本的格式與索引類型寫出 (output_zip_path 為 None 時由呼叫端串流打包)
+    with timed_stage("index"):
+        write_artifact(vector_db_folder, base.artifact_format, np.stack(vectors), docs, embeddings, base.index_type)
+    if output_zip_path is not None:
+        package_artifact(vector_db_folder, output_zip_path)
+
+    # 去重後的增減：以 Chunk 內容比對更新前後的索引
+    base_hashes = {EmbeddingStore.text_hash(d.page_content) for d in base.docs}
+    final_hashes = set(hashes)
+    return {
+        "chunks_total": len(docs),
+        "chunks_added": sum(1 for h in hashes if h not in base_hashes),
+        "chunks_removed": len(base_hashes - final_hashes),
+        **dedup_stats,
+        "embedding_reused": embeddings.reused,
+        "embedding_new": embeddings.embedded,
+    }
+
+@app.post("/api/update_index")
+async def update_index(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),                   # 既有的索引 ZIP (/process_zip 的產出)
+    add_file: Optional[UploadFile] = File(None),    # 要新增 (或更新) 的原始文件 ZIP，路徑需與原講義包一致
+    remove_sources: Optional[str] = Form(None)      # 要移除的來源 (source metadata)，JSON 陣列或每行一個
+):
+    """
+    增量更新索引並回傳更新後的 ZIP (格式與索引類型與上傳的索引相同)
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+
+    task_id = str(uuid.uuid4())
+    try:
+        # [修改] 本請求專用的暫存資料夾：預留既有索引 (上傳檔與重建後各一份) 與新增文件建庫所需的空間
+        reserve = upload_size(file) * 2 + (upload_size(add_file) * WORKSPACE_BUILD_FACTOR if add_file else 0)
+        workspace = WORKSPACES.acquire("update_index", reserve=reserve)
+    except StageOverloaded as e:
+        return overloaded_response(e)
+
+    # 離開 with 區塊時一律釋放暫存資料夾，除非已交給串流回應
+    with workspace:
+        base_zip_path = workspace.file("base.zip")
+        vector_db_folder = workspace.file(task_id)
+        try:
+            try:
+                sources = parse_source_list(remove_sources)
+                if not add_file and not sources:
+                    raise CorpusInputError("請提供 add_file 或 remove_sources")
+
+                def _update():
+                    # 既有索引寫入暫存資料夾，讀取時可直接 memory-map
+                    save_upload(file, base_zip_path)
+                    return update_vector_db_zip(base_zip_path, add_file.file if add_file else None, sources,
+                                                api_key, vector_db_folder)
+                summary = await STAGES["ingest"].run(_update)
+            except CorpusInputError as e:
+                return corpus_error_response(e)
+
+            background_tasks.add_task(workspace.detach(WORKSPACE_STREAM_SECONDS).release)
+            return artifact_stream_response(
+                vector_db_folder,
+                f"faiss_db_{task_id[:8]}.zip",
+                {
+                    "X-Chunks-Total": str(summary["chunks_total"]),
+                    "X-Chunks-Added": str(summary["chunks_added"]),
+                    "X-Chunks-Removed": str(summary["chunks_removed"]),
+                    "X-Chunks-Exact-Duplicates": str(summary["chunks_exact_duplicates"]),
+                    "X-Chunks-Near-Duplicates": str(summary["chunks_near_duplicates"]),
+                    "X-Embedding-Reused": str(summary["embedding_reused"]),
+                    "X-Embedding-New": str(summary["embedding_new"]),
+                },
+            )
+        except StageOverloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+
+# --- [新增] 串流 (Server-Sent Events) 輔助函數 ---
+def sse_event(event: str, data) -> str:
+    """
+    組合一則 SSE 訊息 (event 名稱 + JSON 資料)
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# SSE 回應共用的 Header：關閉快取與代理伺服器緩衝，讓每個 token 立即送達瀏覽器
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+async def stream_in_thread(stage: StageLimiter, make_iter: Callable[[], object]):
+    """
+    在指定階段的執行緒池中逐一取出同步迭代器 (例如 OpenAI 串流回應) 的項目
+    並以非同步產生器的形式交給事件迴圈，事件迴圈不會被阻塞
+    用戶端中途斷線時會通知執行緒停止讀取並關閉上游串流
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def _produce():
+        if stop.is_set():
+            return  # 排隊等待名額期間用戶端已斷線，不必再開啟上游串流
+        iterator = make_iter()
+        try:
+            for item in iterator:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, ("item", item))
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, ("error", e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close:
+                close()  # 關閉上游 HTTP 串流，釋放連線
+            loop.call_soon_threadsafe(queue.put_nowait, ("done", None))
+
+    async def _runner():
+        try:
+            await stage.run(_produce)
+        except BaseException as e:
+            # 排隊已滿或等待逾時 (_produce 沒有執行)，直接通知消費端
+            queue.put_nowait(("error", e))
+            queue.put_nowait(("done", None))
+
+    task = asyncio.ensure_future(_runner())
+    try:
+        while True:
+            kind, item = await queue.get()
+            if kind == "item":
+                yield item
+            elif kind == "error":
+                raise item
+            else:
+                break
+    finally:
+        # 正常結束或用戶端斷線：通知執行緒停止；仍在等待的 task 直接取消，並等它結束 (有例外時拋出)
+        stop.set()
+        if not task.done():
+            task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+def iter_chat_tokens(client: OpenAI, **kwargs):
+    """
+    以串流模式呼叫 Chat Completions，逐一產生文字片段 (token)
+    [新增] 記錄第一個字的等待時間 (llm_first_token)、整段串流耗時 (llm) 與最後一個 chunk 附帶的 token 用量
+    """
+    model = kwargs.get("model", "")
+    start = time.perf_counter()
+    first = True
+    with timed_stage("llm"):
+        stream = client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **kwargs)
+        try:
+            for chunk in stream:
+                if getattr(chunk, "usage", None):
+                    record_llm_usage(model, chunk.usage)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if first:
+                        first = False
+                        STAGE_LATENCY.observe(time.perf_counter() - start, endpoint=REQUEST_ENDPOINT.get(),
+                                              stage="llm_first_token")
+                    yield chunk.choices[0].delta.content
+        finally:
+            stream.close()
+
+# =========================================================
+# 功能 2: 上傳並直接問答 (支援 RAG Zip 或 原始文件 Zip)
+# =========================================================
+# 定義 Prompt Template (提示詞模板)，指導 AI 如何回答
+ASK_PROMPT_TEMPLATE = """你是一個專業的助教。請根據以下的上下文內容來回答學生的問題。
+
+        上下文:
+        {context}
+
+        問題: {question}
+
+        回答:"""
+
+@app.post("/ask_with_zip")
+async def ask_with_zip(
+    background_tasks: BackgroundTasks, # 用於設定背景清理任務
+    question: str = Form(...),         # 接收使用者輸入的問題 (Form Data)
+    file: Optional[UploadFile] = File(None),  # 接收使用者上傳的檔案 (Zip)
+    corpus_id: Optional[str] = Form(None)     # [新增] 或使用已註冊語料庫的 corpus_id (不必重新上傳)
+):
+    """
+    這是主要的問答 API。
+    它會自動偵測上傳的 Zip 是「已經做好的 RAG 資料庫」還是「原始文件」。
+    """
+    # 取得 OpenAI API Key
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+    if not file and not corpus_id:
+        return JSONResponse(status_code=400, content={"error": "請上傳檔案或提供 corpus_id"})
+
+    try:
+        # === 關鍵邏輯：由索引快取取得語料庫 ===
+        # 以上傳檔案內容的指紋 (SHA-256) 查詢，同一份 ZIP 重複上傳時直接命中，跳過讀檔與 Embedding
+        # 未命中時才會自動偵測是 RAG 資料庫 (FAISS) 還是原始文件並建立
+        try:
+            corpus = await resolve_corpus(file, api_key, empty_error="Zip 內無支援的文件 (亦非 RAG DB)",
+                                          corpus_id=corpus_id)
+        except CorpusInputError as e:
+            # ZIP 格式錯誤或無支援的文件，回傳 400 (corpus_id 不存在時回傳 404)
+            return corpus_error_response(e)
+
+        # === 問答流程 (Retrieval & Generation) ===
+        # [修改] 不再使用 RetrievalQA 的 "stuff" 模式 (無上限地塞入所有段落)：
+        # 檢索 5 個最相關的片段 (經過檢索快取)，合併重疊段落並控制在 token 預算內後組合 Prompt
+        docs = await retrieve_docs(corpus, question, k=5)
+        context = await assemble_context(docs)
+        prompt = ASK_PROMPT_TEMPLATE.format(context=context.text, question=question)
+
+        # 呼叫 GPT-4o 回答 (阻塞呼叫，交給 llm 階段的執行緒池)
+        client = await resolve_openai_client()
+        response = await STAGES["llm"].run(
+            chat_completion, client,
+            model="gpt-4o",
+            temperature=0,
+            messages=[{"role": "user", "content": prompt}],
+        )
+
+        # === 回傳 ===
+        # (上傳檔直接從記憶體讀取，沒有解壓縮的暫存檔需要清理)
+        # 回傳 JSON 結果，並透過 Header 回報講義內容使用與省下的 token 數
+        return JSONResponse(content={
+            "question": question, # 回傳原始問題
+            "answer": response.choices[0].message.content, # 回傳 AI 的回答
+            # 回傳參考資料來源 (去重複，含合併掉的重複 Chunk 的來源)，如果有 metadata 則顯示檔名，否則顯示 unknown
+            "sources": source_filenames(docs)
+        }, headers=context.headers())
+
+    except StageOverloaded as e:
+        # 伺服器忙碌：回傳 429/503，而不是無限排隊
+        return overloaded_response(e)
+    except Exception as e:
+        # 如果發生任何未預期的錯誤
+        # 回傳 500 錯誤與詳細錯誤訊息
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+# =========================================================
+# [新增] 功能 2-B: 串流問答 (SSE)
+# 先送出檢索到的參考來源，再逐字送出 AI 回答，縮短學生等待第一個字的時間
+# =========================================================
+@app.post("/ask_with_zip/stream")
+async def ask_with_zip_stream(
+    question: str = Form(...),         # 接收使用者輸入的問題 (Form Data)
+    file: Optional[UploadFile] = File(None),  # 接收使用者上傳的檔案 (Zip)
+    corpus_id: Optional[str] = Form(None)     # [新增] 或使用已註冊語料庫的 corpus_id
+):
+    """
+    串流版問答 API，回傳 text/event-stream：
+    event: sources -> 參考來源檔名
+    event: token   -> 回答的文字片段 (逐一送出)
+    event: done    -> 完整回答
+    event: error   -> 串流過程中發生錯誤
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+    if not file and not corpus_id:
+        return JSONResponse(status_code=400, content={"error": "請上傳檔案或提供 corpus_id"})
+
+    try:
+        # 取得語料庫並檢索 (在開始串流前完成，錯誤仍可用 HTTP 狀態碼回報)
+        try:
+            corpus = await resolve_corpus(file, api_key, empty_error="Zip 內無支援的文件 (亦非 RAG DB)",
+                                          corpus_id=corpus_id)
+        except CorpusInputError as e:
+            return corpus_error_response(e)
+        docs = await retrieve_docs(corpus, question, k=5)
+        # [修改] 合併重疊段落並控制在 token 預算內後組合 Prompt (與非串流版本相同)
+        context = await assemble_context(docs)
+        client = await resolve_openai_client()
+    except StageOverloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    prompt = ASK_PROMPT_TEMPLATE.format(context=context.text, question=question)
+    sources = source_filenames(docs)
+
+    async def event_stream():
+        # 1. 先送出參考來源
+        yield sse_event("sources", {"question": question, "sources": sources})
+        # 2. 逐一送出 GPT-4o 回答的 token
+        answer_parts: List[str] = []
+        try:
+            async for token in stream_in_thread(
+                STAGES["llm"],
+                lambda: iter_chat_tokens(
+                    client, model="gpt-4o", temperature=0, messages=[{"role": "user", "content": prompt}]
+                ),
+            ):
+                answer_parts.append(token)
+                yield sse_event("token", {"text": token})
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+            return
+        # 3. 最後送出完整回答 (格式與非串流版本相同)
+        yield sse_event("done", {"question": question, "answer": "".join(answer_parts), "sources": sources})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={**SSE_HEADERS, **context.headers()})
+
+
+# --- [新增] 共通函數：組合出題用的 Prompt (一般與串流版本共用) ---
+def build_question_messages(qtype: str, level: str, file_names_str: str, context_text: str) -> List[dict]:
+    """
+    組合出題的 System Prompt 與 User Prompt，嚴格限制 AI 行為
+    """
+    sys_role = "你是頂尖的空間分析助教。請使用 GPT-4o 的強大邏輯來出題。"
+    r_rules = """⚠️ 嚴格限制：
+1. 實作內容必須限定使用 **R 語言** (例如使用 sf, terra, tmap, tidyverse 等套件)。
+2. 🚫 禁止提及 "ArcGIS", "QGIS" 或通用的 "GIS 軟體" 字眼。
+3. 題目應引導學生寫出 R 程式碼來解決問題。
+4. **請務必使用繁體中文 (Traditional Chinese) 出題。**"""
+    
+    system_instruction = f"""你必須從提供的「真實檔案列表」中選擇一個檔案來設計操作任務。
+真實檔案列表: [{file_names_str}]
+(若選擇 Shapefile，請只提及 .shp 檔，不要提及 .dbf 或 .shx)
+{r_rules}
+【出題重要規範】
+1. 在 'question_content' (題目) 中：只說明**任務目標**與**使用資料**。❌ 嚴禁直接列出步驟 1, 2, 3。請保留思考空間給學生。
+2. 在 'hint' (提示) 中：才列出詳細的解題步驟、建議使用的 R 套件與函數。"""
+
+    task_instruction = f"目前的題型任務是：【{qtype}】。難度：{level}。"
+    core_point = "🔥 **本次題目核心考點：請根據以下參考講義內容設計**"
+
+    final_system_prompt = f"""
+{sys_role}
+{task_instruction}
+{core_point}
+(Please design the question around the core concept above.)
+{system_instruction}
+請以 JSON 格式回傳：
+{{ "question_content": "Question content (Markdown)...", "hint": "Hint for students...", "target_filename": "AI選擇的檔案名稱" }}
+"""
+    user_prompt_text = f"參考講義內容：\n{context_text}"
+    return [
+        {"role": "system", "content": final_system_prompt},
+        {"role": "user", "content": user_prompt_text}
+    ]
+
+# --- [新增] 共通函數：依語料庫生成一道題目 (出題 API 與背景補題共用) ---
+async def generate_question(client: OpenAI, corpus: PreparedCorpus, qtype: str, level: str):
+    """
+    檢索與題型/難度相關的講義內容，呼叫 GPT-4o 生成題目
+    回傳 (解析後的 JSON, 組合好的講義內容)
+    """
+    # 檔案列表 (File List) - 讓 AI 知道有哪些 GIS 檔案可用
+    # 已在準備語料庫時掃描並隨快取保存，不必再走訪目錄
+    file_names = corpus.gis_files
+    file_names_str = ", ".join(file_names) if file_names else "None"
+
+    # RAG 檢索 (Retrieval) - 找出與「題型/難度」相關的內容
+    query = f"空間分析 {level} {qtype} 重點概念與操作步驟"
+    # 撈前 5 個相關段落；查詢只由題型與難度決定，重複的組合直接由檢索快取取得
+    docs = await retrieve_docs(corpus, query, k=5)
+    context = await assemble_context(docs) # 組合 Context 文字 (合併重疊段落並控制 token 預算)
+
+    # 組合 Prompt (System Prompt) - 嚴格限制 AI 行為
+    messages = build_question_messages(qtype, level, file_names_str, context.text)
+
+    # 呼叫 GPT-4o 生成題目 (阻塞呼叫，交給 llm 階段的執行緒池)
+    response = await STAGES["llm"].run(
+        chat_completion, client,
+        model="gpt-4o",
+        messages=messages,
+        response_format={"type": "json_object"}, # 強制回傳 JSON
+        temperature=0.7 # 保持一點創造力
+    )
+    return json.loads(response.choices[0].message.content), context
+
+# --- [新增] 預先生成的題庫 (每個題型/難度一個佇列，背景補題) ---
+class QuestionPool:
+    """
+    針對預設語料庫，為每個 (題型, 難度) 預先準備幾道題目
+    整班同時開啟練習頁時可直接取出現成題目，背景工作再慢慢補回水位
+    - 題型/難度組合在第一次被請求時登記 (也可用 QUESTION_POOL_KEYS 預先指定)
+    - 預設語料庫更新 (指紋改變) 時清空題庫，避免出到舊講義的題目
+    - 補題只在 llm 階段有空閒名額時進行，不與即時請求搶名額
+    """
+    def __init__(self, target: int, max_keys: int, refill_interval: int, preset_keys: List[tuple]):
+        self.target = target                    # 每個組合的目標水位 (0 表示停用題庫)
+        self.max_keys = max_keys                # 最多登記幾個組合
+        self.refill_interval = refill_interval  # 沒有補題需求時，多久檢查一次 (秒)
+        self._pools: Dict[tuple, deque] = {key: deque() for key in preset_keys[:max_keys]}
+        self._fingerprint: Optional[str] = None  # 題庫對應的語料庫指紋
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._refill_times: deque = deque()     # 最近補題完成的時間，用於計算補題速率
+        self.hits = 0           # 直接取得現成題目的次數
+        self.misses = 0         # 題庫為空、需即時生成的次數
+        self.refilled = 0       # 背景補題成功的題數
+        self.refill_errors = 0  # 背景補題失敗的次數
+
+    def _sync_fingerprint(self, fingerprint: str):
+        # 語料庫改變時清空所有佇列 (保留已登記的組合)
+        if fingerprint != self._fingerprint:
+            self._fingerprint = fingerprint
+            for pool in self._pools.values():
+                pool.clear()
+
+    def pop(self, fingerprint: str, qtype: str, level: str) -> Optional[dict]:
+        """
+        取出一道現成題目，沒有時回傳 None；並喚醒背景工作補題
+        """
+        if self.target <= 0:
+            return None
+        self._sync_fingerprint(fingerprint)
+        key = (qtype, level)
+        if key not in self._pools and len(self._pools) < self.max_keys:
+            self._pools[key] = deque()
+        pool = self._pools.get(key)
+        if self._wakeup is not None:
+            self._wakeup.set()
+        if pool:
+            self.hits += 1
+            return pool.popleft()
+        self.misses += 1
+        return None
+
+    def _next_key(self) -> Optional[tuple]:
+        # 挑選目前水位最低、且未達目標的組合
+        lacking = [(len(pool), key) for key, pool in self._pools.items() if len(pool) < self.target]
+        return min(lacking)[1] if lacking else None
+
+    async def refill_loop(self):
+        """
+        背景補題：持續把各組合補到目標水位
+        """
+        self._wakeup = asyncio.Event()
+        llm = STAGES["llm"]
+        while True:
+            corpus = DEFAULT_CORPUS.peek()
+            api_key = os.getenv("OPENAI_API_KEY")
+            key = None
+            if corpus is not None and api_key:
+                self._sync_fingerprint(corpus.fingerprint)
+                key = self._next_key()
+            # 沒有補題需求，或 llm 階段正在忙 (有人排隊或名額用完) 時先等待
+            if key is None or llm.waiting > 0 or llm.active >= llm.concurrency:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.refill_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                question, _ = await generate_question(await resolve_openai_client(), corpus, *key)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.refill_errors += 1
+                log_event("question_pool_refill_failed", key=key, error=str(e))
+                await asyncio.sleep(self.refill_interval)
+                continue
+            # 生成期間語料庫可能已更新，只保留屬於目前語料庫的題目
+            if corpus.fingerprint == self._fingerprint and key in self._pools:
+                self._pools[key].append(question)
+                self.refilled += 1
+                self._refill_times.append(time.time())
+
+    def start(self):
+        if self.target > 0 and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.refill_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        now = time.time()
+        while self._refill_times and now - self._refill_times[0] > 60:
+            self._refill_times.popleft()
+        lookups = self.hits + self.misses
+        return {
+            "target": self.target,
+            "fingerprint": self._fingerprint,
+            "depth": {f"{qtype}|{level}": len(pool) for (qtype, level), pool in self._pools.items()},
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": (self.hits / lookups) if lookups else 0.0,
+            "refilled": self.refilled,
+            "refill_errors": self.refill_errors,
+            "refill_per_minute": len(self._refill_times),
+        }
+
+def parse_pool_keys(raw: str) -> List[tuple]:
+    """
+    解析 QUESTION_POOL_KEYS，格式為「題型|難度」並以分號分隔，例如 "實作題|初級;簡答題|中級"
+    """
+    keys = []
+    for item in raw.split(";"):
+        if "|" in item:
+            qtype, level = item.split("|", 1)
+            keys.append((qtype.strip(), level.strip()))
+    return keys
+
+# 建立全域題庫實例
+QUESTION_POOL = QuestionPool(
+    target=env_int("QUESTION_POOL_SIZE", 3),                             # 每個組合預備 3 題 (0 表示停用)
+    max_keys=env_int("QUESTION_POOL_MAX_KEYS", 32),
+    refill_interval=env_int("QUESTION_POOL_REFILL_INTERVAL", 5),
+    preset_keys=parse_pool_keys(os.getenv("QUESTION_POOL_KEYS", "")),
+)
+
+# [新增] 伺服器啟動時開始背景補題，關閉時停止
+@app.on_event("startup")
+async def start_question_pool():
+    QUESTION_POOL.start()
+
+@app.on_event("shutdown")
+async def stop_question_pool():
+    QUESTION_POOL.stop()
+
+# =========================================================
+# [新增] API 3: 智慧出題 (Generate Question)
+# 邏輯：優先使用上傳的檔案，若無則使用伺服器啟動時載入的 'rag_db.zip'
+# =========================================================
+@app.post("/api/generate_question")
+async def generate_practice_question_with_upload(
+    background_tasks: BackgroundTasks, # 用於設定背景清理任務
+    file: Optional[UploadFile] = File(None), # [關鍵修改] 檔案為可選 (Optional)，預設為 None
+    qtype: str = Form(...),            # 使用 Form Data 接收題型
+    level: str = Form(...),            # 使用 Form Data 接收難度
+    corpus_id: Optional[str] = Form(None)  # [新增] 已註冊語料庫的 corpus_id (優先於 file)
+):
+    """
+    【一條龍出題 API】
+    1. 檢查是否有上傳 ZIP，若有則使用。
+    2. 若無上傳，使用伺服器啟動時已載入記憶體的 'rag_db.zip' (檔案變更時自動熱更新)。
+    3. 自動載入向量資料庫 -> 檢索 Context -> 偵測檔案列表 -> 呼叫 GPT-4o 生成題目。
+    """
+    # 檢查 API Key
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key: return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+    
+    # === [關鍵邏輯] 決定使用哪個 ZIP 檔案來源 ===
+    if file:
+        # 情境 A: 使用者有上傳檔案
+        log_event("upload_received", filename=file.filename)
+    # 情境 B: 使用者沒上傳，使用伺服器啟動時已載入記憶體的預設語料庫 (不做任何檔案 I/O)
+
+    try:
+        # 2~4. 上傳的檔案由索引快取取得語料庫 (未命中時才掃描 ZIP、偵測 FAISS DB 並載入或現場製作)
+        try:
+            corpus = await resolve_corpus(file, api_key, empty_error="Zip 內無支援的講義文件",
+                                          corpus_id=corpus_id)
+        except CorpusInputError as e:
+            # 兩者皆無或 ZIP 不合法，回傳錯誤
+            return corpus_error_response(e)
+
+        # 5. 預設語料庫且題庫中有現成題目時直接回傳，不必等待 GPT-4o
+        if not file and not corpus_id:
+            pooled = QUESTION_POOL.pop(corpus.fingerprint, qtype, level)
+            if pooled is not None:
+                return pooled
+
+        # 6~9. 檢索講義並呼叫 GPT-4o 生成題目，回傳生成的 JSON (共用的 OpenAI 原生客戶端)
+        client = await resolve_openai_client()
+        question, context = await generate_question(client, corpus, qtype, level)
+        return JSONResponse(content=question, headers=context.headers())
+
+    except StageOverloaded as e:
+        # 伺服器忙碌：回傳 429/503
+        return overloaded_response(e)
+    except Exception as e:
+        # 發生錯誤時回傳 500
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+# =========================================================
+# [新增] API 3-B: 串流出題 (SSE)
+# 先送出參考來源，再隨著 GPT-4o 產生內容送出「目前為止解析得到的部分 JSON」
+# =========================================================
+@app.post("/api/generate_question/stream")
+async def generate_practice_question_stream(
+    file: Optional[UploadFile] = File(None), # 檔案為可選 (Optional)，未上傳時使用預設語料庫
+    qtype: str = Form(...),            # 使用 Form Data 接收題型
+    level: str = Form(...),            # 使用 Form Data 接收難度
+    corpus_id: Optional[str] = Form(None)  # [新增] 已註冊語料庫的 corpus_id (優先於 file)
+):
+    """
+    串流版出題 API，回傳 text/event-stream：
+    event: sources -> 參考來源檔名與可用的 GIS 檔案列表
+    event: partial -> 目前為止可解析的部分 JSON (question_content / hint / target_filename)
+    event: done    -> 完整 JSON (格式與非串流版本相同)
+    event: error   -> 串流過程中發生錯誤
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key: return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+
+    try:
+        try:
+            corpus = await resolve_corpus(file, api_key, empty_error="Zip 內無支援的講義文件",
+                                          corpus_id=corpus_id)
+        except CorpusInputError as e:
+            return corpus_error_response(e)
+        query = f"空間分析 {level} {qtype} 重點概念與操作步驟"
+        docs = await retrieve_docs(corpus, query, k=5)
+        context = await assemble_context(docs)
+        client = await resolve_openai_client()
+    except StageOverloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    file_names = corpus.gis_files
+    file_names_str = ", ".join(file_names) if file_names else "None"
+    messages = build_question_messages(qtype, level, file_names_str, context.text)
+    sources = source_filenames(docs)
+
+    async def event_stream():
+        # 1. 先送出參考來源
+        yield sse_event("sources", {"sources": sources, "files": file_names})
+        # 2. 累積 token，每當可解析的部分 JSON 有變化就送出一次
+        buffer = ""
+        last_partial = None
+        try:
+            async for token in stream_in_thread(
+                STAGES["llm"],
+                lambda: iter_chat_tokens(
+                    client, model="gpt-4o", messages=messages,
+                    response_format={"type": "json_object"}, temperature=0.7
+                ),
+            ):
+                buffer += token
+                partial = parse_partial_json(buffer)
+                if isinstance(partial, dict) and partial != last_partial:
+                    last_partial = partial
+                    yield sse_event("partial", partial)
+            # 3. 完整 JSON
+            yield sse_event("done", json.loads(buffer))
+        except Exception as e:
+            yield sse_event("error", {"error": str(e)})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={**SSE_HEADERS, **context.headers()})
+
+
+# --- [新增] 共通函數：組合評分用的 Prompt (單筆評分與批次評分共用) ---
+def build_grading_prompt(qtype: str, question_text: str, student_answer: str, context_text: str) -> str:
+    """
+    依題型 (觀念簡答題 / R 語言實作題) 組合 GPT-4o 評分用的 Prompt
+    """
+    is_conceptual = any(k in qtype for k in ["簡答", "Short Answer", "Intro"])
+
+    if is_conceptual:
+        # 情境 A：觀念簡答題 Prompt
+        return f"""你是一位空間分析助教。請批改這道**「觀念簡答題」**。
+目標：評估學生對 GIS 原理的理解、邏輯推演與解釋清晰度。
+【重要限制】
+1. **請務必使用繁體中文 (Traditional Chinese) 撰寫所有評語、優點、弱點與行動建議。**
+2. 若參考資料為英文，請自行翻譯並內化成中文回饋。
+【評分標準】A) 概念正確性 (3分), B) 邏輯與解釋 (4分), C) 完整性 (3分)。
+【輸出 JSON】{{ "score": int, "level": str, "rubric": [], "strengths": [], "weaknesses": [], "missing_items": [], "action_items": [] }}
+[題目] {question_text}
+[學生回答] {student_answer}
+[講義依據] {context_text}"""
+    # 情境 B：實作題 Prompt (預設)
+    return f"""你是一位空間分析助教。請批改這道**「R 語言實作題」**。
+目標：評估 R 程式碼的正確性、可重現性與空間邏輯。
+【重要限制】
+1. **請務必使用繁體中文 (Traditional Chinese) 撰寫所有評語、優點、弱點與行動建議。**
+2. 若參考資料為英文，請自行翻譯並內化成中文回饋。
+【評分標準】A) 需求覆蓋 (3分), B) 空間邏輯 (4分), C) R 程式嚴謹度 (3分)。
+【輸出 JSON】{{ "score": int, "level": str, "rubric": [], "strengths": [], "weaknesses": [], "missing_items": [], "action_items": [] }}
+[題目] {question_text}
+[學生回答] {student_answer}
+[講義依據] {context_text}"""
+
+# [新增] 評分模型與 Prompt 版本：修改 build_grading_prompt 的內容時請調高版本號，舊的快取結果便不會再被使用
+GRADING_MODEL = "gpt-4o"
+GRADING_PROMPT_VERSION = "1"
+
+async def grade_with_prompt(client: OpenAI, prompt: str) -> dict:
+    """
+    呼叫 GPT-4o 評分並解析 JSON 結果 (阻塞呼叫交給 llm 階段的執行緒池)
+    """
+    response = await STAGES["llm"].run(
+        chat_completion, client,
+        model=GRADING_MODEL,
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_object"},
+        temperature=0.3 # 評分建議使用低溫度，保持客觀一致
+    )
+    return json.loads(response.choices[0].message.content)
+
+# --- [新增] 評分結果快取 (持久保存) + 相同請求合併 (single-flight) ---
+def normalize_answer(answer: str) -> str:
+    """
+    正規化學生答案，只去除不影響評分的差異 (換行符號、行尾與前後空白)
+    """
+    lines = answer.replace("\r\n", "\n").replace("\r", "\n").strip().split("\n")
+    return "\n".join(line.rstrip() for line in lines)
+
+def grading_cache_key(qtype: str, question_text: str, student_answer: str, context_text: str) -> str:
+    """
+    以 (模型, Prompt 版本, 題型, 題目, 正規化後的答案, 講義內容) 計算評分快取的 Key
+    講義內容以雜湊代表，語料庫更新或 token 預算調整導致 Prompt 不同時自然不會命中
+    """
+    payload = json.dumps({
+        "model": GRADING_MODEL,
+        "prompt_version": GRADING_PROMPT_VERSION,
+        "qtype": qtype,
+        "question": question_text,
+        "answer": normalize_answer(student_answer),
+        "context": EmbeddingStore.text_hash(context_text),
+    }, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class GradingCache:
+    """
+    把評分結果存在 SQLite (跨重啟保留)，學生重交一模一樣的答案或助教重新批改時不必再呼叫 GPT-4o
+    同一時間有多個相同的評分請求時，只有第一個會真的呼叫 API，其餘等待並共用結果
+    """
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()  # sqlite3 連線跨執行緒共用，需自行加鎖
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS grades ("
+            " cache_key TEXT PRIMARY KEY,"
+            " result TEXT NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._inflight: Dict[str, asyncio.Task] = {}  # 進行中的評分 (只在事件迴圈中存取)
+        # SQLite 讀寫專用的小型執行緒池：快取命中不必與 GPT-4o 呼叫搶 llm 階段的名額
+        self._executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="grading-cache")
+        self.hits = 0       # 由快取直接回傳的次數
+        self.misses = 0     # 實際呼叫 GPT-4o 的次數
+        self.coalesced = 0  # 與進行中的相同請求合併的次數
+        self.forced = 0     # 要求強制重新評分的次數
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM grades WHERE cache_key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, result: dict):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO grades VALUES (?, ?, ?)",
+                (key, json.dumps(result, ensure_ascii=False), time.time()),
+            )
+            self._conn.commit()
+
+    async def get_or_grade(self, key: str, grade: Callable, force: bool = False):
+        """
+        回傳 (評分結果, 來源)，來源為 "hit" / "coalesced" / "miss"
+        grade: 無參數的 async 函數，真正呼叫 GPT-4o 評分
+        force: 略過快取重新評分 (仍會與進行中的相同請求合併，並以新結果覆蓋快取)
+        """
+        if force:
+            self.forced += 1
+        else:
+            # SQLite 查詢在專用的執行緒池中執行，不阻塞事件迴圈 (只有未命中時 grade() 才佔用 llm 名額)
+            cached = await asyncio.get_running_loop().run_in_executor(self._executor, self.get, key)
+            if cached is not None:
+                self.hits += 1
+                return cached, "hit"
+
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending), "coalesced"
+
+        # 評分在獨立的 task 中執行：發起的請求被取消 (例如用戶端斷線) 時只停止它自己的等待，
+        # 合併進來的其他請求仍會拿到結果
+        task = asyncio.create_task(self._grade(key, grade))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # 沒有等待者時避免「例外未被讀取」警告
+        self._inflight[key] = task
+        self.misses += 1
+        return await asyncio.shield(task), "miss"
+
+    async def _grade(self, key: str, grade: Callable) -> dict:
+        try:
+            result = await grade()
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.put, key, result)
+            return result
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM grades").fetchone()[0]
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "path": self.db_path,
+            "stored_results": count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "forced": self.forced,
+            "in_flight": len(self._inflight),
+            "hit_ratio": ((self.hits + self.coalesced) / lookups) if lookups else 0.0,
+        }
+
+# 建立全域評分快取實例
+GRADING_CACHE = GradingCache(os.path.join(CACHE_DIR, "grading.sqlite3"))
+
+async def grade_answer(client: OpenAI, qtype: str, question_text: str, student_answer: str,
+                       context: BuiltContext, force: bool = False):
+    """
+    依組合好的講義內容評分一份答案 (經過評分快取)，回傳 (評分結果, 快取來源)
+    """
+    prompt = build_grading_prompt(qtype, question_text, student_answer, context.text)
+    key = grading_cache_key(qtype, question_text, student_answer, context.text)
+    return await GRADING_CACHE.get_or_grade(key, lambda: grade_with_prompt(client, prompt), force=force)
+
+# =========================================================
+# [新增] API 4: 智慧評分 (Grade Submission)
+# 邏輯：優先使用上傳的檔案，若無則使用伺服器啟動時載入的 'rag_db.zip'
+# =========================================================
+@app.post("/api/grade_submission")
+async def grade_submission_with_upload(
+    background_tasks: BackgroundTasks,
+    file: Optional[UploadFile] = File(None), # [關鍵修改] 檔案為可選 (Optional)
+    question_text: str = Form(...),    # 題目內容
+    student_answer: str = Form(...),   # 學生回答
+    qtype: str = Form(...),            # 題型
+    force_regrade: bool = Form(False), # [新增] True 時略過評分快取，強制重新評分 (例如助教要求重批)
+    corpus_id: Optional[str] = Form(None)  # [新增] 已註冊語料庫的 corpus_id (優先於 file)
+):
+    """
+    【評分 API】
+    1. 依據上傳或預設的 ZIP 準備評分標準庫。
+    2. 根據「題目內容」檢索相關講義 (Context)。
+    3. 呼叫 GPT-4o 進行評分。
+    """
+    # 檢查 API Key
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key: return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+
+    # === [關鍵邏輯] 決定使用哪個 ZIP 檔案來源 ===
+    if file:
+        log_event("upload_received", filename=file.filename)
+    # 未上傳時使用常駐記憶體的預設語料庫，不再複製與解壓縮 rag_db.zip
+
+    try:
+        # 2~3. 上傳的檔案由索引快取取得語料庫 (未命中時才掃描 ZIP、偵測並載入向量資料庫)
+        try:
+            corpus = await resolve_corpus(file, api_key, empty_error="Zip 內無支援的講義文件",
+                                          corpus_id=corpus_id)
+        except CorpusInputError as e:
+            return corpus_error_response(e)
+
+        # 4. RAG 檢索 (Retrieval) - 用「題目」去撈出「標準答案/相關概念」作為評分依據 (Context)
+        # 這樣 AI 才能根據講義內容評分，而不只是根據通用知識
+        query = question_text
+        docs = await retrieve_docs(corpus, query, k=5)  # 同一題目重複評分時由檢索快取取得
+        context = await assemble_context(docs)  # 合併重疊段落並控制在 token 預算內
+
+        # 5~6. 依題型組合評分 Prompt 並呼叫 OpenAI 評分 (相同答案直接沿用評分快取，force_regrade 時重新評分)
+        client = await resolve_openai_client()
+        result, cache_status = await grade_answer(client, qtype, question_text, student_answer, context,
+                                                  force=force_regrade)
+
+        # 回傳 JSON 結果 (X-Grading-Cache 標示結果來源：hit / coalesced / miss)
+        return JSONResponse(content=result, headers={"X-Grading-Cache": cache_status, **context.headers()})
+
+    except StageOverloaded as e:
+        # 伺服器忙碌：回傳 429/503
+        return overloaded_response(e)
+    except Exception as e:
+        # 發生錯誤時回傳 500
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+# =========================================================
+# [新增] API 5: 批次評分 (Grade Batch)
+# 同一題目、全班的答案：只準備一次語料庫、只檢索一次，再以有限的並行數呼叫 GPT-4o 評分
+# =========================================================
+GRADE_BATCH_MAX_ITEMS = env_int("GRADE_BATCH_MAX_ITEMS", 200)     # 單次批次最多幾份答案
+GRADE_BATCH_CONCURRENCY = env_int("GRADE_BATCH_CONCURRENCY", 8)   # 單次批次同時評分的上限
+
+def parse_batch_answers(answers: Optional[str], csv_bytes: Optional[bytes]) -> List[dict]:
+    """
+    解析批次評分的學生答案，回傳 [{"id": ..., "answer": ...}, ...] (保持原始順序)
+    - answers: JSON 陣列，元素可為字串或 {"id": ..., "answer": ...}
+    - csv_bytes: CSV 檔內容，需含 answer (或 student_answer) 欄位，可選 id (或 student_id) 欄位
+    格式錯誤時拋出 ValueError
+    """
+    items: List[dict] = []
+    if answers:
+        try:
+            raw = json.loads(answers)
+        except json.JSONDecodeError:
+            raise ValueError("answers 必須是 JSON 陣列")
+        if not isinstance(raw, list):
+            raise ValueError("answers 必須是 JSON 陣列")
+        for i, entry in enumerate(raw):
+            if isinstance(entry, str):
+                items.append({"id": str(i), "answer": entry})
+            elif isinstance(entry, dict) and isinstance(entry.get("answer", entry.get("student_answer")), str):
+                answer = entry.get("answer", entry.get("student_answer"))
+                items.append({"id": str(entry.get("id", entry.get("student_id", i))), "answer": answer})
+            else:
+                raise ValueError(f"answers[{i}] 格式錯誤，需為字串或含 answer 欄位的物件")
+    elif csv_bytes:
+        reader = csv.DictReader(io.StringIO(decode_text(csv_bytes)))
+        fields = {(name or "").strip().lower(): name for name in (reader.fieldnames or [])}
+        answer_col = fields.get("answer") or fields.get("student_answer")
+        id_col = fields.get("id") or fields.get("student_id")
+        if not answer_col:
+            raise ValueError("CSV 需包含 answer 或 student_answer 欄位")
+        for i, row in enumerate(reader):
+            row_id = (row.get(id_col) or "").strip() if id_col else ""
+            items.append({"id": row_id or str(i), "answer": row.get(answer_col) or ""})
+    else:
+        raise ValueError("請提供 answers (JSON) 或 answers_file (CSV)")
+
+    if not items:
+        raise ValueError("沒有任何學生答案")
+    if len(items) > GRADE_BATCH_MAX_ITEMS:
+        raise ValueError(f"單次最多評分 {GRADE_BATCH_MAX_ITEMS} 份答案")
+    return items
+
+@app.post("/api/grade_batch")
+async def grade_batch(
+    file: Optional[UploadFile] = File(None),          # 評分參考 ZIP (可選)，未上傳時使用預設語料庫
+    corpus_id: Optional[str] = Form(None),            # [新增] 或使用已註冊語料庫的 corpus_id
+    question_text: str = Form(...),                   # 題目內容 (全批次共用)
+    qtype: str = Form(...),                           # 題型
+    answers: Optional[str] = Form(None),              # 學生答案 JSON 陣列
+    answers_file: Optional[UploadFile] = File(None),  # 或上傳 CSV (answer / student_answer 欄位)
+    stream: bool = Form(False),                       # True 時以 SSE 逐筆回傳評分完成的結果
+    force_regrade: bool = Form(False)                 # [新增] True 時略過評分快取，強制重新評分
+):
+    """
+    【批次評分 API】
+    1. 準備語料庫並以題目檢索講義 (整批只做一次)。
+    2. 以 GRADE_BATCH_CONCURRENCY 為上限並行呼叫 GPT-4o 評分。
+    3. 單筆失敗不影響其他答案，該筆以 ok=false 與 error 說明回傳。
+    回傳：
+    - stream=False：依輸入順序回傳 {"results": [...]}
+    - stream=True：text/event-stream，每筆完成即送出 event: result，最後送出 event: done
+    """
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key: return JSONResponse(status_code=500, content={"error": "未設定 OPENAI_API_KEY"})
+
+    try:
+        csv_bytes = await answers_file.read() if answers_file else None
+        items = parse_batch_answers(answers, csv_bytes)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+
+    try:
+        # 1. 語料庫與檢索：整批共用同一份講義依據
+        try:
+            corpus = await resolve_corpus(file, api_key, empty_error="Zip 內無支援的講義文件",
+                                          corpus_id=corpus_id)
+        except CorpusInputError as e:
+            return corpus_error_response(e)
+        docs = await retrieve_docs(corpus, question_text, k=5)
+        context = await assemble_context(docs)  # 整批只組合一次講義內容
+        client = await resolve_openai_client()
+    except StageOverloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+
+    sources = source_filenames(docs)
+    semaphore = asyncio.Semaphore(GRADE_BATCH_CONCURRENCY)
+
+    async def grade_item(index: int, item: dict) -> dict:
+        # 2. 單筆評分：錯誤只記錄在該筆結果中，不中斷整批
+        async with semaphore:
+            try:
+                result, cache_status = await grade_answer(client, qtype, question_text, item["answer"], context,
+                                                          force=force_regrade)
+                return {"index": index, "id": item["id"], "ok": True, "result": result, "cache": cache_status}
+            except StageOverloaded as e:
+                return {"index": index, "id": item["id"], "ok": False, "error": str(e), "status": e.status_code}
+            except Exception as e:
+                return {"index": index, "id": item["id"], "ok": False, "error": str(e)}
+
+    if not stream:
+        results = await asyncio.gather(*[grade_item(i, item) for i, item in enumerate(items)])
+        return {
+            "question_text": question_text,
+            "count": len(results),
+            "failed": sum(1 for r in results if not r["ok"]),
+            "sources": sources,
+            "results": results,
+        }
+
+    async def event_stream():
+        yield sse_event("sources", {"question_text": question_text, "count": len(items), "sources": sources})
+        tasks = [asyncio.ensure_future(grade_item(i, item)) for i, item in enumerate(items)]
+        failed = 0
+        try:
+            # 3. 依完成順序送出 (每筆帶 index，前端可自行排回原順序)
+            for next_done in asyncio.as_completed(tasks):
+                r = await next_done
+                failed += 0 if r["ok"] else 1
+                yield sse_event("result", r)
+            yield sse_event("done", {"count": len(items), "failed": failed})
+        finally:
+            # 用戶端中途斷線：取消尚未開始的評分，避免浪費 API 額度
+            for t in tasks:
+                t.cancel()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers=SSE_HEADERS)
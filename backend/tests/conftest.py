@@ -0,0 +1,59 @@
+"""
+測試共用設定：在匯入 main 之前準備好環境變數 (全新的快取目錄、不載入預設語料庫、不背景補題)
+並在背景執行緒啟動 benchmarks/fake_openai.py 作為 OpenAI API 的替身 (不花費 API 費用也不需要網路)
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_DIR = os.path.join(BACKEND_DIR, "benchmarks")
+sys.path[:0] = [BACKEND_DIR, BENCH_DIR]
+
+import fake_openai  # noqa: E402
+import uvicorn  # noqa: E402
+from load_test import free_port  # noqa: E402
+
+WORKDIR = tempfile.mkdtemp(prefix="autoq-tests-")
+FAKE_PORT = free_port()
+os.environ.update({
+    "OPENAI_API_KEY": "sk-test",
+    "OPENAI_BASE_URL": f"http://127.0.0.1:{FAKE_PORT}/v1",
+    "RAG_CACHE_DIR": os.path.join(WORKDIR, "cache"),
+    "DEFAULT_RAG_ZIP": os.path.join(WORKDIR, "missing.zip"),
+    "QUESTION_POOL_SIZE": "0",
+    "LOADER_MODE": "serial",
+    "EMBED_CHECK_CTX_LENGTH": "0",  # 離線環境無法下載 tiktoken 編碼檔
+})
+# 替身不模擬延遲
+fake_openai.LATENCY.update({"embedding": 0, "embedding_item": 0, "chat": 0, "token": 0})
+
+
+@pytest.fixture(scope="session", autouse=True)
+def fake_openai_server():
+    server = uvicorn.Server(uvicorn.Config(fake_openai.app, host="127.0.0.1", port=FAKE_PORT, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.time() + 30
+    while not server.started:
+        if time.time() > deadline:
+            raise RuntimeError("fake_openai 啟動逾時")
+        time.sleep(0.05)
+    yield server
+    server.should_exit = True
+    thread.join(timeout=10)
+
+
+@pytest.fixture(scope="session")
+def main():
+    import main as app_main
+    return app_main
+
+
+@pytest.fixture
+def workdir(tmp_path):
+    return str(tmp_path)
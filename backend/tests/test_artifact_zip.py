@@ -0,0 +1,49 @@
+"""
+索引 ZIP 的打包：需 memory-map 的成員以 STORED 寫入，資料起點對齊 64 bytes
+"""
+import io
+import os
+import zipfile
+
+import numpy as np
+import pytest
+
+
+def make_folder(root: str, vector_bytes: int = 4096) -> str:
+    folder = os.path.join(root, "db")
+    os.makedirs(folder)
+    with open(os.path.join(folder, "manifest.json"), "w") as f:
+        f.write('{"format": "test"}')
+    np.arange(vector_bytes // 4, dtype=np.float32).tofile(os.path.join(folder, "vectors.f32"))
+    return folder
+
+
+def check_aligned(main, zip_source):
+    with zipfile.ZipFile(zip_source) as zf:
+        info = zf.getinfo("db/vectors.f32")
+        assert info.compress_type == zipfile.ZIP_STORED
+        offset = main.member_data_offset(zf, info)
+        assert offset % 64 == 0
+        assert zf.read(info) == np.arange(info.file_size // 4, dtype=np.float32).tobytes()
+        return info
+
+
+@pytest.mark.parametrize("zip64", [False, True])
+def test_package_artifact_aligns_stored_members(main, tmp_path, monkeypatch, zip64):
+    if zip64:
+        # 以較小的上限模擬 2GB 以上的成員，zipfile 會在 local header 加上 zip64 欄位
+        monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 1024)
+    folder = make_folder(str(tmp_path))
+    out = str(tmp_path / "db.zip")
+    main.package_artifact(folder, out)
+    info = check_aligned(main, out)
+    assert (b"\x01\x00\x10\x00" in info.extra) == zip64  # zip64 欄位 (header id 1，長度 16)
+
+
+@pytest.mark.parametrize("zip64", [False, True])
+def test_streamed_artifact_is_aligned(main, tmp_path, monkeypatch, zip64):
+    if zip64:
+        monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 1024)
+    folder = make_folder(str(tmp_path))
+    data = b"".join(main.iter_artifact_zip(folder))
+    check_aligned(main, io.BytesIO(data))
@@ -0,0 +1,126 @@
+"""
+索引快取、檢索快取與 Embedding 快取的命中與未命中
+"""
+import asyncio
+import io
+import threading
+import time
+import zipfile
+from types import SimpleNamespace
+
+
+def corpus(size_bytes: int = 10):
+    return SimpleNamespace(size_bytes=size_bytes)
+
+
+def test_index_cache_counts_each_request_once(main):
+    cache = main.IndexCache(max_entries=4, max_bytes=1000)
+    release = threading.Event()
+    builds = []
+
+    def builder():
+        builds.append(1)
+        release.wait(10)
+        return corpus()
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_build("k", builder)))
+               for _ in range(5)]
+    for t in threads:
+        t.start()
+    time.sleep(0.2)  # 讓其餘請求都在等待建立中的項目
+    release.set()
+    for t in threads:
+        t.join()
+
+    assert len(builds) == 1 and len(results) == 5
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"]) == (1, 4)
+
+    cache.get_or_build("k", builder)
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert (stats["misses"], stats["hits"]) == (2, 5)
+
+
+def test_index_cache_evicts_lru_and_invalidates_retrieval_results(main):
+    index_cache = main.IndexCache(max_entries=2, max_bytes=1000)
+    retrieval = main.RetrievalCache(max_entries=16, max_bytes=10_000, ttl_seconds=0)
+    index_cache.on_evict = retrieval.invalidate
+    for key in ("a", "b"):
+        index_cache.put(key, corpus())
+        retrieval.put(key, "buffer", 3, [])
+    assert index_cache.get("a") is not None  # a 成為最近使用，b 最先被淘汰
+
+    index_cache.put("c", corpus())
+    assert index_cache.get("b") is None and index_cache.get("a") is not None
+    assert retrieval.get("b", "buffer", 3) is None and retrieval.get("a", "buffer", 3) == []
+    assert index_cache.stats()["evictions"] == 1
+
+    # 單一項目超過記憶體上限時不放入快取
+    index_cache.put("huge", corpus(size_bytes=5000))
+    assert index_cache.get("huge") is None
+
+
+def test_retrieval_cache_hits_ttl_and_vectors(main, monkeypatch):
+    cache = main.RetrievalCache(max_entries=2, max_bytes=10_000, ttl_seconds=60)
+    assert cache.get("fp", "query", 5) is None
+    cache.put("fp", "query", 5, [])
+    assert cache.get("fp", "query", 5) == []
+    assert cache.get("fp", "query", 3) is None  # k 不同視為不同查詢
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"]) == (1, 2)
+
+    cache.put_vector("model", "query", [0.5, 0.5])
+    cache.invalidate("fp")
+    assert cache.get("fp", "query", 5) is None
+    assert cache.get_vector("model", "query") == [0.5, 0.5]  # 語料庫變更時查詢向量仍可沿用
+
+    now = time.time()
+    monkeypatch.setattr(main.time, "time", lambda: now + 3600)
+    assert cache.get_vector("model", "query") is None  # 超過 TTL
+
+
+def lecture_zip(text: str) -> bytes:
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as zf:
+        zf.writestr("week1/notes.md", text)
+    return out.getvalue()
+
+
+def test_prepared_corpus_and_retrieval_are_cached(main, monkeypatch):
+    text = "\n\n".join(f"Paragraph {i}: spatial autocorrelation with moran index and kriging {i}." * 8
+                       for i in range(6))
+    data = lecture_zip(text)
+    fingerprint = main.hashlib.sha256(data).hexdigest()
+    builds = []
+
+    def build():
+        builds.append(1)
+        return main.prepare_corpus_from_zip(io.BytesIO(data), "sk-test", fingerprint)
+
+    prepared = main.INDEX_CACHE.get_or_build(fingerprint, build)
+    assert main.INDEX_CACHE.get_or_build(fingerprint, build) is prepared
+    assert len(builds) == 1
+
+    embedded = []
+    original = prepared.vectorstore.embeddings.embed_query
+    monkeypatch.setattr(prepared.vectorstore.embeddings, "embed_query",
+                        lambda query: embedded.append(query) or original(query))
+    hits = main.RETRIEVAL_CACHE.stats()["hits"]
+    first = asyncio.run(main.retrieve_docs(prepared, "what is kriging", k=2))
+    second = asyncio.run(main.retrieve_docs(prepared, "what is kriging", k=2))
+    assert [d.page_content for d in first] == [d.page_content for d in second]
+    assert main.RETRIEVAL_CACHE.stats()["hits"] == hits + 1
+    assert embedded == ["what is kriging"]
+    main.INDEX_CACHE.evict(fingerprint)
+
+
+def test_embedding_cache_is_reused_across_builds(main, tmp_path):
+    text = "\n\n".join(f"Section {i} explains buffer and overlay analysis in detail {i}." * 6 for i in range(5))
+    src = tmp_path / "src.zip"
+    src.write_bytes(lecture_zip(text + "\n\nunique tail for embedding cache test"))
+    first = main.build_vector_db_zip(str(src), "sk-test", str(tmp_path / "a"), None)
+    second = main.build_vector_db_zip(str(src), "sk-test", str(tmp_path / "b"), None)
+    assert first["embedding_new"] == first["chunks_total"] > 0
+    assert (second["embedding_new"], second["embedding_reused"]) == (0, first["chunks_total"])
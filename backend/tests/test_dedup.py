@@ -0,0 +1,65 @@
+"""
+Chunk 去重：完全相同 (正規化空白後) 與 MinHash 近似重複的 Chunk 合併進第一次出現的 Chunk
+"""
+import random
+
+from langchain_core.documents import Document
+
+WORDS = "spatial analysis buffer overlay projection raster vector kriging interpolation density polygon".split()
+
+
+def text(seed: int, words: int = 120) -> str:
+    rng = random.Random(seed)
+    return " ".join(f"{rng.choice(WORDS)}{rng.randrange(100)}" for _ in range(words))
+
+
+def chunk(content: str, source: str) -> Document:
+    return Document(page_content=content, metadata={"source": source, "filename": source.split("/")[-1]})
+
+
+def test_exact_and_near_duplicates_are_merged(main):
+    base, other = text(1), text(2)
+    near = base.replace(base.split()[10], "changed", 1)
+    docs = [
+        chunk(base, "week1/a.md"),
+        chunk(other, "week1/b.md"),
+        chunk("  " + base.replace(" ", "\n", 3), "week2/a-copy.md"),  # 只有空白不同
+        chunk(near, "week3/a-edited.md"),
+    ]
+    kept, positions, stats = main.dedup_chunks(docs)
+
+    assert positions == [0, 1]
+    assert stats == {"chunks_exact_duplicates": 1, "chunks_near_duplicates": 1}
+    first = kept[0]
+    assert first.page_content == base and first.metadata["source"] == "week1/a.md"
+    assert main.chunk_sources(first) == ["week1/a.md", "week2/a-copy.md", "week3/a-edited.md"]
+    # 被合併掉的 Chunk 保存在 duplicates，增量更新時可以重新選出代表
+    assert [d["page_content"] for d in first.metadata["duplicates"]] == [docs[2].page_content, near]
+    assert kept[1] is docs[1]
+    # 不修改輸入的 Document
+    assert "sources" not in docs[0].metadata and "duplicates" not in docs[0].metadata
+
+
+def test_distinct_chunks_are_kept(main):
+    docs = [chunk(text(seed), f"week{seed}/notes.md") for seed in range(10)]
+    kept, positions, stats = main.dedup_chunks(docs)
+    assert kept == docs and positions == list(range(10))
+    assert stats == {"chunks_exact_duplicates": 0, "chunks_near_duplicates": 0}
+
+
+def test_near_duplicate_threshold(main, monkeypatch):
+    base = text(3)
+    words = base.split()
+    half = " ".join(words[:60] + text(4, 60).split())  # 只有一半相同
+    kept, _, stats = main.dedup_chunks([chunk(base, "a.md"), chunk(half, "b.md")])
+    assert len(kept) == 2 and stats["chunks_near_duplicates"] == 0
+
+    monkeypatch.setattr(main, "CHUNK_DEDUP", False)
+    same = [chunk(base, "a.md"), chunk(base, "b.md")]
+    assert main.dedup_chunks(same)[0] == same
+
+
+def test_signature_is_deterministic(main):
+    a = main.minhash_signature(text(5))
+    assert (a == main.minhash_signature(text(5))).all()
+    assert (a != main.minhash_signature(text(6))).any()
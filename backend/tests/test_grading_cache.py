@@ -0,0 +1,86 @@
+"""
+評分快取 (GradingCache)：命中、合併相同的進行中請求、發起的請求被取消時其他請求仍拿到結果
+"""
+import asyncio
+
+import pytest
+
+
+@pytest.fixture
+def cache(main, tmp_path):
+    return main.GradingCache(str(tmp_path / "grading.sqlite3"))
+
+
+def grader(calls, result, gate=None):
+    async def grade():
+        calls.append(1)
+        if gate is not None:
+            await gate.wait()
+        return result
+    return grade
+
+
+def test_miss_then_hit_and_force(cache):
+    calls = []
+
+    async def scenario():
+        first = await cache.get_or_grade("k", grader(calls, {"score": 8}))
+        second = await cache.get_or_grade("k", grader(calls, {"score": 0}))
+        forced = await cache.get_or_grade("k", grader(calls, {"score": 9}), force=True)
+        return first, second, forced
+
+    assert asyncio.run(scenario()) == (({"score": 8}, "miss"), ({"score": 8}, "hit"), ({"score": 9}, "miss"))
+    assert len(calls) == 2
+    assert cache.get("k") == {"score": 9}  # 強制重新評分的結果覆蓋快取
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["forced"], stats["stored_results"]) == (1, 2, 1, 1)
+
+
+def test_concurrent_requests_are_coalesced(cache):
+    calls = []
+
+    async def scenario():
+        gate = asyncio.Event()
+        grade = grader(calls, {"score": 7}, gate)
+        tasks = [asyncio.create_task(cache.get_or_grade("k", grade)) for _ in range(3)]
+        await asyncio.sleep(0.05)
+        gate.set()
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(scenario())
+    assert len(calls) == 1
+    assert sorted(source for _, source in results) == ["coalesced", "coalesced", "miss"]
+    assert all(result == {"score": 7} for result, _ in results)
+    assert cache.stats()["in_flight"] == 0
+
+
+def test_cancelled_initiator_does_not_cancel_waiters(cache):
+    calls = []
+
+    async def scenario():
+        gate = asyncio.Event()
+        grade = grader(calls, {"score": 6}, gate)
+        initiator = asyncio.create_task(cache.get_or_grade("k", grade))
+        await asyncio.sleep(0.05)
+        waiter = asyncio.create_task(cache.get_or_grade("k", grade))
+        await asyncio.sleep(0.05)
+        initiator.cancel()  # 例如用戶端斷線
+        gate.set()
+        with pytest.raises(asyncio.CancelledError):
+            await initiator
+        return await waiter
+
+    assert asyncio.run(scenario()) == ({"score": 6}, "coalesced")
+    assert len(calls) == 1 and cache.get("k") == {"score": 6}
+
+
+def test_failed_grading_is_not_cached(cache):
+    async def failing():
+        raise RuntimeError("api down")
+
+    async def scenario():
+        with pytest.raises(RuntimeError):
+            await cache.get_or_grade("k", failing)
+        return await cache.get_or_grade("k", grader([], {"score": 5}))
+
+    assert asyncio.run(scenario()) == ({"score": 5}, "miss")
@@ -0,0 +1,102 @@
+"""
+增量更新 (/api/update_index) 的結果應與用完整講義包重新建庫相同
+"""
+import io
+import os
+import random
+import zipfile
+
+import numpy as np
+import pytest
+
+WORDS = ("spatial analysis buffer overlay projection coordinate raster vector kriging interpolation "
+         "autocorrelation density kernel polygon network shortest path zonal statistics clip dissolve").split()
+
+
+def lecture(seed: int, paragraphs: int = 6) -> str:
+    # 每段約 400 字元，切分後每份文件有數個 Chunk；不同 seed 的內容互不重複
+    rng = random.Random(seed)
+    return "\n\n".join(" ".join(f"{rng.choice(WORDS)}{rng.randrange(100)}" for _ in range(50))
+                       for _ in range(paragraphs))
+
+
+def make_zip(files: dict) -> bytes:
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w") as zf:
+        for name, text in sorted(files.items()):
+            zf.writestr(name, text)
+    return out.getvalue()
+
+
+BASE_FILES = {
+    "week1/a.md": lecture(1),
+    "week1/b.md": lecture(1),                         # 與 a.md 完全相同 (會被合併進 a.md)
+    "week2/c.md": lecture(2),
+    "week2/d.md": lecture(2).replace("buffer", "buffers", 1),  # 與 c.md 近似重複
+    "week3/e.md": lecture(3),
+}
+
+
+def write(workdir: str, name: str, data: bytes) -> str:
+    path = os.path.join(workdir, name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def full_build(main, workdir: str, files: dict, name: str, **options) -> str:
+    src = write(workdir, f"{name}-src.zip", make_zip(files))
+    out = os.path.join(workdir, f"{name}.zip")
+    main.build_vector_db_zip(src, "sk-test", os.path.join(workdir, name), out, **options)
+    return out
+
+
+def update(main, workdir: str, base_zip: str, name: str, add: dict = None, remove=()) -> tuple:
+    out = os.path.join(workdir, f"{name}.zip")
+    add_source = io.BytesIO(make_zip(add)) if add else None
+    summary = main.update_vector_db_zip(base_zip, add_source, list(remove), "sk-test",
+                                        os.path.join(workdir, name), out)
+    return out, summary
+
+
+def assert_same_artifact(main, left: str, right: str):
+    a = main.read_artifact(left, "sk-test")
+    b = main.read_artifact(right, "sk-test")
+    assert (a.artifact_format, a.index_type) == (b.artifact_format, b.index_type)
+    assert [d.page_content for d in a.docs] == [d.page_content for d in b.docs]
+    assert [d.metadata for d in a.docs] == [d.metadata for d in b.docs]
+    if a.vectors is not None:
+        np.testing.assert_allclose(a.vectors, b.vectors, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("options", [{}, {"artifact_format": "faiss"}, {"index_type": "hnsw"}])
+def test_remove_primary_source_matches_full_rebuild(main, workdir, options):
+    base = full_build(main, workdir, BASE_FILES, "base", **options)
+    updated, summary = update(main, workdir, base, "updated", remove=["week1/a.md", "week2/c.md"])
+    rest = {k: v for k, v in BASE_FILES.items() if k not in ("week1/a.md", "week2/c.md")}
+    expected = full_build(main, workdir, rest, "expected", **options)
+
+    assert_same_artifact(main, updated, expected)
+    # d.md 是近似重複：移除 c.md 後由 d.md 自己的內容代表 (需要新的向量)
+    assert summary["chunks_added"] > 0
+    assert summary["chunks_added"] == summary["chunks_removed"]
+
+
+def test_add_and_replace_matches_full_rebuild(main, workdir):
+    base = full_build(main, workdir, BASE_FILES, "base")
+    added = {"week3/e.md": lecture(4), "week4/f.md": lecture(5), "week4/g.md": lecture(2)}
+    updated, summary = update(main, workdir, base, "updated", add=added, remove=["week1/b.md"])
+    files = {**{k: v for k, v in BASE_FILES.items() if k != "week1/b.md"}, **added}
+    expected = full_build(main, workdir, files, "expected")
+
+    assert_same_artifact(main, updated, expected)
+    expected_total = len(main.read_artifact(expected, "sk-test").docs)
+    assert summary["chunks_total"] == expected_total
+    # g.md 與 c.md 完全相同：併入既有的 Chunk，不算新增
+    assert summary["chunks_exact_duplicates"] > 0
+
+
+def test_unknown_source_is_rejected(main, workdir):
+    base = full_build(main, workdir, BASE_FILES, "base")
+    with pytest.raises(main.CorpusInputError):
+        update(main, workdir, base, "updated", remove=["week9/missing.md"])
@@ -0,0 +1,112 @@
+"""
+非同步匯入工作 (JobManager)：排隊上限、ingest 階段限制與下載中的暫存資料夾
+"""
+import time
+
+import pytest
+
+
+def make_job(main, status="queued", finished_ago=None):
+    workspace = main.WORKSPACES.acquire("job-test")
+    job = main.IngestJob(main.uuid.uuid4().hex, workspace, "lecture.zip")
+    with open(job.upload_path, "wb") as f:
+        f.write(b"zip")
+    job.status = status
+    if finished_ago is not None:
+        job.finished_at = time.time() - finished_ago
+    return job
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "等待逾時"
+        time.sleep(0.01)
+
+
+def test_retry_respects_queue_bound(main):
+    manager = main.JobManager(workers=1, max_queue=1, ttl_seconds=60)
+    failed, queued = make_job(main, status="failed"), make_job(main)
+    manager._jobs.update({failed.job_id: failed, queued.job_id: queued})
+    with pytest.raises(main.StageOverloaded) as info:
+        manager.retry(failed, "sk-test")
+    assert info.value.status_code == 429
+    assert failed.status == "failed"
+    failed.workspace.release()
+    queued.workspace.release()
+
+
+def test_jobs_share_the_ingest_limiter(main, monkeypatch):
+    limiter = main.StageLimiter("ingest", concurrency=1, max_waiting=0, wait_timeout=1)
+    monkeypatch.setitem(main.STAGES, "ingest", limiter)
+    summary = dict.fromkeys(("chunks_total", "chunks_exact_duplicates", "chunks_near_duplicates",
+                             "embedding_reused", "embedding_new"), 0)
+    monkeypatch.setattr(main, "build_vector_db_zip", lambda *args, **kwargs: summary)
+    manager = main.JobManager(workers=1, max_queue=4, ttl_seconds=60)
+    job = make_job(main)
+
+    with limiter.slot():
+        manager.submit(job, "sk-test")
+        wait_for(lambda: limiter.stats()["waiting"] == 1)
+        time.sleep(0.05)
+        # 名額被請求佔住時工作仍在排隊，且不因 max_waiting=0 或等待逾時而失敗
+        assert job.status == "queued"
+    wait_for(lambda: job.status == "done")
+    assert limiter.stats()["rejected"] == 0
+    job.workspace.release()
+
+
+def test_purge_keeps_workspace_while_downloading(main):
+    manager = main.JobManager(workers=1, max_queue=4, ttl_seconds=60)
+    job = make_job(main, status="done", finished_ago=3600)
+    manager._jobs[job.job_id] = job
+
+    assert manager.pin_result(job)
+    manager.purge_expired()
+    assert manager.get(job.job_id) is job and not job.workspace.released
+
+    job.workspace.unpin()
+    manager.purge_expired()
+    assert manager.get(job.job_id) is None and job.workspace.released
+    assert not manager.pin_result(job)
+
+
+def test_download_unpins_after_streaming(main, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    job = make_job(main, status="done")
+    job.result_path = job.workspace.file("db")
+    main.os.makedirs(job.result_path)
+    with open(main.os.path.join(job.result_path, "notes.txt"), "w") as f:
+        f.write("hello")
+    main.JOB_MANAGER._jobs[job.job_id] = job
+    seen = []
+    original = main.iter_artifact_zip
+
+    def tracking(folder):
+        seen.append(job.workspace.pins)
+        yield from original(folder)
+
+    monkeypatch.setattr(main, "iter_artifact_zip", tracking)
+    try:
+        response = TestClient(main.app).get(f"/api/jobs/{job.job_id}/download")
+    finally:
+        main.JOB_MANAGER._jobs.pop(job.job_id, None)
+        job.workspace.release()
+    assert response.status_code == 200
+    assert seen == [1] and job.workspace.pins == 0
+
+
+def test_retry_endpoint_returns_429_when_queue_is_full(main, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    monkeypatch.setattr(main.JOB_MANAGER, "max_queue", 0)
+    job = make_job(main, status="failed")
+    main.JOB_MANAGER._jobs[job.job_id] = job
+    try:
+        response = TestClient(main.app).post(f"/api/jobs/{job.job_id}/retry")
+    finally:
+        main.JOB_MANAGER._jobs.pop(job.job_id, None)
+        job.workspace.release()
+    assert response.status_code == 429
+
@@ -0,0 +1,67 @@
+"""
+分階段的並行限制 (StageLimiter)：排隊已滿回 429、等待逾時回 503，端點附上 Retry-After
+"""
+import asyncio
+import io
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+def test_rejects_when_queue_is_full(main):
+    limiter = main.StageLimiter("test", concurrency=1, max_waiting=1, wait_timeout=5)
+    entered, release = threading.Event(), threading.Event()
+
+    def hold():
+        with limiter.slot():
+            entered.set()
+            release.wait(10)
+
+    def wait_in_queue():
+        with limiter.slot():
+            pass
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    entered.wait(5)
+    waiter = threading.Thread(target=wait_in_queue)
+    waiter.start()
+    while limiter.stats()["waiting"] != 1:
+        time.sleep(0.01)
+
+    with pytest.raises(main.StageOverloaded) as info:
+        with limiter.slot():
+            pass
+    assert info.value.status_code == 429
+
+    release.set()
+    holder.join()
+    waiter.join()
+    stats = limiter.stats()
+    assert (stats["active"], stats["waiting"], stats["rejected"]) == (0, 0, 1)
+
+
+def test_wait_timeout_returns_503(main):
+    limiter = main.StageLimiter("test", concurrency=1, max_waiting=4, wait_timeout=0)
+
+    async def scenario():
+        with limiter.slot():
+            with pytest.raises(main.StageOverloaded) as info:
+                await limiter.run(lambda: None)
+        return info.value.status_code, await limiter.run(lambda x: x * 2, 21)
+
+    assert asyncio.run(scenario()) == (503, 42)
+    assert limiter.stats()["timeouts"] == 1
+
+
+def test_endpoint_answers_429_with_retry_after(main, monkeypatch):
+    limiter = main.StageLimiter("ingest", concurrency=1, max_waiting=0, wait_timeout=1)
+    monkeypatch.setitem(main.STAGES, "ingest", limiter)
+    with limiter.slot():
+        response = TestClient(main.app).post(
+            "/api/jobs/process_zip", files={"file": ("lecture.zip", io.BytesIO(b"PK\x05\x06" + b"\0" * 18))})
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "5"
+    assert main.JOB_MANAGER.stats()["jobs"].get("queued", 0) == 0
@@ -0,0 +1,54 @@
+"""
+讀檔行程池 (LoaderPool)：結果順序、損毀檔案、逾時與意外結束的行程
+使用真正的子行程 (forkserver)，子行程只匯入 loaders.py
+"""
+import pytest
+from fixtures import make_docx, make_pdf
+
+
+@pytest.fixture
+def pool(main):
+    pool = main.LoaderPool(2, "forkserver")
+    yield pool
+    pool.close()
+
+
+def test_results_keep_input_order(main, pool):
+    files = [
+        ("a.pdf", make_pdf(["first page", "second page"])),
+        ("b.md", "# notes\n".encode("utf-8")),
+        ("c.docx", make_docx(["buffer"])),
+        ("broken.pdf", b"%PDF-1.4 not really a pdf"),
+        ("d.jpg", b"\xff\xd8"),
+    ]
+    loaded = []
+    results = pool.load(files, on_loaded=loaded.append)
+
+    assert [d.metadata["page"] for d in results[0]] == [0, 1]
+    assert results[1][0].page_content == "# notes\n"
+    assert results[2][0].page_content.strip() == "buffer"
+    assert results[3] == [] and results[4] == []  # 損毀與不支援的檔案略過
+    assert loaded == [1, 2, 3, 4, 5]
+    assert results == [main.load_file_bytes(name, data) for name, data in files]
+
+
+def test_slow_file_times_out_and_worker_is_replaced(main, pool, monkeypatch):
+    monkeypatch.setattr(main, "LOADER_FILE_TIMEOUT", 0.05)
+    slow = make_pdf([f"page {i} " * 40 for i in range(400)])
+    results = pool.load([("slow.pdf", slow)])
+    assert results == [[]]
+    assert pool.stats()["timeouts"] == 1
+
+    monkeypatch.setattr(main, "LOADER_FILE_TIMEOUT", 60)
+    assert pool.load([("ok.md", b"still works")])[0][0].page_content == "still works"
+    assert pool.stats()["alive"] == 2
+
+
+def test_dead_worker_is_replaced(main, pool):
+    pool.load([("warm.md", b"x")])
+    for proc in list(pool._procs):
+        proc.kill()
+        proc.join()
+    results = pool.load([("a.md", b"a"), ("b.md", b"b")])
+    assert [docs[0].page_content for docs in results] == ["a", "b"]
+    assert pool.stats()["crashes"] >= 2 and pool.stats()["alive"] == 2
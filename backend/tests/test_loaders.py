@@ -0,0 +1,70 @@
+"""
+loaders.parse_file 與原本的 LangChain Loader (讀取暫存檔) 比較：內容與 metadata 必須一致
+"""
+import os
+
+import pytest
+from fixtures import make_docx, make_pdf
+from langchain_community.document_loaders import BSHTMLLoader, Docx2txtLoader, PyPDFLoader, TextLoader
+
+from loaders import decode_text, parse_file
+
+HTML = (
+    "<html><head><title>空間分析 Lecture</title></head>\r\n"
+    "<body><h1>環域</h1><p>Use st_buffer() for this step.</p>\r\n<p>第二段</p></body></html>"
+)
+
+
+def load_with(loader_cls, tmp_path, filename, data, **kwargs):
+    """
+    以舊的方式讀檔：寫成暫存檔後交給 LangChain Loader，source 換回 ZIP 內的相對路徑 (同舊版 main)
+    """
+    path = tmp_path / os.path.basename(filename)
+    path.write_bytes(data)
+    docs = loader_cls(str(path), **kwargs).load()
+    for doc in docs:
+        doc.metadata["source"] = filename
+    return docs
+
+
+def as_tuples(docs):
+    return [(doc.page_content, doc.metadata) for doc in docs]
+
+
+@pytest.mark.parametrize("filename,data,loader_cls,kwargs", [
+    ("week1/intro.pdf", make_pdf(["Spatial autocorrelation page one.", "Kriging (page two)."]), PyPDFLoader, {}),
+    ("week1/notes.docx", make_docx(["buffer overlay", "環域 疊圖"]), Docx2txtLoader, {}),
+    ("week1/lab.md", "# 實習\r\n\r\nst_read() 讀取圖層\r\n".encode("utf-8"), TextLoader,
+     {"encoding": "utf-8", "autodetect_encoding": True}),
+    ("week1/lab.R", "﻿library(sf)\nx <- st_read('a.shp')\n".encode("utf-8"), TextLoader,
+     {"encoding": "utf-8", "autodetect_encoding": True}),
+    # 舊版 BSHTMLLoader 預設使用 lxml (未列在 requirements)，這裡與 parse_file 使用相同的 html.parser 比較
+    ("week1/page.html", HTML.encode("utf-8"), BSHTMLLoader,
+     {"open_encoding": "utf-8", "bs_kwargs": {"features": "html.parser"}}),
+])
+def test_matches_langchain_loaders(tmp_path, filename, data, loader_cls, kwargs):
+    expected = load_with(loader_cls, tmp_path, filename, data, **kwargs)
+    assert as_tuples(parse_file(filename, data)) == as_tuples(expected)
+
+
+def test_pdf_pages_carry_page_numbers():
+    docs = parse_file("a.pdf", make_pdf(["one", "two", "three"]))
+    assert [doc.metadata["page"] for doc in docs] == [0, 1, 2]
+
+
+@pytest.mark.parametrize("encoding", ["big5", "gbk"])
+def test_legacy_chinese_encodings_are_detected(encoding):
+    text = "空間自相關分析：以莫蘭指數檢定鄰近區域的屬性是否相似。\n" * 3
+    if encoding == "gbk":
+        text = "空间自相关分析：以莫兰指数检定邻近区域的属性是否相似。\n" * 3
+    docs = parse_file("notes.txt", text.encode(encoding))
+    assert docs[0].page_content == text
+
+
+def test_undetectable_encoding_raises_instead_of_mojibake():
+    with pytest.raises(ValueError):
+        decode_text(bytes(range(256)) * 4)
+
+
+def test_unsupported_extension_is_skipped():
+    assert parse_file("map.jpg", b"\xff\xd8\xff") == []
@@ -0,0 +1,82 @@
+"""
+memory-map 索引格式：寫出 -> 打包 ZIP -> 載入後的檢索結果與 Chunk 內容與寫入前相同
+"""
+import io
+import json
+import zipfile
+
+import numpy as np
+import pytest
+from langchain_core.documents import Document
+
+DIM = 16
+
+
+def make_data(count: int = 40):
+    rng = np.random.default_rng(7)
+    vectors = rng.standard_normal((count, DIM)).astype(np.float32)
+    docs = [Document(page_content=f"第 {i} 段：spatial chunk {i}",
+                     metadata={"source": f"week{i % 3}/notes.md", "chunk_index": i, "page": i // 5})
+            for i in range(count)]
+    return vectors, docs
+
+
+def build_zip(main, tmp_path, index_type: str) -> str:
+    vectors, docs = make_data()
+    folder = str(tmp_path / "db")
+    main.write_mmap_artifact(folder, vectors.tolist(), docs, "text-embedding-3-large", index_type=index_type)
+    out = str(tmp_path / "db.zip")
+    main.package_artifact(folder, out)
+    return out
+
+
+def load(main, zip_source):
+    with main.open_zip(zip_source) as zf:
+        scan = main.ZipScan(zf)
+        assert scan.mmap_dir is not None
+        return main.load_mmap_from_zip(zf, zip_source, scan.mmap_dir, "sk-test")
+
+
+@pytest.mark.parametrize("index_type", ["flat", "flat_f16", "hnsw"])
+def test_round_trip(main, tmp_path, index_type):
+    vectors, docs = make_data()
+    out = build_zip(main, tmp_path, index_type)
+    vectorstore = load(main, out)
+
+    assert vectorstore.index.ntotal == len(docs) and vectorstore.index.d == DIM
+    for i in (0, 17, len(docs) - 1):
+        hit = vectorstore.similarity_search_by_vector(vectors[i].tolist(), k=1)[0]
+        assert (hit.page_content, hit.metadata) == (docs[i].page_content, docs[i].metadata)
+    with zipfile.ZipFile(out) as zf:
+        manifest = json.loads(zf.read("db/manifest.json"))
+    assert (manifest["count"], manifest["dim"]) == (len(docs), DIM)
+    assert manifest["index"]["type"] == index_type
+
+
+def test_flat_vectors_are_memory_mapped(main, tmp_path):
+    vectors, _ = make_data()
+    out = build_zip(main, tmp_path, "flat")
+    index = load(main, out).index
+    assert isinstance(index, main.MmapFlatIndex)
+    assert index.resident_bytes < vectors.nbytes  # 向量留在檔案中，不佔用 heap
+
+    # 檔案物件 (例如上傳中的 ZIP) 無法 memory-map，改為讀進記憶體，結果相同
+    with open(out, "rb") as f:
+        in_memory = load(main, io.BytesIO(f.read()))
+    hit = in_memory.similarity_search_by_vector(vectors[3].tolist(), k=1)[0]
+    assert hit.metadata["chunk_index"] == 3
+
+
+def test_inconsistent_manifest_is_rejected(main, tmp_path):
+    out = build_zip(main, tmp_path, "flat")
+    broken = str(tmp_path / "broken.zip")
+    with zipfile.ZipFile(out) as src, zipfile.ZipFile(broken, "w") as dst:
+        for info in src.infolist():
+            data = src.read(info)
+            if info.filename.endswith("manifest.json"):
+                manifest = json.loads(data)
+                manifest["count"] += 1
+                data = json.dumps(manifest).encode("utf-8")
+            dst.writestr(info, data)
+    with pytest.raises(main.CorpusInputError):
+        load(main, broken)
@@ -0,0 +1,40 @@
+"""
+冷啟動：import main 不應載入重量級套件 (main.HEAVY_IMPORTS)，且匯入時間在預算內
+以子行程檢查 (本測試行程的其他測試已經匯入過 main 與這些套件)
+"""
+import json
+import os
+import subprocess
+import sys
+
+import startup_check
+
+# 匯入時間預算 (毫秒)，較慢的 CI 機器可用 STARTUP_IMPORT_BUDGET_MS 調整
+IMPORT_BUDGET_MS = float(os.getenv("STARTUP_IMPORT_BUDGET_MS", "1500"))
+
+PROBE = """
+import json, sys
+import main
+print(json.dumps({
+    "heavy": sorted({lazy.name.split(".")[0] for lazy in main.HEAVY_IMPORTS}),
+    "loaded": sorted(lazy.name for lazy in main.HEAVY_IMPORTS if lazy.loaded
+                     or lazy.name.split(".")[0] in sys.modules),
+}))
+"""
+
+
+def test_import_main_does_not_load_heavy_imports(tmp_path):
+    proc = subprocess.run([sys.executable, "-c", PROBE], cwd=str(tmp_path),
+                          env=startup_check.clean_env(str(tmp_path)), capture_output=True, text=True, check=True)
+    result = json.loads(proc.stdout.strip().splitlines()[-1])
+    assert result["loaded"] == []
+    # startup_check 的 LAZY_MODULES 需涵蓋 HEAVY_IMPORTS 的所有套件
+    assert set(result["heavy"]) <= set(startup_check.LAZY_MODULES)
+    assert startup_check.eager_modules(str(tmp_path)) == []
+
+
+def test_startup_check_import_budget():
+    proc = subprocess.run([sys.executable, os.path.join(startup_check.BENCH_DIR, "startup_check.py"),
+                           "--skip-serve", "--runs", "3", "--import-budget-ms", str(IMPORT_BUDGET_MS)],
+                          cwd=startup_check.BACKEND_DIR, capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stdout + proc.stderr